@@ -7,7 +7,7 @@ import argparse
 import numpy as np
 import matplotlib.pyplot as plt
 from llcsim.analysis import Poly_fit, top, Atom_props
-import mdtraj as md
+from llcsim.llclib import trajectory, physical, timeseries
 import time
 from scipy import stats
 
@@ -31,33 +31,6 @@ def initialize():
     return args
 
 
-def autocorrFFT(x):
-
-    N = len(x)
-    F = np.fft.fft(x, n=2*N)  # 2*N because of zero-padding
-    PSD = F * F.conjugate()
-    res = np.fft.ifft(PSD)
-    res = (res[:N]).real   # now we have the autocorrelation in convention B
-    n= N*np.ones(N)-np.arange(0, N)  # divide res(m) by (N-m)
-    return old_div(res,n)  # this is the autocorrelation in convention A
-
-
-def msd_fft(x, ndx):
-
-    r = np.copy(x)
-    r = r[:, ndx]
-    N = len(r)
-    D = np.square(r).sum(axis=1)
-    D = np.append(D, 0)
-    S2 = sum([autocorrFFT(r[:, i]) for i in range(r.shape[1])])
-    Q = 2*D.sum()
-    S1 = np.zeros(N)
-    for m in range(N):
-      Q = Q-D[m-1]-D[N-m]
-      S1[m] = old_div(Q,(N-m))
-    return S1-2*S2
-
-
 def msd(x, axis):
     """
     Calculate mean square displacement based on particle positions
@@ -66,17 +39,7 @@ def msd(x, axis):
     :return: MSD of each particle
     """
 
-    nT = x.shape[0]
-    no_comp = x.shape[1]
-    # MSD = np.zeros([nT], dtype=float)
-    MSDs = np.zeros([nT, no_comp], dtype=float)  # a set of MSDs per particle
-
-    for n in range(no_comp):
-        MSDs[:, n] = msd_fft(x[:, n, :], axis)
-    #     MSD += MSDs[:, n]
-    # MSD /= no_comp
-
-    return MSDs
+    return timeseries.msd_batch(x, axis)
 
 
 def msd_straightforward(x, ndx):
@@ -103,7 +66,8 @@ def msd_straightforward(x, ndx):
 
 class Diffusivity(object):
 
-    def __init__(self, traj, gro, axis, begin=0, startfit=0.05, endfit=0.2, residue=False, atoms=[], restrict=[]):
+    def __init__(self, traj, gro, axis, begin=0, startfit=0.05, endfit=0.2, residue=False, atoms=[], restrict=[],
+                 chunk=100):
         """
         Calculate diffusivity from trajectory
         :param traj: unwrapped trajectory (i.e. gmx trjconv with -pbc nojump)
@@ -115,16 +79,15 @@ class Diffusivity(object):
         :param atoms: if specified, group of atoms whose center of mass MSD will be measured
         :param restrict: restrict selection to certain indices. For example, if you want to calculate MSD of a certain
         residue, but only include a fraction of the total residues in the system.
+        :param chunk: number of trajectory frames read into memory at once
         """
 
         self.script_location = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
         self.top_location = "%s/../top/topologies" % self.script_location
 
-        print('Loading trajectory...', end='', flush=True)
-        t = md.load(traj, top=gro)[begin:]  # load trajectory
-        print('Done!')
-        self.nT = t.n_frames  # number of frames
-        self.time = t.time  # time stamp on each frame
+        source = trajectory.Source(traj, gro, begin=begin, end=None, chunk=chunk)  # frames are streamed from disk
+        self.nT = source.n_frames  # number of frames
+        self.time = None  # time stamp on each frame
         self.MSD = None
         self.limits = None
         self.MSD_average = 0
@@ -148,9 +111,9 @@ class Diffusivity(object):
             self.itp = "%s/%s.itp" % (self.top_location, res)
 
             if restrict:
-                selection = [a.index for a in t.topology.atoms if a.residue.name == res and a.index in restrict]
+                selection = [a.index for a in source.topology.atoms if a.residue.name == res and a.index in restrict]
             else:
-                selection = [a.index for a in t.topology.atoms if a.residue.name == res]
+                selection = [a.index for a in source.topology.atoms if a.residue.name == res]
 
             topology = top.Top(self.itp)  # read topology
             atoms_per_residue = topology.natoms  # number atoms in a single residue
@@ -159,7 +122,7 @@ class Diffusivity(object):
 
         elif atoms:
 
-            selection = [a.index for a in t.topology.atoms if a.name in atoms]
+            selection = [a.index for a in source.topology.atoms if a.name in atoms]
 
             atoms_per_residue = len(atoms)
             matoms = np.array([Atom_props.mass[x] for x in atoms])
@@ -168,8 +131,6 @@ class Diffusivity(object):
             print('Error: No valid group of atoms or residues selected')
             exit()
 
-        pos = t.xyz[:, selection, :]
-
         self.axis = []
         if 'x' in axis:
             self.axis.append(0)
@@ -178,20 +139,19 @@ class Diffusivity(object):
         if 'z' in axis:
             self.axis.append(2)
 
-        print('Calculating center of mass of residues...', end='', flush=True)
-        self.com = np.zeros([self.nT, pos.shape[1] // atoms_per_residue, 3])  # track the center of mass of each residue
+        print('Calculating center of mass of residues...')
 
-        for f in range(self.nT):
-            for i in range(self.com.shape[1]):
-                w = (pos[f, i * atoms_per_residue:(i + 1) * atoms_per_residue, :].T * matoms).T  # weight each atom in the residue by its mass
-                self.com[f, i, :] = np.sum(w, axis=0) / self.mres  # sum the coordinates and divide by the mass of the residue
-        print('Done!')
+        def com(block):  # only the selected atoms are read from disk
+
+            return physical.center_of_mass(block.xyz, matoms), block.time
+
+        self.com, self.time = source.gather(com, atom_indices=selection, progress=True)
 
         self.weights = True
         if self.com.shape[1] == 1:
             self.weights = False
 
-        self.dt = t.time[-1] - t.time[-2]  # time step (assuming equispaced time points)
+        self.dt = self.time[-1] - self.time[-2]  # time step (assuming equispaced time points)
 
     def calculate(self):
 
@@ -240,9 +200,7 @@ class Diffusivity(object):
 
         for b in range(N):
             indices = np.random.randint(0, self.com.shape[1], self.com.shape[1])  # randomly choose particles with replacement
-            for n in range(self.com.shape[1]):
-                eMSDs[:, b] += self.MSD[:, indices[n]]  # add the MSDs of a randomly selected particle
-            eMSDs[:, b] /= self.com.shape[1]  # Divide every timestep by Nparticles -- average the MSDs
+            eMSDs[:, b] = self.MSD[:, indices].mean(axis=1)  # average the MSDs of the randomly selected particles
 
         self.limits = np.zeros([2, self.nT], dtype=float)  # upper and lower bounds at each point along MSD curve
         # determine a 95 % error bound for each tau (out of n MSD's, use that for the error bars)
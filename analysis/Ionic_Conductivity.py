@@ -8,7 +8,7 @@ from builtins import range
 from past.utils import old_div
 import argparse
 from llcsim.analysis import Atom_props, Diffusivity, Poly_fit
-from llcsim.llclib import physical
+from llcsim.llclib import physical, trajectory, bootstrap, timeseries
 import matplotlib.pyplot as plt
 import time
 import numpy as np
@@ -99,6 +99,7 @@ def initialize():
                                                                       'current measurements will be made')
     parser.add_argument('-T', '--temp', default=300, type=float, help='System Temperature, Kelvin')
     parser.add_argument('-B', '--nboot', default=200, type=int, help='Number of bootstrap trials to be run')
+    parser.add_argument('--seed', type=int, help='Random seed used for bootstrapping')
     parser.add_argument('-m', '--nMC', default=1000, help='Number of Monte Carlo trials to estimate error in D and Dq')
     parser.add_argument('-S', '--suffix', default='saved',
                         help='Suffix to append to position and id arrays when saving')
@@ -117,6 +118,7 @@ def initialize():
     parser.add_argument('-begin', default=0, type=int, help='Frame to begin using data')
     parser.add_argument('--noshow', action="store_true", help='Specify this to not show any plots')
     parser.add_argument('-a', '--axis', default='xyz', type=str, help='Which axis to compute msd along')
+    parser.add_argument('-chunk', '--chunk', default=100, type=int, help='Number of frames read into memory at once')
 
     args = parser.parse_args()
 
@@ -139,29 +141,31 @@ def nernst_einstein(D, D_std, C, C_std, T):
     return NE_av, NE_error
 
 
+def channel_displacement(z, zmax, zmin):
+    """
+    Displacement of each particle within the channel between consecutive frames. Positions outside of the channel are
+    clamped to its boundaries, so a particle entering or leaving the channel only contributes the part of its step
+    taken inside. A particle that was on opposite sides of the channel in consecutive frames (i.e. it was wrapped
+    across the periodic boundary) contributes nothing
+    :param z: trajectory of positions [nframes, npoints]  --> z-direction only
+    :param zmax: upper boundary of the channel
+    :param zmin: lower boundary of the channel
+    :return: displacements [nframes - 1, npoints]
+    """
+
+    clamped = np.clip(z, zmin, zmax)
+    inside = (z >= zmin) & (z <= zmax)
+
+    return np.where(inside[1:] | inside[:-1], clamped[1:] - clamped[:-1], 0)
+
+
 def dQ(frame, positions, channel_length, zmax, zmin, charges, id):
 
-    q = 0
-
-    for i in range(positions.shape[1]):  # find out how far each ion has moved in the z direction this frame
-        curr = positions[frame, i, 2]  # current z position
-        prev = positions[frame - 1, i, 2]  # previous z position
-        if zmin <= curr <= zmax:  # check that the ion is in the channel over which we are measuring
-            current_frame = curr  # If it, that is its position at the current frame
-        elif curr > zmax:  # If the particle is above zmax, we are still potentially interested in it
-            current_frame = zmax
-        elif curr < zmin:  # If the particle is below zmin, we are still potentially interested in it
-            current_frame = zmin
-        if zmin <= prev <= zmax:  # Do the same checks on the particle from the previous frame
-            prev_frame = prev
-        elif prev > zmax:
-            prev_frame = zmax
-        elif prev < zmin:
-            prev_frame = zmin
-        displacement = current_frame - prev_frame
-        q += e * (charges[id[i]]) * displacement / channel_length
+    clamped = np.clip(positions[frame - 1:frame + 1, :, 2], zmin, zmax)  # find out how far each ion has moved in z
+    displacement = clamped[1] - clamped[0]
+    weights = np.array([charges[name] for name in id[:positions.shape[1]]])
 
-    return q
+    return e * np.dot(displacement, weights) / channel_length
 
 
 def dQ2(z, zmax, zmin, charges, id):
@@ -170,25 +174,11 @@ def dQ2(z, zmax, zmin, charges, id):
     :param z: trajectory of positions [nframes, npoints, 1]  --> z-direction only
     :return: a trajectory n(t) describing the delta n at each time step
     """
-    q = np.zeros(z.shape[0])
 
-    for t in tqdm.tqdm(range(1, q.shape[0])):
-        for i in range(z.shape[1]):
-            current = z[t, i]
-            previous = z[t - 1, i]
-            if zmax >= current >= zmin:
-                if zmax >= previous >= zmin:
-                    q[t] += (current - previous)*charges[id[i]]
-                elif previous > zmax:
-                    q[t] += (current - zmax)*charges[id[i]]
-                elif previous < zmin:
-                    q[t] += (current - zmin)*charges[id[i]]
-            elif current > zmax:
-                if zmax >= previous >= zmin:
-                    q[t] += (zmax - previous)*charges[id[i]]
-            elif current < zmin:
-                if zmax >= previous >= zmin:
-                    q[t] += (zmin - previous)*charges[id[i]]
+    weights = np.array([charges[name] for name in id[:z.shape[1]]])
+
+    q = np.zeros(z.shape[0])
+    q[1:] = channel_displacement(z, zmax, zmin) @ weights
 
     q *= (e / (zmax - zmin))
 
@@ -217,12 +207,13 @@ if __name__ == '__main__':
     if 'z' in args.axis:
         ndx.append(2)
 
-    t = md.load(args.traj, top=args.gro)[args.begin:]
+    # stream the trajectory from disk. Only the ions are held in memory for all frames
+    source = trajectory.Source(args.traj, args.gro, begin=args.begin, end=None, chunk=args.chunk)
 
-    keep = [a.index for a in t.topology.atoms if a.name == args.ion]
+    keep = [a.index for a in source.topology.atoms if a.name == args.ion]
 
-    pos = t.xyz
-    pos_ion = t.xyz[:, keep, :]
+    t = md.join(list(source.blocks(atom_indices=keep)))  # trajectory of ions only
+    pos_ion = t.xyz
     time = t.time
 
     C, C_std, cross, Lc, z_2, z_1 = physical.conc(t, args.ion, args.buffer)
@@ -230,12 +221,12 @@ if __name__ == '__main__':
     factor = 1 * 10 ** 9  # number of nm in a m
     conv = old_div((old_div(Lc, factor)), (old_div(cross, (factor ** 2))))
 
-    no_comp = pos.shape[1]  # np.shape(pos)[1]
-    nT = t.n_frames  # np.shape(pos)[0]
+    no_comp = source.topology.n_atoms
+    nT = source.n_frames
 
     dt = t.timestep  # time[1] - time[0]
 
-    id = np.array([a.name for a in t.topology.atoms])
+    id = np.array([a.name for a in source.topology.atoms])
 
     if args.method == 'NE' or args.method == 'B':
 
@@ -243,7 +234,8 @@ if __name__ == '__main__':
 
         print('Calculating Diffusivity')
 
-        D = Diffusivity.Diffusivity(args.traj, args.gro, args.axis, atoms=[args.ion], begin=args.begin)
+        D = Diffusivity.Diffusivity(args.traj, args.gro, args.axis, atoms=[args.ion], begin=args.begin,
+                                    chunk=args.chunk)
         D.calculate()
         D.ensure_fit()
         D.bootstrap(args.nboot)
@@ -265,7 +257,18 @@ if __name__ == '__main__':
         # dq_all = np.zeros([nT - 1])
         # for i in tqdm.tqdm(range(nT - 1)):
         #     dq_all[i] = dQ(i + 1, pos, Lc, z_2, z_1, charge, id)
-        dq_all = dQ2(pos[:, :, 2], z_2, z_1, charge, id)
+        # charge displacement is calculated block by block. The last frame of each block is carried over so that the
+        # displacement across block boundaries is included
+        dq_all = []
+        previous = None
+        for block in source.blocks():
+            z = block.xyz[:, :, 2]
+            if previous is None:
+                dq_all.append(dQ2(z, z_2, z_1, charge, id))
+            else:
+                dq_all.append(dQ2(np.concatenate((previous, z)), z_2, z_1, charge, id)[1:])
+            previous = z[-1:, :]
+        dq_all = np.concatenate(dq_all)
 
         np.save('dq_%s' % args.suffix, dq_all)
         print('q saved')
@@ -289,31 +292,13 @@ if __name__ == '__main__':
     l_sub = dt * nT_sub / 1000  # ns in the subinterval
 
     # Break dq_all into sub-trajectories
-    dq = np.zeros([n_sub, nT_sub])
-    for i in range(n_sub):
-        dq[i, :] = dq_all[i * nT_sub + discarded_frames: (i + 1) * nT_sub + discarded_frames]
+    dq = dq_all[discarded_frames:discarded_frames + n_sub * nT_sub].reshape(n_sub, nT_sub)
 
     # cumulate q in each time interval
-    dq_cum = np.zeros([n_sub, nT_sub])
-    dq_cum[:, 0] = dq[:, 0]
-    for i in range(nT_sub):
-        dq_cum[:, i] = dq[:, i] + dq_cum[:, i - 1]
-
-    msd = np.zeros([n_sub, nT_sub])
-    itau = 0  # counts up to the number of trajectory frames
-    while itau < nT_sub:
-        ncount = (nT_sub - itau)
-        for t in range(nT_sub - itau):  # run for total number of time points from itau to nT
-            for i in range(n_sub):
-                xo = dq_cum[i, t + itau] - dq_cum[i, t]
-                msd[i, itau] += np.dot(xo, xo)  # Should there be a division by 't' in here?
-        msd[:, itau] /= ncount
-        itau += 1
-
-    avg_std = np.zeros([2, nT_sub])
-    for i in range(nT_sub):
-        avg_std[0, i] = np.mean(msd[:, i])
-        avg_std[1, i] = np.std(msd[:, i])
+    dq_cum = np.cumsum(dq, axis=1)
+
+    # time-averaged MSD of q in each sub-trajectory
+    msd = timeseries.msd_batch(dq_cum.T[:, :, np.newaxis], 0).T
 
     times = np.linspace(0, (nT_sub - 1) * dt, nT_sub)
 
@@ -363,16 +348,8 @@ if __name__ == '__main__':
     ic_cds = slopes * ((1 * 10 ** 12) * conv / (2 * kb * float(args.temp)))
 
     # Bootstrap the slopes
-    from random import randint
-
     nboot = 200000
-    means = np.zeros([nboot])
-    for i in range(nboot):
-        sum = 0
-        for j in range(n_sub):
-            index = randint(0, n_sub - 1)
-            sum += slopes[index]
-        means[i] = old_div(sum, n_sub)
+    means = bootstrap.means(slopes, nboot, seed=args.seed)
     means *= old_div(((1 * 10 ** 12) * conv), (2 * kb * float(args.temp)))
     bootstrap_mean = np.mean(means)
     bootstrap_std = np.std(means)
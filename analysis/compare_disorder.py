@@ -199,8 +199,8 @@ if __name__ == "__main__":
     theta = np.zeros_like(z)
 
     for i in range(len(independent_trajectories)):
-        z[i, :] = independent_trajectories[i].z_values[-1, :]  # value at last frame for each center of mass
-        r[i, :] = independent_trajectories[i].r_values[-1, :]  # value at last frame for each center of mass
+        z[i, :] = independent_trajectories[i].z_values[-1, ...].flatten()  # value at last frame for each center of mass
+        r[i, :] = independent_trajectories[i].r_values[-1, ...].flatten()  # value at last frame for each center of mass
         theta[i, :] = independent_trajectories[i].theta_values[-1, ...].flatten()  # value at last frame for each center of mass
 
     N = len(independent_trajectories)
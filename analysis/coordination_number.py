@@ -2,12 +2,9 @@
 
 import argparse
 import numpy as np
-import mdtraj as md
-from llcsim.llclib import physical, topology, transform
+from llcsim.llclib import physical, topology, transform, trajectory, neighbors
 import sys
-import tqdm
-from scipy.sparse import lil_matrix
-import pickle
+from scipy.sparse import csr_matrix
 import matplotlib.pyplot as plt
 
 
@@ -22,6 +19,7 @@ def initialize():
     parser.add_argument('-b', '--begin', default=0, type=int, help='Start frame')
     parser.add_argument('-e', '--end', default=-1, type=int, help='Last frame')
     parser.add_argument('-skip', default=1, type=int, help='Include every skip frames in calculation')
+    parser.add_argument('-chunk', default=100, type=int, help='Number of frames read into memory at once')
 
     # atom selection
     parser.add_argument('-r', '--residue', default=None, help='Residue to calculate coordination number with respect '
@@ -39,10 +37,10 @@ def initialize():
                                                               'coordinated')
 
     # saving options
-    parser.add_argument('-s', '--savename', default='coordination.pl', help='Name under which to save distance '
-                                                                                 'array')
-    parser.add_argument('-l', '--load', action="store_true", help='Load distance array saved with name '
-                                                                             'passed to save_distances option.')
+    parser.add_argument('-s', '--savename', default='coordination.npz', help='Name of compressed .npz file under '
+                        'which to save coordinated pairs')
+    parser.add_argument('-l', '--load', action="store_true", help='Load coordinated pairs saved with name passed to '
+                                                                  'savename option.')
 
     parser.add_argument('-bins', nargs='+', default=100, type=int, help='Integer or array of bin values. If more than'
                         'one value is used, order the inputs according to the order given in args.axis')
@@ -50,30 +48,154 @@ def initialize():
     return parser
 
 
+class Contacts(object):
+
+    def __init__(self, offsets, centers, coordinated, distances, shape):
+        """ Compact storage of coordinated pairs at every frame of a trajectory. Pairs of all frames are stored end to
+        end in flat arrays, sorted by center then coordinated index within each frame. The pairs of frame t are entries
+        offsets[t]:offsets[t + 1] of each array
+
+        :param offsets: index of the first pair of each frame, followed by the total number of pairs (n_frames + 1)
+        :param centers: index of the center (atom or group whose coordination number is measured) of each pair
+        :param coordinated: index of the coordinated atom or group of each pair
+        :param distances: minimum image distance between the members of each pair
+        :param shape: number of centers and number of coordinated atoms or groups
+
+        :type offsets: numpy.ndarray
+        :type centers: numpy.ndarray
+        :type coordinated: numpy.ndarray
+        :type distances: numpy.ndarray
+        :type shape: tuple
+        """
+
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.centers = np.asarray(centers, dtype=np.int32)
+        self.coordinated = np.asarray(coordinated, dtype=np.int32)
+        self.distances = np.asarray(distances, dtype=np.float32)
+        self.shape = tuple(int(n) for n in shape)
+
+        self.n_frames = self.offsets.size - 1
+
+    def __len__(self):
+
+        return self.n_frames
+
+    def __getitem__(self, t):
+        """ Sparse (n_centers, n_coordinated) matrix of distances between coordinated pairs at frame t
+        """
+
+        t = range(self.n_frames)[t]  # negative frame indices count back from the end
+        s = slice(self.offsets[t], self.offsets[t + 1])
+
+        return csr_matrix((self.distances[s], (self.centers[s], self.coordinated[s])), shape=self.shape)
+
+    def counts(self):
+        """ Number of coordinated pairs at each frame
+        """
+
+        return np.diff(self.offsets)
+
+    def frames(self):
+        """ Frame that each pair belongs to
+        """
+
+        return np.repeat(np.arange(self.n_frames), self.counts())
+
+    def neighbors(self, t, i):
+        """ Indices of the atoms or groups coordinated to center i at frame t
+        """
+
+        t = range(self.n_frames)[t]  # negative frame indices count back from the end
+        s = slice(self.offsets[t], self.offsets[t + 1])
+        centers = self.centers[s]
+
+        return self.coordinated[s][np.searchsorted(centers, i, side='left'):np.searchsorted(centers, i, side='right')]
+
+    def coordination_number(self, codes=None, ncodes=None):
+        """ Coordination number of each center at each frame, optionally broken down by the type of the coordinated
+        atoms or groups
+
+        :param codes: integer type code of each coordinated atom or group. Pairs whose code is negative are not counted
+        :param ncodes: number of type codes. Defaults to codes.max() + 1
+
+        :type codes: numpy.ndarray
+        :type ncodes: int
+
+        :return: coordination numbers (n_frames, n_centers), or (ncodes, n_frames, n_centers) if codes are given
+        """
+
+        n = self.shape[0]
+        index = self.frames() * n + self.centers  # flat index into (n_frames, n_centers)
+
+        if codes is None:
+
+            return np.bincount(index, minlength=self.n_frames * n).reshape(self.n_frames, n)
+
+        else:
+
+            codes = np.asarray(codes)
+            if ncodes is None:
+                ncodes = codes.max() + 1 if codes.size > 0 else 0
+
+            pair_codes = codes[self.coordinated]
+            counted = pair_codes >= 0
+
+            index = pair_codes[counted] * self.n_frames * n + index[counted]
+
+            return np.bincount(index, minlength=ncodes * self.n_frames * n).reshape(ncodes, self.n_frames, n)
+
+
 class System(object):
 
     def __init__(self, traj, gro, atoms=None, coordinated_atoms=None, residue=None, coordinated_residue=None, type=None,
-                 ctype=None, begin=0, end=-1, skip=1):
-
-        print("Loading trajectory...", end='', flush=True)
-        self.t = md.load(traj, top=gro)[begin:end:skip]
-        print("Done!")
+                 ctype=None, begin=0, end=-1, skip=1, chunk=100):
 
-        self.time = self.t.time / 1000  # time in nanoseconds
+        self.source = trajectory.Source(traj, gro, begin=begin, end=end, skip=skip, chunk=chunk)
+        self.topology = self.source.topology
+        self.n_frames = self.source.n_frames
 
         # get locations of atoms of interest and coordinating atoms
         # calculate centers of mass for certain groups. Decision-making in this regard is made in self.narrow_atoms()
-        self.com, self.com_map = self.narrow_atoms(atoms, residue, type)
-        self.com_coordinated, self.com_coordinated_map = self.narrow_atoms(coordinated_atoms, coordinated_residue,
-                                                                           ctype, coordination=True)
+        indices, mass, self.com_map = self.narrow_atoms(atoms, residue, type)
+        cindices, cmass, self.com_coordinated_map = self.narrow_atoms(coordinated_atoms, coordinated_residue, ctype,
+                                                                      coordination=True)
+
+        # only read the atoms that are needed from disk
+        selection = np.union1d(indices, cindices).astype(int)
+        ndx = np.searchsorted(selection, indices)
+        cndx = np.searchsorted(selection, cindices)
+
+        def positions(block):
+
+            pos = block.xyz[:, ndx, :]
+            cpos = block.xyz[:, cndx, :]
+
+            if mass is not None:
+                pos = physical.center_of_mass(pos, mass)
+            if cmass is not None:
+                cpos = physical.center_of_mass(cpos, cmass)
+
+            return pos, cpos, block.unitcell_vectors, block.time
+
+        print("Reading trajectory...")
+        self.com, self.com_coordinated, self.box, time = self.source.gather(positions, atom_indices=selection,
+                                                                            progress=True)
+
+        self.time = time / 1000  # time in nanoseconds
 
         # relate indices to
-        self.names = [a.name for a in self.t.topology.atoms]
-        self.residues = [a.residue.name for a in self.t.topology.atoms]
+        self.names = [a.name for a in self.topology.atoms]
+        self.residues = [a.residue.name for a in self.topology.atoms]
 
-        self.distances = None
+        self.contacts = None
 
     def narrow_atoms(self, atoms, residue, type, coordination=False):
+        """ Decide which atoms to track. Either the positions of individual atoms or the centers of mass of groups of
+        atoms are used
+
+        :return: indices of atoms to read, masses of the atoms in each group if centers of mass should be calculated
+        (None if atom positions are used directly) and a map of group number to atom indices
+        """
 
         if atoms is not None or type is not None:
 
@@ -81,17 +203,17 @@ class System(object):
 
                 if type is not None:
                     # get names of all atoms with the appropriate type
-                    atoms = set([a.name for a in self.t.topology.atoms if a.element.symbol == type])
+                    atoms = set([a.name for a in self.topology.atoms if a.element.symbol == type])
 
                 # get indices of all atoms in the system that make up the atoms list
-                atom_indices = [a.index for a in self.t.topology.atoms if a.residue.name == residue and
+                atom_indices = [a.index for a in self.topology.atoms if a.residue.name == residue and
                                 a.name in atoms]
 
                 if type is not None:
                     # if a residue is specified with an atom type, assume you want the locations of each atom of that
                     # type within each residue.
 
-                    return self.t.xyz[:, atom_indices, :], topology.map_atoms(atom_indices)
+                    return atom_indices, None, topology.map_atoms(atom_indices)
 
                 else:
                     # If a residue is specified with atoms, assume that the user wants to isolate calculations to the
@@ -101,32 +223,30 @@ class System(object):
                     atom_mass = [residue.mass[v] for v in residue.mass.keys() if
                                  v in atoms]  # mass of atoms of interest
 
-                    return physical.center_of_mass(self.t.xyz[:, atom_indices, :], atom_mass), \
-                           topology.map_atoms(atom_indices, len(atom_mass))
+                    return atom_indices, atom_mass, topology.map_atoms(atom_indices, len(atom_mass))
 
             else:
 
                 if type is not None:
                     # get indices of any atoms whose element = type
-                    atom_indices = [a.index for a in self.t.topology.atoms if a.element.symbol == type]
+                    atom_indices = [a.index for a in self.topology.atoms if a.element.symbol == type]
 
                 else:
                     # get indices of any atoms in the "atoms" list
-                    atom_indices = [a.index for a in self.t.topology.atoms if a.name in atoms]
+                    atom_indices = [a.index for a in self.topology.atoms if a.name in atoms]
 
-                return self.t.xyz[:, atom_indices, :], topology.map_atoms(atom_indices)
+                return atom_indices, None, topology.map_atoms(atom_indices)
 
         else:
 
             if residue is not None:
                 # calculate the center of mass of the residue based on all atoms
                 # First get indices of all atoms in the residue
-                atom_indices = [a.index for a in self.t.topology.atoms if a.residue.name == residue]
+                atom_indices = [a.index for a in self.topology.atoms if a.residue.name == residue]
                 res = topology.Residue(residue)
                 atom_mass = [v for v in res.mass.values()]  # mass of each atom in an individual residue
 
-                return physical.center_of_mass(self.t.xyz[:, atom_indices, :], atom_mass), \
-                       topology.map_atoms(atom_indices, len(atom_mass))
+                return atom_indices, atom_mass, topology.map_atoms(atom_indices, len(atom_mass))
 
             else:
                 # if you forget a flag, exit the program with a descriptive error
@@ -146,18 +266,84 @@ class System(object):
         :return:
         """
 
-        # initialize array to hold all pairwise distances
-        self.distances = np.zeros([self.t.n_frames], dtype=object)
-
         print('Calculating minimum image distances!')
-        for t in tqdm.tqdm(range(self.distances.shape[0])):
-            self.distances[t] = lil_matrix((self.com.shape[1], self.com_coordinated.shape[1]))  # sparse matrices are 2D
-            for i in range(self.com.shape[1]):
-                xyz_distances = self.com_coordinated[t, ...] - self.com[t, i, :]
-                min_distances = physical.minimum_image_distance(xyz_distances, self.t.unitcell_vectors[t, ...])
-                euclidean_dist = np.linalg.norm(min_distances, axis=1)
-                under_cut = np.where(euclidean_dist < cut)[0]
-                self.distances[t][i, under_cut] = euclidean_dist[under_cut]
+        # only pairs within the cutoff are ever found, so memory scales with the number of neighbors
+        pairs = neighbors.pair_lists(self.com, self.box, cut, y=self.com_coordinated, progress=True)
+
+        # when the centers and coordinated atoms overlap, an atom or group is found at zero distance from itself. Those
+        # are not coordinated pairs
+        pairs = [(i[d > 0], j[d > 0], d[d > 0]) for i, j, d in pairs]
+
+        offsets = np.zeros([self.n_frames + 1], dtype=np.int64)
+        offsets[1:] = np.cumsum([p[0].size for p in pairs])
+
+        i, j, d = [np.concatenate([p[k] for p in pairs]) for k in range(3)]
+
+        self.contacts = Contacts(offsets, i, j, d, (self.com.shape[1], self.com_coordinated.shape[1]))
+
+    def group_codes(self, atom_groups, res=None):
+        """ Assign each coordinated atom or group to the first atom group that contains its (first) atom
+
+        :param atom_groups: a list of lists of atom names
+        :param res: residue name of each atom group. If given, an atom must also belong to that residue
+
+        :type atom_groups: list
+        :type res: list
+
+        :return: index of atom group of each coordinated atom or group, -1 if it belongs to none of them
+        """
+
+        first = [self.com_coordinated_map[j][0] for j in range(len(self.com_coordinated_map))]
+        names = np.array([self.names[a] for a in first])
+        residues = np.array([self.residues[a] for a in first])
+
+        codes = np.full(len(first), -1, dtype=int)
+        for g in reversed(range(len(atom_groups))):  # earlier groups take precedence
+            match = np.isin(names, atom_groups[g])
+            if res is not None:
+                match &= (residues == res[g])
+            codes[match] = g
+
+        return codes
+
+    def save(self, name='coordination.npz'):
+        """ Write coordinated pairs and everything needed to plot them to a compressed .npz file
+
+        :param name: name of output file
+
+        :type name: str
+        """
+
+        np.savez_compressed(name, offsets=self.contacts.offsets, centers=self.contacts.centers,
+                            coordinated=self.contacts.coordinated, distances=self.contacts.distances,
+                            shape=np.array(self.contacts.shape), time=self.time, names=np.array(self.names),
+                            residues=np.array(self.residues), com_map=np.array(list(self.com_map.values())),
+                            com_coordinated_map=np.array(list(self.com_coordinated_map.values())))
+
+    @classmethod
+    def load(cls, name):
+        """ Read a system written by save(). Only what is needed to re-plot coordination numbers is restored
+
+        :param name: name of .npz file
+
+        :type name: str
+
+        :return: System object
+        """
+
+        system = cls.__new__(cls)
+
+        with np.load(name) as f:
+            system.contacts = Contacts(f['offsets'], f['centers'], f['coordinated'], f['distances'], f['shape'])
+            system.time = f['time']
+            system.names = f['names'].tolist()
+            system.residues = f['residues'].tolist()
+            system.com_map = {i: list(a) for i, a in enumerate(f['com_map'])}
+            system.com_coordinated_map = {i: list(a) for i, a in enumerate(f['com_coordinated_map'])}
+
+        system.n_frames = system.contacts.n_frames
+
+        return system
 
     def plot(self, res=None, atom_groups=None):
         """ Plot number of atoms coordinated to residue vs. time
@@ -176,49 +362,9 @@ class System(object):
 
         if atom_groups is not None:
 
-            ncoord = np.zeros([len(atom_groups), self.t.n_frames, self.com.shape[1]])
-
-            if res is not None:
-
-                print('Organizing atoms based on atom type and residue name...')
-                for t in tqdm.tqdm(range(self.t.n_frames)):
-                    for i in range(ncoord.shape[2]):
-                        atom_types = [self.names[self.com_coordinated_map[j][0]] for j in
-                                      np.nonzero(self.distances[t][i, :])[1]]  # residue name
-                        residues = [self.residues[self.com_coordinated_map[j][0]] for j in
-                                    np.nonzero(self.distances[t][i, :])[1]]
-
-                        grp = []
-                        for ndx, k in enumerate(atom_types):
-                            atoms = np.array([a.count(k) for a in atom_groups])
-                            resi = np.array([a.count(residues[ndx]) for a in res])
-                            try:
-                                grp.append(np.where(atoms + resi == 2)[0][0])
-                            except IndexError:
-                                pass
-
-                        for g in grp:
-                            ncoord[g, t, i] += 1
-
-            else:
-
-                print('Organizing atoms based on atom type...')
-                for t in tqdm.tqdm(range(self.t.n_frames)):
-                    for i in range(ncoord.shape[2]):
-                        atom_types = [self.names[self.com_coordinated_map[j][0]] for j in
-                                      np.nonzero(self.distances[t][i, :])[1]]  # residue name
-
-                        grp = []
-                        for ndx, k in enumerate(atom_types):
-                            atoms = [a.count(k) for a in atom_groups]
-
-                            try:
-                                grp.append(atoms.index(1))
-                            except IndexError:
-                                pass
-
-                        for g in grp:
-                            ncoord[g, t, i] += 1
+            print('Organizing atoms based on atom type%s...' % (' and residue name' if res is not None else ''))
+            codes = self.group_codes(atom_groups, res=res)
+            ncoord = self.contacts.coordination_number(codes, ncodes=len(atom_groups))
 
             # for i in range(ncoord.shape[0]):
             #
@@ -234,10 +380,7 @@ class System(object):
             #plt.legend()
 
         else:
-            ncoord = np.zeros([self.t.n_frames, self.com.shape[1]])
-
-            for i in range(ncoord.shape[1]):
-                ncoord[:, i] = [len(np.nonzero(self.distances[t][i, :])[1]) for t in range(self.t.n_frames)]
+            ncoord = self.contacts.coordination_number()
 
             plt.plot(self.time, ncoord.mean(axis=1))
 
@@ -256,20 +399,19 @@ if __name__ == "__main__":
 
         system = System(args.traj, args.gro, atoms=args.atoms, coordinated_atoms=args.coordinated_atoms,
                         residue=args.residue, coordinated_residue=args.coordinated_residue, type=args.type,
-                        ctype=args.coordinated_type, begin=args.begin, end=args.end, skip=args.skip)
+                        ctype=args.coordinated_type, begin=args.begin, end=args.end, skip=args.skip, chunk=args.chunk)
 
         system.distance_search(cut=args.cut)  # calculate pairwise distance between all points in self.com and self.com_coordinated
 
-        with open(args.savename, 'wb') as f:
-            pickle.dump(system, f)
+        system.save(args.savename)
 
     else:
-        print('Loading pickled object!...', end='', flush=True)
-        system = pickle.load(open(args.savename, "rb"))
+        print('Loading coordinated pairs!...', end='', flush=True)
+        system = System.load(args.savename)
         print('Done!')
 
     #system.plot(res=['HII', 'HII', 'HOH'], atom_groups=[['O3', 'O4'], ['O', 'O1', 'O2'], ['O']])
     system.plot()
 
-    for i in np.nonzero(system.distances[-1][0, :])[1]:
+    for i in system.contacts.neighbors(-1, 0):
         print('%s -- %s' % (system.com_map[0], system.com_coordinated_map[i]))
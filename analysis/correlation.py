@@ -7,10 +7,10 @@ from llcsim.analysis import Atom_props, detect_peaks
 import tqdm
 import matplotlib.pyplot as plt
 from matplotlib import ticker
-from llcsim.llclib import fast_rotate
+from llcsim.llclib import physical, transform, neighbors
 from llcsim.setup.place_solutes import trace_pores
 from scipy.optimize import curve_fit
-from scipy.interpolate import RegularGridInterpolator
+from scipy.spatial import cKDTree
 
 
 def initialize():
@@ -63,55 +63,107 @@ def com(pos, mass):
     :return: trajectory of center of mass coordinates
     """
 
-    ngrps = len(mass)
     n = [len(i) for i in mass]
-    ndx = [sum(n[:i]) for i in range(len(n))]
-
     nmon = pos.shape[1] // sum(n)  # number of monomers
-    centers = np.zeros([pos.shape[0], nmon*ngrps, 3])  # total number of center of masses
 
-    for f in range(pos.shape[0]):
-        for i in range(nmon):
-            for g in range(ngrps):
-                w = (pos[f, i*sum(n) + ndx[g]:i*sum(n) + ndx[g] + n[g], :].T * mass[g]).T
-                centers[f, ngrps*i + g, :] = np.sum(w, axis=0) / sum(mass[g])
+    offsets = physical.group_offsets(n, nrepeats=nmon)
+    mass_atoms = np.tile(np.concatenate(mass), nmon)
+
+    return physical.center_of_mass(pos, mass_atoms, offsets=offsets)
+
 
-    return centers
+def local_frame_rotations(v):
+    """ Rotation matrices about z that make each vector point along +x. The angle and its sign are chosen exactly as
+    fast_rotate.rotate_vector(xyz, v, [1, 0, 0]) chooses them
 
+    :param v: vectors (n, 3)
 
-def duplicate_periodically(pts, box):
+    :type v: numpy.ndarray
+
+    :return: rotation matrices (n, 3, 3)
     """
-    Duplicate points periodically in the +/- xyz directions. Assumes y box vector is angled with respect to x and
-    the z vector points straight up
-    :param pts: pts to be duplicated
-    :param box: unitcell vectors in mdtraj format (use t.unitcell_vectors)
-    :return: periodically extended system
+
+    theta = np.arccos(v[:, 0] / np.linalg.norm(v, axis=1))
+    theta = np.where((v[:, 1] > 0) & (v[:, 0] != 0), -theta, theta)  # points in quadrant I or II rotate clockwise
+
+    R = np.zeros([v.shape[0], 3, 3])
+    R[:, 0, 0] = np.cos(theta)
+    R[:, 1, 0] = np.sin(theta)
+    R[:, 0, 1] = -np.sin(theta)
+    R[:, 1, 1] = np.cos(theta)
+    R[:, 2, 2] = 1
+
+    return R
+
+
+def local_frame_histogram(pts, references, directions, bins, hist_range, box=None):
+    """ Histogram the positions of points relative to each of a set of reference points, in a frame rotated about z
+    so that the direction associated with each reference point (e.g. the vector from it to its pore center) points
+    along +x. Only points close enough to a reference point to land within the histogram range are found (with a
+    KD-tree) and rotated, and all of them are binned with a single bincount. Equivalent to, for each reference point,
+    rotating every point with fast_rotate.rotate_vector, translating the reference point to the origin and calling
+    np.histogramdd
+
+    :param pts: coordinates of all points (npts, 3)
+    :param references: indices of the points used as reference points (nref)
+    :param directions: vector defining the local frame of each reference point (nref, 3)
+    :param bins: number of bins in each dimension
+    :param hist_range: lower and upper bound of histogram in each dimension
+    :param box: box vectors (3, 3). If given, points are wrapped into the unit cell and only the periodic images of
+    points that can land in the histogram are generated (see neighbors.periodic_images). Otherwise pts are used as
+    given
+
+    :type pts: numpy.ndarray
+    :type references: numpy.ndarray
+    :type directions: numpy.ndarray
+    :type bins: numpy.ndarray
+    :type hist_range: list
+    :type box: numpy.ndarray
+
+    :return: histogram summed over all reference points and bin edges (as returned by np.histogramdd)
     """
 
-    nT = pts.shape[0]
-    npts = pts.shape[1]
-    p = np.zeros([nT, npts*27, 3])
+    bins = np.asarray(bins, dtype=int)
+    hist_range = np.asarray(hist_range, dtype=float)
+    edges = [np.linspace(hist_range[d, 0], hist_range[d, 1], bins[d] + 1) for d in range(3)]
 
-    p[:, :npts, :] = pts
+    # rotation about z preserves distances, so every point that can land in the histogram is within the distance of
+    # the farthest corner of the histogram range
+    cut = np.linalg.norm(np.abs(hist_range).max(axis=1))
 
-    for t in range(nT):
+    if box is not None:
+        pts = physical.wrap_box(np.asarray(pts, dtype=float), box)
+        images, origin, shifts = neighbors.periodic_images(pts, box, cut, shifts=True)
+    else:
+        images = pts
 
-        p[t, npts:2*npts, :] = pts[t, :, :] + box[t, 2, :]
-        p[t, 2*npts:3*npts, :] = pts[t, :, :] - box[t, 2, :]
+    references = np.asarray(references, dtype=int)
+    found = cKDTree(images).query_ball_point(pts[references], cut, return_sorted=False)
+    ref = np.repeat(np.arange(references.size), [len(n) for n in found])  # which reference point each pair belongs to
+    i = references[ref]
+    j = np.concatenate([np.asarray(n, dtype=int) for n in found])
 
-        for i in range(3, 6):
-            p[t, i*npts:(i+1)*npts, :] = p[t, (i-3)*npts:(i-2)*npts] + box[t, 0, :]
+    if box is not None:
+        # add the lattice translation separately so that a point's displacement from itself is exactly zero
+        displacement = pts[origin[j]] - pts[i] + np.matmul(shifts[j], box)
+    else:
+        displacement = pts[j] - pts[i]
 
-        for i in range(6, 9):
-            p[t, i*npts:(i+1)*npts, :] = p[t, (i-6)*npts:(i-5)*npts] - box[t, 0, :]
+    R = local_frame_rotations(directions)
+    local = np.einsum('nij,nj->ni', R[ref], displacement)
 
-        for i in range(9, 18):
-            p[t, i*npts:(i+1)*npts, :] = p[t, (i-9)*npts:(i-8)*npts] + box[t, 1, :]
+    # assign bins the way np.histogramdd does: bins are half-open except the last, which includes its right edge
+    index = np.zeros([local.shape[0], 3], dtype=int)
+    inside = np.ones(local.shape[0], dtype=bool)
+    for d in range(3):
+        index[:, d] = np.searchsorted(edges[d], local[:, d], side='right') - 1
+        index[local[:, d] == edges[d][-1], d] = bins[d] - 1
+        inside &= (index[:, d] >= 0) & (index[:, d] < bins[d])
 
-        for i in range(18, 27):
-            p[t, i*npts:(i+1)*npts, :] = p[t, (i-18)*npts:(i-17)*npts] - box[t, 1, :]
+    flat = np.ravel_multi_index(index[inside].T, bins)
+    H = np.bincount(flat, minlength=np.prod(bins)).reshape(bins).astype(float)
 
-    return p
+    return H, edges
 
 
 def sinusoidal_decay(x, a, b, c, d):
@@ -230,70 +282,15 @@ def autocorrelation(x, largest_prime=500):
     return auto / np.arange(n, 0, -1)
 
 
-def angle_average(X, Y, Z, SF, ucell=None, NBR=80, rmax=-1, zbins=-1, zmax=-1):
-
-    ES = RegularGridInterpolator((X, Y, Z), SF, bounds_error=False)
-
-    THETA_BINS_PER_INV_ANG = 20.
-    MIN_THETA_BINS = 10  # minimum allowed bins
-    RBINS = NBR
-
-    if ucell is not None:
+def angle_average(X, Y, Z, SF, ucell=None, NBR=80, rmax=-1, zbins=-1, zmax=-1, interpolate=False):
+    """ Average a 3D function about the z axis. See transform.angle_average for parameters. Empty bins are filled
+    with the smallest average and the result is normalized and mirrored about r = 0 for plotting
 
-        a1 = ucell[0]
-        a2 = ucell[1]
-        a3 = ucell[2]
-
-        b1 = (np.cross(a2, a3)) / (np.dot(a1, np.cross(a2, a3)))
-        b2 = (np.cross(a3, a1)) / (np.dot(a2, np.cross(a3, a1)))
-        b3 = (np.cross(a1, a2)) / (np.dot(a3, np.cross(a1, a2)))
-
-        b_inv = np.linalg.inv(np.vstack((b1, b2, b3)))
-
-    if zbins == -1:
-        ZBINS = Z.shape[0]  # 400
-    else:
-        ZBINS = zbins
-
-    if zmax == -1:
-        ZMAX = Z[-1]
-    else:
-        ZMAX = zmax
-
-    XR = (X[-1] - X[0])
-    YR = (Y[-1] - Y[0])
-
-    if rmax == -1:
-        Rmax = min(XR, YR) / 2.0
-        Rmax *= 0.95
-    else:
-        Rmax = rmax
-
-    rarr, rspace = np.linspace(0.0, Rmax, RBINS, retstep=True)
-    #zar = np.linspace(Z[0], Z[-1], ZBINS)
-    zar = np.linspace(-ZMAX, ZMAX, ZBINS)
-
-    oa = np.zeros((rarr.shape[0], zar.shape[0]))
-
-    circ = 2.*np.pi*rarr  # circumference
-
-    for ir in range(rarr.shape[0]):
-
-        NTHETABINS = max(int(THETA_BINS_PER_INV_ANG*circ[ir]), MIN_THETA_BINS)  #calculate number of bins at this r
-        thetas = np.linspace(0.0, np.pi*2.0, NTHETABINS, endpoint=False)  # generate theta array
-
-        t, r, z = np.meshgrid(thetas, rarr[ir], zar)  # generate grid of cylindrical points
-
-        xar = r*np.cos(t)  # set up x,y coords
-        yar = r*np.sin(t)
-
-        pts = np.vstack((xar.ravel(), yar.ravel(), z.ravel())).T  # reshape for interpolation
-
-        if ucell is not None:
-            # pts = mc_inv(pts, ucell)
-            pts = np.matmul(pts, b_inv)
+    :return: averaged function (2*NBR - 1, zbins), r values, z values (1, zbins)
+    """
 
-        oa[ir, :] = np.average(ES(pts).reshape(r.shape), axis=1)  # store average values in final array
+    oa, rarr, zar = transform.angle_average(X, Y, Z, SF, ucell=ucell, NBR=NBR, rmax=rmax, zbins=zbins, zmax=zmax,
+                                            interpolate=interpolate)
 
     mn = np.nanmin(oa)
     oa = np.where(np.isnan(oa), mn, oa)
@@ -304,7 +301,7 @@ def angle_average(X, Y, Z, SF, ucell=None, NBR=80, rmax=-1, zbins=-1, zmax=-1):
     # set up data for contourf plot by making it symmetrical
     final = np.append(oa[::-1, :], oa[1:], axis=0)  # SF
     rfin = np.append(-rarr[::-1], rarr[1:])  # R
-    zfin = np.append(z[:, 0, :], z[1:, 0, :], axis=0)  # Z
+    zfin = zar[np.newaxis, :]  # Z
 
     return final, rfin, zfin
 
@@ -448,13 +445,8 @@ if __name__ == "__main__":
 
         com_per_pore = int(center_of_mass.shape[1] / npores)
 
-        periodic_pts = duplicate_periodically(center_of_mass, t.unitcell_vectors)
-
         correlation = np.zeros(bins)
 
-        x = np.array([1, 0, 0])
-        xnorm = np.linalg.norm(x)
-
     if args.load:
 
         if len(args.slice) == 2:
@@ -471,22 +463,18 @@ if __name__ == "__main__":
         frames = t.n_frames
 
         if args.slice == 'xy' or args.slice == 'yx':
+
+            # index of each center of mass reference point and of the pore center (at its layer) it is rotated towards
+            p, l, a = np.meshgrid(np.arange(npores), np.arange(args.layers), np.arange(monomers_per_layer),
+                                  indexing='ij')
+            pt = (p*com_per_pore + l*monomers_per_layer + a).ravel()
+            center = (p*args.layers + l).ravel()
+
             for frame in tqdm.tqdm(range(frames), unit='Frame'):
-                for p in range(npores):
-                    for l in range(args.layers):
-                        for a in range(monomers_per_layer):
-
-                            pt = p*com_per_pore + l*monomers_per_layer + a  # index of center of mass reference point
-                            point = periodic_pts[frame, pt, :]  # coordinates of center of mass reference point
-                            v = pore_spline[frame, p*args.layers + l, :] - point  # vector from point to pore center
-                            rot = fast_rotate.rotate_vector(periodic_pts[frame, :, :], v, x)  # rotate all points by angle
-                            trans = rot - rot[pt, :]  # translate all point so reference point is at the origin
-                            H, edges = np.histogramdd(trans, bins=bins, range=hist_range)
-                            correlation += H
-                            # middle_x = bins[0] // 2
-                            # middle_y = bins[1] // 2
-                            # plt.plot(correlation[middle_x, middle_y, :])
-                            # plt.show()
+                v = pore_spline[frame, center, :] - center_of_mass[frame, pt, :]  # vector from point to pore center
+                H, edges = local_frame_histogram(center_of_mass[frame, ...], pt, v, bins, hist_range,
+                                                 box=t.unitcell_vectors[frame, ...])
+                correlation += H
 
         else:
             # for frame in tqdm.tqdm(range(frames), unit='Frame'):
@@ -4,7 +4,7 @@ import argparse
 import numpy as np
 import mdtraj as md
 import matplotlib.pyplot as plt
-from llcsim.llclib import file_rw, transform
+from llcsim.llclib import file_rw, transform, physical
 from llcsim.analysis import Structure_char, Atom_props
 from scipy.optimize import minimize
 import tqdm
@@ -39,16 +39,39 @@ def angular_deviation(pore, p_center, ideal):
     return angles - angles_ideal
 
 
-def minimize_deviation(ideal_pore, angle, com, p_center):
+def wrap_angle(theta):
+    """ Map angles onto the interval (-pi, pi]
 
-    ideal = transform.rotate_coords_z(ideal_pore, angle)  # rotate pore uniformly by some angle
+    :param theta: angles (radians)
 
-    return np.linalg.norm(angular_deviation(com, p_center, ideal))  # find deviation between ideal and actual positions
+    :type theta: numpy.ndarray
+
+    :return: wrapped angles
+    """
+
+    return np.angle(np.exp(1j * theta))
+
+
+def optimal_rotation(deviation, axis=None):
+    """ Rotation about the pore axis which best aligns an ideal pore with actual positions. Minimizing the squared chord
+    distance between actual and rotated ideal angular positions, sum_k |exp(i*theta_k) - exp(i*(ideal_k + alpha))|^2,
+    is a 2D Procrustes problem whose solution is the circular mean of the angular deviations, theta_k - ideal_k
+
+    :param deviation: angles of actual positions minus angles of ideal positions (radians)
+    :param axis: axis or axes over which deviations belonging to the same pore are stored
+
+    :type deviation: numpy.ndarray
+    :type axis: int or tuple
+
+    :return: angle (radians) by which ideal pore(s) should be rotated
+    """
+
+    return np.arctan2(np.sin(deviation).sum(axis=axis), np.cos(deviation).sum(axis=axis))
 
 
 class System(object):
 
-    def __init__(self, traj, top, ref_atoms, begin=0, pores=4, layers=20, nrotations=360):
+    def __init__(self, traj, top, ref_atoms, begin=0, pores=4, layers=20):
 
         # initialize what will be the main properties of interest
         self.dz = None
@@ -58,7 +81,6 @@ class System(object):
         self.dr = None
         self.r_values = None
         self.pore_radius = 0
-        self.nrotations = nrotations
 
         # load trajectory and calculate center of mass of each reference group
         self.t = md.load(traj, top=top)[begin:]
@@ -72,20 +94,20 @@ class System(object):
 
         pos = self.t.xyz[:, keep, :]
 
-        ncom = len(keep) // natoms
-        self.com = np.zeros([self.t.n_frames, ncom, 3])
-
         mass = np.array([Atom_props.mass[i] for i in ref_atoms])
 
         # calculate center of mass of reference groups
-        for f in range(self.t.n_frames):
-            for i in range(ncom):
-                p = pos[f, i * natoms: (i + 1) * natoms, :]
-                w = (p.T * mass).T
-                self.com[f, i, :] = np.sum(w, axis=0) / sum(mass)
+        self.com = physical.center_of_mass(pos, mass)
 
         self.p_centers = Structure_char.avg_pore_loc(self.npores, self.t.xyz, 0)
 
+        # centers of mass arranged by pore, column and layer, (nframes, npores, ncol, nlayers, 3)
+        self.columns = self.com[:, :(self.npores * self.ncol * self.nlayers), :].reshape(
+            self.t.n_frames, self.npores, self.ncol, self.nlayers, 3)
+
+        # pore centers at each frame, broadcastable against self.columns[..., :2]
+        self.centers = np.transpose(self.p_centers, (2, 1, 0))[:, :, np.newaxis, np.newaxis, :]
+
     def z_deviation(self):
 
         # map out ideal positions
@@ -93,81 +115,40 @@ class System(object):
         dbwl = zbox / self.nlayers
         layer_locations = np.linspace(0, dbwl * self.nlayers - dbwl, self.nlayers)
 
-        z = np.zeros([self.t.n_frames, self.com.shape[1]])  # leave out top and bottom layers which are across pbc's
-        for f in range(self.t.n_frames):
-            for p in range(self.npores):
-                for c in range(self.ncol):
-                    start = p * self.ncol * self.nlayers + c * self.nlayers
-                    end = p * self.ncol * self.nlayers + (c + 1) * self.nlayers
-                    z[f, start:end] = self.com[f, start:end, 2] - layer_locations
-                # for l in range(1, self.nlayers - 1):
-                #     start = p * 100 + l * 5
-                #     end = p * 100 + (l + 1) * 5
-                #     z[f, start:end] = self.com[f, start:end, 2] - layer_locations[l]
+        z = self.columns[..., 2] - layer_locations  # (nframes, npores, ncol, nlayers)
 
         z = np.where(z >= 0.5*zbox, z-zbox, z)
         z = np.where(z <= -0.5*zbox, z+zbox, z)
-        self.z_values = z #.flatten()[np.nonzero(z.flatten())]
+        self.z_values = z
         self.z_values -= self.z_values.mean()  # set mean to zero (needed to compare distributions)
         self.dz = np.std(self.z_values)
 
     def r_deviation(self):
 
-        r = np.zeros([self.t.n_frames, self.com.shape[1]])
-        for f in range(self.t.n_frames):
-            for p in range(self.npores):
-                r[f, p * self.ncol * self.nlayers:(p + 1) * self.ncol * self.nlayers] = np.linalg.norm(
-                    self.com[f, p * self.ncol * self.nlayers: (p + 1) * self.ncol * self.nlayers, :2] -
-                                                             self.p_centers[:, p, f], axis=1)
+        r = np.linalg.norm(self.columns[..., :2] - self.centers, axis=-1)  # (nframes, npores, ncol, nlayers)
 
-        self.pore_radius = np.mean(r.flatten())
-        self.r_values = r #.flatten()
+        self.pore_radius = np.mean(r)
+        self.r_values = r
         self.dr = np.std(self.r_values)
 
     def theta_deviation(self, pd=False):
 
-        ideal_column = np.zeros([self.nlayers, 3])
-        starting_position = np.array([self.pore_radius, 0, 0])
-        ideal_column[:, :] = starting_position
+        # angular positions of monomers in an ideal pore, (ncol, nlayers)
+        ideal = np.zeros([self.ncol, self.nlayers])
+        ideal += np.arange(self.ncol)[:, np.newaxis] * self.angle
         if pd:
-            ideal_column[1::2, :] = transform.rotate_coords_z(starting_position[np.newaxis, :], 33.9155266) #self.angle / 2)
-        ideal_pore = np.zeros([ideal_column.shape[0] * self.ncol, 3])
-        ideal_pore[:self.nlayers, :] = ideal_column
-        for i in range(1, self.ncol):
-            ideal_pore[i * self.nlayers: (i + 1) * self.nlayers, :] = transform.rotate_coords_z(
-                ideal_column, i * self.angle)
-
-        # layer based systems
-        # ideal_layer = np.zeros([5, 3])
-        # ideal_layer[0, :] = [self.pore_radius, 0, 0]
-        # for i in range(1, 5):
-        #     ideal_layer[i, :] = transform.rotate_coords_z(ideal_layer[np.newaxis, 0, :], i * self.angle)
-        #
-        # ideal_pore = np.zeros([ideal_layer.shape[0] * self.nlayers, 3])
-        # for i in range(self.nlayers):
-        #     if pd and i % 2 == 1:
-        #         ideal_pore[i * ideal_layer.shape[0]: (i + 1) * ideal_layer.shape[0], :] = transform.rotate_coords_z(
-        #                                 ideal_layer, self.angle / 2)
-        #     else:
-        #         ideal_pore[i * ideal_layer.shape[0]: (i + 1) * ideal_layer.shape[0], :] = ideal_layer
-
-        print('Calculating angles needed to minimize angular deviation')
-        #angles = np.zeros([self.t.n_frames, self.npores])
-        angles = np.linspace(0, 360, self.nrotations)
-        angular_deviations = np.zeros([self.t.n_frames, self.npores, self.ncol * self.nlayers])
-        for f in tqdm.tqdm(range(self.t.n_frames)):
-            for p in range(self.npores):
-                deviations = np.zeros([self.nrotations])
-                pos = self.com[f, p * self.ncol * self.nlayers:(p + 1) * self.ncol * self.nlayers, :2]
-                center = self.p_centers[:, p, f]
-                for i, x in enumerate(angles):
-                    deviations[i] = minimize_deviation(ideal_pore, x, pos, center)  # , com, ideal_pore, p_centers)
-                ideal = transform.rotate_coords_z(ideal_pore, angles[np.argmin(deviations)])
-                angular_deviations[f, p, :] = angular_deviation(pos, center, ideal)
-
-        self.theta_values = angular_deviations
-        self.theta_values[np.where(self.theta_values < 3)] += 2 * np.pi
-        self.theta_values[np.where(self.theta_values > 3)] -= 2 * np.pi
+            ideal[:, 1::2] += 33.9155266  # self.angle / 2
+        ideal *= (np.pi / 180)
+
+        centered = self.columns[..., :2] - self.centers  # move pores so origin is pore center
+        angles = np.arctan2(centered[..., 1], centered[..., 0])  # Calculate angle -- 4 quandrant inverse tangent
+
+        deviation = angles - ideal  # (nframes, npores, ncol, nlayers)
+
+        # rotate each ideal pore to best match actual positions at every frame
+        rotation = optimal_rotation(deviation, axis=(2, 3))
+
+        self.theta_values = wrap_angle(deviation - rotation[..., np.newaxis, np.newaxis])
         self.theta_values -= self.theta_values.mean()
 
         self.dtheta = np.std(self.theta_values)
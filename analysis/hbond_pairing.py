@@ -28,6 +28,8 @@ def initialize():
     parser.add_argument('-d', '--distance', default=.3, help='Maximum distance between acceptor and donor atoms')
     parser.add_argument('-angle', '--angle_cut', default=20, help='Maximum DHA angle to be considered an H-bond')
     parser.add_argument('-nmon', default=5, type=int, help='Number of monomers per layer')
+    parser.add_argument('-l', '--load', default=False, help='Load h-bonds from .npz file written by hbonds.py instead '
+                                                            'of searching for them')
 
     args = parser.parse_args()
 
@@ -79,25 +81,30 @@ if __name__ == "__main__":
     water_numbers = sys.number_water_molecules()
     res_numbers, nres = sys.number_residues('HII')
 
-    sys.identify_hbonds(args.distance, args.angle_cut)
+    if args.load:
+        sys.load_hbonds(args.load)
+    else:
+        sys.identify_hbonds(args.distance, args.angle_cut)
 
-    # single = np.zeros(sys.t.n_frames)
+    # single = np.zeros(sys.n_frames)
     nlayers = 20
     pores = 4
-    intra = np.zeros([pores*nlayers, sys.t.n_frames])  # h-bonds within layer
-    inter = np.zeros([pores*nlayers, sys.t.n_frames])  # h-bonds between layers
-    # above_and_below = np.zeros(sys.t.n_frames)
-    for i in range(sys.t.n_frames):
+    intra = np.zeros([pores*nlayers, sys.n_frames])  # h-bonds within layer
+    inter = np.zeros([pores*nlayers, sys.n_frames])  # h-bonds between layers
+    # above_and_below = np.zeros(sys.n_frames)
+    for i in range(sys.n_frames):
         # check to see which hydrogen share bonds between monomer and if those monomers are in different layers
         n = 0
-        donors = list(sys.hbonds[i][0, :])  # [D, H, A, angle]
-        double_donors = list(set(int(x) for x in donors if donors.count(x) > 1))
-        donors = np.array(donors)
+        frame = slice(sys.hbonds.offsets[i], sys.hbonds.offsets[i + 1])
+        donors = sys.hbonds.donors[frame]
+        acceptors = sys.hbonds.acceptors[frame]
+        unique, count = np.unique(donors, return_counts=True)
+        double_donors = unique[count > 1]
         interlayer = []
         intralayer = []
         for d in double_donors:
             ndx = np.where(donors == d)[0]
-            x = [res_numbers[int(x)] for x in sys.hbonds[i][2, ndx] if int(x) in res_numbers]
+            x = [res_numbers[int(x)] for x in acceptors[ndx] if int(x) in res_numbers]
             if len(x) == 2:
                 layer = min([a // args.nmon for a in x])
                 if different_layers(x, args.nmon):
@@ -124,7 +131,7 @@ if __name__ == "__main__":
         # single[i] = n
         # above_and_below[i] = N
 
-    z_avg = np.mean(sys.t.unitcell_vectors[:, 2, 2])
+    z_avg = np.mean(sys.box[:, 2, 2])
     print(z_avg)
     z = np.linspace(0, z_avg, 20)*10 # angstroms
 
@@ -155,7 +162,7 @@ if __name__ == "__main__":
 
     binsize = (layers[1] - layers[0])
 
-    ft = np.zeros([pores, int(nlayers*(block_length + 1) - block_length), sys.t.n_frames])
+    ft = np.zeros([pores, int(nlayers*(block_length + 1) - block_length), sys.n_frames])
 
     for j in range(inter.shape[1]):
         for k in range(4):
@@ -218,14 +225,14 @@ if __name__ == "__main__":
 
     p = (p_interlayer**2 - p_combos) / p_interlayer
 
-    plt.plot(sys.t.time, p)
+    plt.plot(sys.time, p)
 
     plt.figure()
-    plt.bar(sys.t.time, p_combos, sys.t.time[1] - sys.t.time[0])
+    plt.bar(sys.time, p_combos, sys.time[1] - sys.time[0])
 
     plt.figure()
-    plt.bar(sys.t.time, p_interlayer, sys.t.time[1] - sys.t.time[0])
+    plt.bar(sys.time, p_interlayer, sys.time[1] - sys.time[0])
     N = 50
-    plt.plot(sys.t.time[(N-1):], running_average(p_interlayer, N), linewidth=2)
+    plt.plot(sys.time[(N-1):], running_average(p_interlayer, N), linewidth=2)
 
     plt.show()
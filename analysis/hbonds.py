@@ -25,8 +25,7 @@ import numpy as np
 import os
 import tqdm
 import matplotlib.pyplot as plt
-import pickle
-from llcsim.llclib import file_rw
+from llcsim.llclib import trajectory, neighbors, physical, topology
 
 script_location = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
@@ -41,6 +40,7 @@ def initialize():
     parser.add_argument('-b', '--begin', default=0, type=int, help='End frame')
     parser.add_argument('-e', '--end', default=-1, type=int, help='Start frame')
     parser.add_argument('-sk', '--skip', default=1, type=int, help='Skip every skip frames')
+    parser.add_argument('-chunk', '--chunk', default=100, type=int, help='Number of frames read into memory at once')
     parser.add_argument('-x', '--exclude_water', action='store_true', help='Exclude water while searching for hbonds')
     parser.add_argument('-r', '--residues', nargs='+', default=['HII'], help='Residues to include in h-bond search. '
                         'Water is automatically included if you do not specify the -x option')
@@ -55,7 +55,8 @@ def initialize():
                                                                                   'describes cross-linked residue')
     parser.add_argument('-xres', '--xlink_residue', default='HII', help='Name of residue in molecules section of the '
                                                                         'topology corresponding to args.xlink_topology')
-    parser.add_argument('-l', '--load', default=False, help='Load pickled system object')
+    parser.add_argument('-l', '--load', default=False, help='Load h-bonds from .npz file written by a previous run')
+    parser.add_argument('-o', '--output', default='hbonds.npz', help='Name of .npz file where h-bonds are saved')
 
     return parser
 
@@ -63,7 +64,7 @@ def initialize():
 class System(object):
 
     def __init__(self, traj, gro, top, begin=0, end=-1, skip=1, exclude_water=False, xlink=False,
-                 xlink_topology='assembly.itp', xlink_residue='HII'):
+                 xlink_topology='assembly.itp', xlink_residue='HII', chunk=100):
         """
 
         :param traj:
@@ -75,18 +76,21 @@ class System(object):
         :param xlink:
         :param xlink_topology:
         :param xlink_residue:
+        :param chunk: number of frames read into memory at once
         """
 
         print('Generating bond list...', end="", flush=True)
         self.top = Topology(top, xlink=xlink, xlink_topology=xlink_topology, xlink_residue=xlink_residue)
         print('Done!')
 
-        print('Loading trajectory...', end="", flush=True)
-        self.t = md.load(traj, top=gro)[begin:end:skip]
-        print('Done!')
-        self.pos = self.t.xyz  # positions of all atoms
-        self.hbonds = []  # will hold h-bonds for each frame [D, H, A, angle]
-        self.dt = self.t.time[1] - self.t.time[0]
+        # frames are streamed from disk while searching for h-bonds
+        self.source = trajectory.Source(traj, gro, begin=begin, end=end, skip=skip, chunk=chunk)
+        self.topology = self.source.topology
+        self.n_frames = self.source.n_frames
+        self.hbonds = None  # Hbonds object holding [D, H, A, angle] of h-bonds at each frame
+        self.time = None  # time stamp of each frame (filled by identify_hbonds)
+        self.box = None  # unit cell vectors of each frame (filled by identify_hbonds)
+        self.dt = None
 
         # for hbond_pairing
         # self.nwater = 0
@@ -96,7 +100,7 @@ class System(object):
 
         # system definitions
         self.names = []
-        for a in self.t.topology.atoms:
+        for a in self.topology.atoms:
             # workaround for mdtraj since standard_names is not an option with .gro topologies.
             if a.residue.name == 'HOH':
                 if a.name == 'O':
@@ -108,7 +112,7 @@ class System(object):
             else:
                 self.names.append(a.name)
 
-        self.residues = [a.residue.name for a in self.t.topology.atoms]
+        self.residues = [a.residue.name for a in self.topology.atoms]
 
         # definitions
         self.donor_atoms = ['H']
@@ -126,11 +130,11 @@ class System(object):
         if not exclude_water:
 
             # all H's are potential donors
-            self.H = [a.index for a in self.t.topology.atoms if a.residue.name == 'HOH' and a.element.symbol == 'H']
+            self.H = [a.index for a in self.topology.atoms if a.residue.name == 'HOH' and a.element.symbol == 'H']
             # get the index of the atoms bonded to each H (all oxygens)
-            self.D = [self.top.bonds[x][0] for x in self.H]  # assumes only one bond to H as it should
+            self.D = list(self.top.neighbors[self.top.indptr[self.H]])  # assumes only one bond to H as it should
             # all oxygens are also potential acceptors
-            self.A = [a.index for a in self.t.topology.atoms if a.residue.name == 'HOH' and a.element.symbol == 'O']
+            self.A = [a.index for a in self.topology.atoms if a.residue.name == 'HOH' and a.element.symbol == 'O']
 
     def set_eligible(self, res, atoms):
         """
@@ -139,88 +143,107 @@ class System(object):
         :param atoms : atoms from residue to include in calculation
         """
 
-        for a in self.t.topology.atoms:
+        for a in self.topology.atoms:
             if a.residue.name == res:
                 if a.name in atoms:
                     # if a.element.symbol in self.donor_atoms:
                     #     self.donors.append(a.index)
                     if a.element.symbol == 'H':  # technically untested
                         self.H.append(a.index)
-                        self.D.append(self.top.bonds[a.index][0])
+                        self.D.append(self.top.bonded(a.index)[0])
                     if a.element.symbol in self.acceptor_atoms:
                         self.A.append(a.index)
 
     def identify_hbonds(self, cut, angle):
+        """ Find h-bonds at every frame. Donor-acceptor pairs within 'cut' of each other are found with a periodic
+        neighbor search one frame at a time, then D-H-A angles of all pairs in a block of frames are calculated at once
 
-        # narrow list by doing a distance search
+        :param cut: maximum distance between donor and acceptor atoms (nm)
+        :param angle: maximum D-H-A angle (degrees)
 
-        Dlen = len(self.D)
-        Alen = len(self.A)
-        d = np.zeros([self.pos.shape[0], Dlen * Alen])
+        :type cut: float
+        :type angle: float
+        """
 
-        # distance search can be sped up with cKDtree
-        if Dlen >= Alen:
-            L = Dlen
-            print('Calculating distances...')
-            for t in tqdm.tqdm(range(d.shape[0]), unit='frames'):
-                for i in range(len(self.A)):
-                    d[t, i*Dlen:(i + 1) * Dlen] = np.linalg.norm(self.pos[t, self.D, :] - self.pos[t, self.A[i], np.newaxis, :], axis=1)
-        else:
-            L = Alen
-            print('Calculating distances...')
-            for t in tqdm.tqdm(range(d.shape[0]), unit='frames'):
-                for i in range(len(self.D)):
-                    d[t, i * Alen:(i + 1) * Alen] = np.linalg.norm(self.pos[t, self.A, :] - self.pos[t, self.D[i], np.newaxis, :], axis=1)
+        # only read donor, hydrogen and acceptor atoms from disk
+        selection = np.unique(np.concatenate((self.D, self.H, self.A))).astype(int)
+        D = np.searchsorted(selection, self.D)  # indices within loaded blocks
+        H = np.searchsorted(selection, self.H)
+        A = np.searchsorted(selection, self.A)
 
-        print('Narrowing eligible atoms and calculating angles')
+        time = []
+        box = []
+        counts = []  # number of h-bonds at each frame
+        hbonds = []  # [D, H, A, angle] of h-bonds in each block
 
-        for i in tqdm.tqdm(range(d.shape[0])):
+        print('Calculating distances and angles...')
+        with tqdm.tqdm(total=self.n_frames, unit='frames') as bar:
 
-            indices = np.where(d[i, :] < cut)[0]  # indices where distance is below cutoff
+            for block in self.source.blocks(atom_indices=selection):
 
-            distance_eligible = indices[np.nonzero(d[i, indices])]  # narrow to only nonzero values
+                pos = block.xyz
+                time.append(block.time)
+                box.append(block.unitcell_vectors)
 
-            if Dlen >= Alen:
-                Aindex = np.array(self.A)[distance_eligible // L]  # indices of distance eligible acceptor atoms
-                Dindex = np.array(self.D)[distance_eligible % L]  # indices of distance eligible donor atoms
-                Hindex = np.array(self.H)[distance_eligible % L]  # H atoms attached to eligible donors
-            else:
-                Aindex = np.array(self.A)[distance_eligible % L]  # indices of distance eligible acceptor atoms
-                Dindex = np.array(self.D)[distance_eligible // L]  # indices of distance eligible donor atoms
-                Hindex = np.array(self.H)[distance_eligible // L]  # H atoms attached to eligible donors
+                # narrow list by doing a periodic neighbor search between donors and acceptors
+                frame, ndx_D, ndx_A = [], [], []
+                for f in range(block.n_frames):
+                    i, j, d = neighbors.pairs(pos[f, D, :], block.unitcell_vectors[f], cut, y=pos[f, A, :])
+                    nonzero = d > 0
+                    frame.append(np.full(np.count_nonzero(nonzero), f, dtype=int))
+                    ndx_D.append(i[nonzero])
+                    ndx_A.append(j[nonzero])
+
+                frame = np.concatenate(frame)
+                Dindex = D[np.concatenate(ndx_D)]  # indices of distance eligible donor atoms
+                Hindex = H[np.concatenate(ndx_D)]  # H atoms attached to eligible donors
+                Aindex = A[np.concatenate(ndx_A)]  # indices of distance eligible acceptor atoms
+
+                # D-H and H-A vectors of every pair in the block, using the box vectors of the frame each pair is from
+                boxes = block.unitcell_vectors[frame]
+                dh = physical.minimum_image_distance((pos[frame, Hindex, :] - pos[frame, Dindex, :])[:, np.newaxis, :],
+                                                     boxes)[:, 0, :]
+                ha = physical.minimum_image_distance((pos[frame, Aindex, :] - pos[frame, Hindex, :])[:, np.newaxis, :],
+                                                     boxes)[:, 0, :]
+
+                cos = np.einsum('ij,ij->i', dh, ha) / (np.linalg.norm(dh, axis=1) * np.linalg.norm(ha, axis=1))
+                a = np.arccos(np.clip(cos, -1, 1)) * (180 / np.pi)  # convert to degrees
+
+                keep = a <= angle
+                counts.append(np.bincount(frame[keep], minlength=block.n_frames))
 
-            self.hbonds.append(np.reshape(np.concatenate((Dindex, Hindex, Aindex)), (3, len(Aindex))))
+                # store h-bonds in terms of indices of the full system
+                hbonds.append((selection[Dindex[keep]], selection[Hindex[keep]], selection[Aindex[keep]], a[keep]))
 
-            # calculate vectors
-            v = np.zeros([2, len(Aindex), 3])
+                bar.update(block.n_frames)
 
-            v[0, ...] = self.pos[i, self.hbonds[i][1, :], :] - self.pos[i, self.hbonds[i][0, :], :]  # D-H vectors
-            v[0, ...] /= np.linalg.norm(v[0, ...], axis=1)[:, np.newaxis]  # normalize (need to, to get correct angle)
-            v[1, :] = self.pos[i, self.hbonds[i][2, :], :] - self.pos[i, self.hbonds[i][1, :], :]  # H-A vectors
-            v[1, ...] /= np.linalg.norm(v[1, ...], axis=1)[:, np.newaxis]  # normalize
+        self.time = np.concatenate(time)
+        self.box = np.concatenate(box)
+        if self.time.size > 1:
+            self.dt = self.time[1] - self.time[0]
 
-            # calculate angles
+        offsets = np.concatenate(([0], np.cumsum(np.concatenate(counts))))
+        self.hbonds = Hbonds(offsets, *[np.concatenate([h[i] for h in hbonds]) for i in range(4)], time=self.time,
+                             box=self.box)
 
-            dot = np.zeros([v.shape[1]])
-            for j in range(dot.shape[0]):
-                dot[j] = np.dot(v[0, j, :], v[1, j, :])
+    def load_hbonds(self, name='hbonds.npz'):
+        """ Load h-bonds written by save_hbonds instead of searching for them
 
-            a = np.arccos(dot) * (180/np.pi)  # convert to degrees
+        :param name: name of .npz file
 
-            self.hbonds[i] = np.delete(self.hbonds[i], np.where(a > angle)[0], axis=1)
-            self.hbonds[i] = np.concatenate((self.hbonds[i], a[a < 20][np.newaxis, :]), 0)
+        :type name: str
+        """
+
+        self.hbonds = Hbonds.load(name)
+        self.n_frames = self.hbonds.n_frames
+        self.time = self.hbonds.time
+        self.box = self.hbonds.box
+        if self.time.size > 1:
+            self.dt = self.time[1] - self.time[0]
 
     def plot_hbonds(self, show=True, save=True, savename='hbonds.png'):
 
-        n = [a.shape[1] for a in self.hbonds]
-        plt.plot(self.t.time / 1000, n)
-        plt.xlabel('Time (ns)', fontsize=14)
-        plt.ylabel('Number of hydrogen bonds', fontsize=14)
-        plt.tight_layout()
-        if save:
-            plt.savefig(savename)
-        if show:
-            plt.show()
+        plot_hbonds(self.hbonds, show=show, save=save, savename=savename)
 
     def number_water_molecules(self):
         """
@@ -231,7 +254,7 @@ class System(object):
         nwater = 0
 
         atoms = 1
-        for a in self.t.topology.atoms:
+        for a in self.topology.atoms:
             if a.residue.name == 'HOH':
                 water_numbers[a.index] = nwater
                 if atoms % 3 == 0:
@@ -247,7 +270,7 @@ class System(object):
 
         residue = Residue(res)
         atoms = 1
-        for a in self.t.topology.atoms:
+        for a in self.topology.atoms:
             if a.residue.name == 'HII':
                 residue_numbers[a.index] = nres
             if atoms % residue.natoms == 0:
@@ -256,134 +279,180 @@ class System(object):
 
         return residue_numbers, nres
 
-    def save_hbonds(self, name='hbonds.pl'):
+    def save_hbonds(self, name='hbonds.npz'):
 
-        with open(name, 'wb') as f:
-            pickle.dump(self.hbonds, f)
+        self.hbonds.save(name)
 
     def hbond_matrix(self):
+        """ Build a (n_frames, n_atoms) matrix whose entries are the index of the acceptor that each donor is
+        h-bonded to at each frame (0 if it is not h-bonded). Atoms are every atom that acts as a donor or acceptor in
+        at least one frame
+        """
 
-        unique_atoms = []
-        for i in range(len(self.hbonds)):
-            unique_atoms.append(np.unique(self.hbonds[i][::2, :]))
-
-        unique = np.unique(np.concatenate(unique_atoms))
+        unique = np.unique(np.concatenate((self.hbonds.donors, self.hbonds.acceptors)))
 
         for i in range(unique.size):
             self.atom_to_matrix_index[int(unique[i])] = i
             self.matrix_to_atom_index[i] = int(unique[i])
 
-        self.donor_acceptor_matrix = np.zeros([len(self.hbonds), unique.size])
+        self.donor_acceptor_matrix = np.zeros([self.hbonds.n_frames, unique.size])
+        self.donor_acceptor_matrix[self.hbonds.frames(), np.searchsorted(unique, self.hbonds.donors)] = \
+            self.hbonds.acceptors
 
-        for t in range(len(self.hbonds)):
-            hbond_frame = self.hbonds[t]
-            for i in range(hbond_frame.shape[1]):
-                self.donor_acceptor_matrix[t, self.atom_to_matrix_index[hbond_frame[0, i]]] = hbond_frame[2, i]
 
+class Hbonds(object):
 
-class Residue(object):
+    def __init__(self, offsets, donors, hydrogens, acceptors, angles, time=None, box=None):
+        """ Compact storage of h-bonds at every frame of a trajectory. H-bonds of all frames are stored end to end in
+        flat arrays, and the h-bonds of frame t are entries offsets[t]:offsets[t + 1] of each array
 
-    def __init__(self, name, xlink=False, xlink_topology='assembly.itp'):
+        :param offsets: index of the first h-bond of each frame, followed by the total number of h-bonds (n_frames + 1)
+        :param donors: index of donor atom of each h-bond
+        :param hydrogens: index of hydrogen atom of each h-bond
+        :param acceptors: index of acceptor atom of each h-bond
+        :param angles: D-H-A angle of each h-bond (degrees)
+        :param time: time stamp of each frame
+        :param box: unit cell vectors of each frame (n_frames, 3, 3)
 
-        self.name = name
+        :type offsets: numpy.ndarray
+        :type donors: numpy.ndarray
+        :type hydrogens: numpy.ndarray
+        :type acceptors: numpy.ndarray
+        :type angles: numpy.ndarray
+        :type time: numpy.ndarray
+        :type box: numpy.ndarray
+        """
 
-        self.is_ion = False
-        # check if residue is an ion
-        with open('%s/../top/topologies/ions.txt' % script_location) as f:
-            ions = []
-            for line in f:
-                if line[0] != '#':
-                    ions.append(str.strip(line))
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.donors = np.asarray(donors, dtype=np.int32)
+        self.hydrogens = np.asarray(hydrogens, dtype=np.int32)
+        self.acceptors = np.asarray(acceptors, dtype=np.int32)
+        self.angles = np.asarray(angles, dtype=np.float16)
+        self.time = time
+        self.box = box
 
-        if name in ions:
-            self.is_ion = True
-            self.natoms = 1
+        self.n_frames = self.offsets.size - 1
 
-        else:
-            # try:
-            #     t = md.load('%s.pdb' % name,
-            #                 standard_names=False)  # see if there is a solute configuration in this directory
-            # except OSError:
-            #     try:
-            #         t = md.load('%s/../top/topologies/%s.pdb' % (script_location, name),
-            #                     standard_names=False)  # check if the configuration is
-            #         # located with all of the other topologies
-            #     except OSError:
-            #         print('No residue %s found' % name)
-            #         exit()
-
-            try:
-                if xlink:
-                    f = open('%s' % xlink_topology, 'r')
-                else:
-                    f = open('%s.itp' % name, 'r')
-            except FileNotFoundError:
-                try:
-                    f = open('%s/../top/topologies/%s.itp' % (script_location, name), 'r')
-                except FileNotFoundError:
-                    print('No topology %s.itp found' % name)
-                    exit()
-
-            itp = []
-            for line in f:
-                itp.append(line)
+    def __len__(self):
+
+        return self.n_frames
+
+    def __getitem__(self, t):
+        """ H-bonds at frame t in the layout used before this class existed: a (4, n) array whose rows are the
+        donor, hydrogen and acceptor indices and D-H-A angle of each h-bond
+        """
+
+        s = slice(self.offsets[t], self.offsets[t + 1])
+
+        return np.array([self.donors[s], self.hydrogens[s], self.acceptors[s], self.angles[s]], dtype=float)
+
+    def counts(self):
+        """ Number of h-bonds at each frame
+        """
+
+        return np.diff(self.offsets)
+
+    def frames(self):
+        """ Frame that each h-bond belongs to
+        """
+
+        return np.repeat(np.arange(self.n_frames), self.counts())
 
-            f.close()
+    def save(self, name='hbonds.npz'):
+        """ Write h-bonds to a compressed .npz file
 
-            atoms_index = 0
-            while itp[atoms_index].count('[ atoms ]') == 0:
-                atoms_index += 1
+        :param name: name of output file
 
-            self.indices = {}  # key = atom name , value = index
-            self.names = {}  # key = index, value = atom name
+        :type name: str
+        """
+
+        arrays = dict(offsets=self.offsets, donors=self.donors, hydrogens=self.hydrogens, acceptors=self.acceptors,
+                      angles=self.angles)
+        if self.time is not None:
+            arrays['time'] = self.time
+        if self.box is not None:
+            arrays['box'] = self.box
+
+        np.savez_compressed(name, **arrays)
+
+    @classmethod
+    def load(cls, name):
+        """ Read h-bonds written by save()
+
+        :param name: name of .npz file
+
+        :type name: str
+
+        :return: Hbonds object
+        """
 
-            atoms_index += 2
-            i = 0
-            while itp[i + atoms_index] != '\n':
-                data = itp[i + atoms_index].split()
-                self.indices[data[4]] = int(data[0])
-                self.names[int(data[0])] = data[4]
-                i += 1
+        with np.load(name) as f:
+            return cls(f['offsets'], f['donors'], f['hydrogens'], f['acceptors'], f['angles'],
+                       time=f['time'] if 'time' in f else None, box=f['box'] if 'box' in f else None)
 
-            self.natoms = len(self.names)
 
-            # find the bonds section
-            bonds_index = 0
-            while itp[bonds_index].count('[ bonds ]') == 0:
-                bonds_index += 1
-            bonds_index += 2
+def plot_hbonds(hbonds, show=True, save=True, savename='hbonds.png'):
+    """ Plot the number of h-bonds versus time
 
-            bonds = []
-            while itp[bonds_index] != '\n':
-                bond_data = str.split(itp[bonds_index])[:2]
-                bonds.append([int(bond_data[0]), int(bond_data[1])])
-                bonds_index += 1
+    :param hbonds: h-bonds at every frame
+    :param show: show the plot
+    :param save: save the plot
+    :param savename: name of saved image
 
-            bonds = np.array(bonds)  # converted to numpy array for use with np.where
+    :type hbonds: Hbonds
+    :type show: bool
+    :type save: bool
+    :type savename: str
+    """
 
-            self.bonds = {}
-            for i in range(self.natoms):
-                self.bonds[i] = []
+    plt.plot(hbonds.time / 1000, hbonds.counts())
+    plt.xlabel('Time (ns)', fontsize=14)
+    plt.ylabel('Number of hydrogen bonds', fontsize=14)
+    plt.tight_layout()
+    if save:
+        plt.savefig(savename)
+    if show:
+        plt.show()
 
-                # involvement = [list(x) for x in bonds if i + 1 in x]  # old (slow) way of doing this
 
-                x = np.where(bonds == i + 1)
-                involvement = [bonds[x[0][i]] for i in range(len(x[0]))]
+class Residue(object):
+
+    def __init__(self, name, xlink=False, xlink_topology='assembly.itp'):
+
+        self.name = name
+
+        self.is_ion = name in topology.ions()  # check if residue is an ion
+        self.itp = None
 
-                for pair in involvement:
-                    atom = [x - 1 for x in pair if x != (i + 1)][0]
-                    self.bonds[i].append(atom)
+        if self.is_ion:
+            self.natoms = 1
+
+        else:
+            itp_file = xlink_topology if xlink and os.path.isfile(xlink_topology) else topology.find_itp(name)
+            if itp_file is None:
+                print('No topology %s.itp found' % name)
+                exit()
+
+            self.itp = topology.read_itp(itp_file)
+
+            self.natoms = self.itp.natoms
+            serials = range(1, self.natoms + 1)
+            self.indices = dict(zip(self.itp.names.tolist(), serials))  # key = atom name , value = index
+            self.names = dict(zip(serials, self.itp.names.tolist()))  # key = index, value = atom name
+
+            self.bonds = self.itp.bond_dict()
 
 
 class Topology(object):
 
     def __init__(self, top, xlink=False, xlink_topology='assembly.itp', xlink_residue='HII'):
-        """
+        """ Bonds between all atoms of a system. Each residue's .itp is parsed once and its bonds are broadcast over
+        every copy of that residue
 
-        :param top:
-        :param xlink:
-        :param xlink_topology:
-        :param xlink_residue:
+        :param top: name of system topology (.top)
+        :param xlink: True if the system is cross-linked
+        :param xlink_topology: name of the .itp describing the cross-linked residue
+        :param xlink_residue: name of the cross-linked residue
         """
 
         topology_file = []
@@ -402,22 +471,26 @@ class Topology(object):
             data = topology_file[i].split()
             self.residues[data[0]] = int(data[1])
 
-        # create bond tree thing
-        self.bonds = {}
-        preceding_atoms = 0  # atoms before residue
+        itps = []
         for r in self.residues:  # look at all residues
             if xlink and r == xlink_residue:
                 res = Residue(r, xlink=True, xlink_topology=xlink_topology)
             else:
                 res = Residue(r)  # create residue object
-            if not res.is_ion:
-                for n in range(self.residues[r]):  # create bond for each same type residue
-                    for b in res.bonds:  # look at bonds to each atom in order
-                        num = preceding_atoms + n * res.natoms + b
-                        self.bonds[num] = []
-                        for nb in res.bonds[b]:
-                            self.bonds[num].append(preceding_atoms + n * res.natoms + nb)
-            preceding_atoms += res.natoms * self.residues[r]
+            itps.append(res.itp)
+
+        # atom i is bonded to self.neighbors[self.indptr[i]:self.indptr[i + 1]]
+        self.indptr, self.neighbors = topology.expand_bonds(itps, list(self.residues.values()))
+
+    def bonded(self, i):
+        """ Atoms bonded to atom i
+
+        :param i: index of atom or array of indices
+
+        :return: indices of bonded atoms
+        """
+
+        return self.neighbors[self.indptr[i]:self.indptr[i + 1]]
 
 
 if __name__ == "__main__":
@@ -426,7 +499,7 @@ if __name__ == "__main__":
 
     if args.load:
 
-        sys = file_rw.load_object(args.load)
+        plot_hbonds(Hbonds.load(args.load))
 
     else:
         # workaround for argparse. If default value is set, it is always included in the list with action='append'
@@ -435,12 +508,12 @@ if __name__ == "__main__":
 
         sys = System(args.traj, args.gro, args.top, begin=args.begin, end=args.end, skip=args.skip,
                      exclude_water=args.exclude_water, xlink=args.xlink, xlink_topology=args.xlink_topology,
-                     xlink_residue=args.xlink_residue)
+                     xlink_residue=args.xlink_residue, chunk=args.chunk)
 
         for i, r in enumerate(args.residues):
             sys.set_eligible(r, args.atoms[i])
 
         sys.identify_hbonds(args.distance, args.angle_cut)
-        file_rw.save_object(sys, 'hbonds.pl')
+        sys.save_hbonds(args.output)
 
-    sys.plot_hbonds()
+        sys.plot_hbonds()
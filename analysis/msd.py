@@ -4,12 +4,10 @@ import os
 import sys
 import argparse
 import numpy as np
-import mdtraj as md
 import matplotlib.pyplot as plt
 from llcsim.analysis import Poly_fit, top, Atom_props
-from llcsim.llclib import physical, topology, timeseries, fitting_functions
+from llcsim.llclib import physical, topology, timeseries, fitting_functions, trajectory, cache, bootstrap
 from scipy import stats
-import tqdm
 import sqlite3 as sql
 
 
@@ -27,6 +25,7 @@ def initialize():
                         'fitting line during diffusivity calculation')
     parser.add_argument('-a', '--axis', default='z', type=str, help='Which axis to compute msd along')
     parser.add_argument('-nboot', default=200, type=int, help='Number of bootstrap trials for error estimation')
+    parser.add_argument('--seed', type=int, help='Random seed used for bootstrapping')
     parser.add_argument('-ensemble', '--ensemble', action="store_true", help='Calculate MSD as ensemble average')
     parser.add_argument('-compare', '--compare', action="store_true", help='Compare time-averaged and ensemble-averaged '
                                                                            'time series')
@@ -40,13 +39,22 @@ def initialize():
     parser.add_argument('-acov', '--autocovariance', action="store_true", help='Plot step autocovariance function')
     parser.add_argument('-nofit', '--nofit', action="store_true", help='Do not attempt to fit any curve to MSD')
     parser.add_argument('--update', action="store_true", help="update database with MD MSD values")
+    parser.add_argument('-chunk', '--chunk', default=100, type=int, help='Number of frames read into memory at once')
+    parser.add_argument('--make_whole', action="store_true", help='Make residues whole across periodic boundaries '
+                        'before calculating centers of mass')
+    parser.add_argument('--single', action="store_true", help='Calculate MSDs in single precision. Halves the memory '
+                        'needed for long trajectories of many particles')
+    parser.add_argument('-nt', '--nthreads', default=1, type=int, help='Number of threads used by the FFTs')
+    parser.add_argument('--no_cache', action="store_true", help='Do not load or store centers of mass and pore centers '
+                                                               'in the on-disk cache')
 
     return parser
 
 
 class Diffusivity(object):
 
-    def __init__(self, traj, gro, axis, begin=0, startfit=0.01, endfit=0.2, residue=False, atoms=[], restrict=[]):
+    def __init__(self, traj, gro, axis, begin=0, startfit=0.01, endfit=0.2, residue=False, atoms=[], restrict=[],
+                 chunk=100, make_whole=False, use_cache=True):
         """
         Calculate diffusivity from trajectory
         :param traj: unwrapped trajectory (i.e. gmx trjconv with -pbc nojump)
@@ -58,6 +66,10 @@ class Diffusivity(object):
         :param atoms: if specified, group of atoms whose center of mass MSD will be measured
         :param restrict: restrict selection to certain indices. For example, if you want to calculate MSD of a certain
         residue, but only include a fraction of the total residues in the system.
+        :param chunk: number of trajectory frames read into memory at once
+        :param make_whole: make residues whole across periodic boundaries before calculating their centers of mass
+        :param use_cache: load centers of mass and pore centers from the on-disk cache if they were already calculated
+        for this trajectory, and store them there otherwise
         """
 
         # initialize path locations
@@ -68,13 +80,14 @@ class Diffusivity(object):
         self.gro = gro
         self.traj = traj
         self.residue = residue
+        self.use_cache = use_cache
 
-        # initialize trajectory properties
-        print('Loading trajectory...', end='', flush=True)
-        self.t = md.load(self.traj, top=self.gro)[begin:]  # load trajectory
-        print('Done!')
-        self.nT = self.t.n_frames  # number of frames
-        self.time = self.t.time / 1000  # time stamp on each frame, converted to nanoseconds
+        # initialize trajectory properties. Frames are streamed from disk as they are needed
+        self.source = trajectory.Source(self.traj, self.gro, begin=begin, end=None, chunk=chunk)
+        self.topology = self.source.topology
+        self.nT = self.source.n_frames  # number of frames
+        self.time = None  # time stamp on each frame, converted to nanoseconds (filled while reading trajectory)
+        self.box = None  # unit cell vectors at each frame
 
         # initialize fits to data, error analysis and plotting parameters
         self.startfit = int(startfit*self.nT)  # index at which to start fit
@@ -107,9 +120,9 @@ class Diffusivity(object):
             self.itp = "%s/%s.itp" % (self.top_location, res)
 
             if restrict:
-                selection = [a.index for a in self.t.topology.atoms if a.residue.name == res and a.index in restrict]
+                selection = [a.index for a in self.topology.atoms if a.residue.name == res and a.index in restrict]
             else:
-                selection = [a.index for a in self.t.topology.atoms if a.residue.name == res]
+                selection = [a.index for a in self.topology.atoms if a.residue.name == res]
 
             topol = top.Top(self.itp)  # read topology
             atoms_per_residue = topol.natoms  # number atoms in a single residue
@@ -118,7 +131,7 @@ class Diffusivity(object):
 
         elif atoms:
 
-            selection = [a.index for a in self.t.topology.atoms if a.name in atoms]
+            selection = [a.index for a in self.topology.atoms if a.name in atoms]
 
             atoms_per_residue = len(atoms)
             matoms = np.array([Atom_props.mass[x] for x in atoms])
@@ -127,7 +140,6 @@ class Diffusivity(object):
             sys.exit('Error: No valid group of atoms or residues selected')
 
         self.map = topology.map_atoms(selection, nres_atoms=atoms_per_residue)
-        pos = self.t.xyz[:, selection, :]
 
         self.axis = []
         if 'x' in axis:
@@ -137,14 +149,18 @@ class Diffusivity(object):
         if 'z' in axis:
             self.axis.append(2)
 
-        print('Calculating center of mass of residues...', end='', flush=True)
-        self.com = np.zeros([self.nT, pos.shape[1] // atoms_per_residue, 3])  # track the center of mass of each residue
+        print('Calculating center of mass of residues...')
 
-        for f in range(self.nT):
-            for i in range(self.com.shape[1]):
-                w = (pos[f, i * atoms_per_residue:(i + 1) * atoms_per_residue, :].T * matoms).T  # weight each atom in the residue by its mass
-                self.com[f, i, :] = np.sum(w, axis=0) / self.mres  # sum the coordinates and divide by the mass of the residue
-        print('Done!')
+        def com(block):  # only the selected atoms are read from disk
+
+            box = block.unitcell_vectors if make_whole else None
+
+            return physical.center_of_mass(block.xyz, matoms, box=box), block.unitcell_vectors, block.time
+
+        self.com, self.box, time = cache.fetch('com', lambda: self.source.gather(com, atom_indices=selection,
+                                               progress=True), self.traj, use_cache=use_cache, selection=selection,
+                                               mass=matoms, make_whole=make_whole, frames=self.source.frames)
+        self.time = time / 1000
 
         # plot 'random' z coordinate traces
         # np.random.seed(4)  # 4 gives a nice spread for ethanol
@@ -186,35 +202,49 @@ class Diffusivity(object):
 
         # find pore centers
         pore_defining_atoms = topology.LC(build_monomer).pore_defining_atoms
-        pore_atoms = [a.index for a in self.t.topology.atoms if a.name in pore_defining_atoms]
-        if spline:
-            print('Creating pore splines')
-            pore_centers = physical.trace_pores(self.t.xyz[:, pore_atoms, :], self.t.unitcell_vectors, 20)
-        else:
-            pore_centers = physical.avg_pore_loc(npores, self.t.xyz[:, pore_atoms, :], self.t.unitcell_vectors)
+        pore_atoms = [a.index for a in self.topology.atoms if a.name in pore_defining_atoms]
+
+        def locate_pores():
+            pore_xyz = self.source.xyz(atom_indices=pore_atoms)  # second pass over the trajectory, pore atoms only
+            if spline:
+                print('Creating pore splines')
+                return physical.trace_pores(pore_xyz, self.box, 20)[0]
+            else:
+                return physical.avg_pore_loc(npores, pore_xyz, self.box)
+
+        pore_centers = cache.fetch('pore_centers', locate_pores, self.traj, use_cache=self.use_cache,
+                                   selection=pore_atoms, frames=self.source.frames, npores=npores, spline=spline,
+                                   npts=20)
 
         results = 0
         if tails:
             results = 1
 
         inregion = physical.partition(self.com, pore_centers, r, buffer=buffer,
-                                      unitcell=self.t.unitcell_vectors, npores=npores)[results]
+                                      unitcell=self.box, npores=npores)[results]
 
-        dwell = np.full((self.t.n_frames, self.com.shape[1]), False, dtype=bool)
+        dwell = np.full((self.nT, self.com.shape[1]), False, dtype=bool)
 
-        for t in range(self.t.n_frames):
+        for t in range(self.nT):
             dwell[t, inregion[t]] = True
 
-        fraction_dwelled = np.sum(dwell, axis=0) / self.t.n_frames  # fraction of total time spend in region of interest
+        fraction_dwelled = np.sum(dwell, axis=0) / self.nT  # fraction of total time spend in region of interest
 
         keep = np.where(fraction_dwelled >= dwell_fraction)[0]
 
         self.com = self.com[:, keep, :]
 
-    def calculate(self, ensemble=False):
+    def calculate(self, ensemble=False, single=False, nt=1):
+        """ Calculate the MSD of each particle
+
+        :param ensemble: calculate the ensemble MSD instead of the time-averaged MSD
+        :param single: calculate the time-averaged MSD in single (float32) precision
+        :param nt: number of threads used by the FFTs
+        """
 
-        print('Calculating MSD...', end='', flush=True)
-        self.MSD = timeseries.msd(self.com, self.axis, ensemble=ensemble)
+        print('Calculating MSD...', flush=True)
+        self.MSD = timeseries.msd(self.com, self.axis, ensemble=ensemble, nt=nt,
+                                  dtype=np.float32 if single else np.float64)
         self.MSD_average = np.mean(self.MSD, axis=1)
         print('Done!')
 
@@ -263,46 +293,32 @@ class Diffusivity(object):
 
         return [np.exp(A[0]), A[1]]
 
-    def bootstrap_power_law(self, N):
+    def bootstrap_power_law(self, N, seed=None):
+        """ Fit a power law to each of N bootstrapped MSD curves
 
-        self.power_law_fit = np.zeros([N, 2])
+        :param N: number of bootstrap trials
+        :param seed: random seed
+        """
 
         print('Bootstrapping power law fit...')
-        for b in tqdm.tqdm(range(N)):
+        bootstrapped_msd = bootstrap.means(self.MSD.T, N, seed=seed).T  # average MSDs of randomly chosen particles
 
-            choices = np.random.randint(0, self.MSD.shape[1], size=self.MSD.shape[1])
-            bootstrapped_msd = self.MSD[:, choices].mean(axis=1)
-            self.power_law_fit[b, :] = self.fit_power_law(bootstrapped_msd)
+        # fit all bootstrapped curves at once
+        A = Poly_fit.find_A(np.log(self.time[1:]), np.log(bootstrapped_msd[1:, :]), 1, self.W)
+        self.power_law_fit = np.array([np.exp(A[0]), A[1]]).T
 
-            # plt.plot(self.time/1000, bootstrapped_msd)
-            # plt.plot(self.time[1:]/1000, power_law(self.time[1:], self.power_law_fit[b, 0],
-            #                                        self.power_law_fit[b, 1]))
-            # plt.show()
-
-    def bootstrap(self, N):
+    def bootstrap(self, N, seed=None):
         """
         Estimate error at each point in the MSD curve using bootstrapping
         :param N: number of bootstrap trials
+        :param seed: random seed
         """
 
-        eMSDs = np.zeros([self.nT, N], dtype=float)  # create n bootstrapped trajectories
-
         print('Bootstrapping MSD curves...')
-        for b in tqdm.tqdm(range(N)):
-            indices = np.random.randint(0, self.com.shape[1], self.com.shape[1])  # randomly choose particles with replacement
-            for n in range(self.com.shape[1]):
-                eMSDs[:, b] += self.MSD[:, indices[n]]  # add the MSDs of a randomly selected particle
-            eMSDs[:, b] /= self.com.shape[1]  # Divide every timestep by Nparticles -- average the MSDs
-
-        confidence = 68  # percent confidence interval
-        lower_confidence = (100 - confidence) / 2
-        upper_confidence = 100 - lower_confidence
-
-        self.limits = np.zeros([2, self.nT], dtype=float)  # upper and lower bounds at each point along MSD curve
-        # determine a 95 % error bound for each tau (out of n MSD's, use that for the error bars)
-        for t in range(self.nT):
-            self.limits[0, t] = np.abs(np.percentile(eMSDs[t, :], lower_confidence) - self.MSD_average[t])
-            self.limits[1, t] = np.abs(np.percentile(eMSDs[t, :], upper_confidence) - self.MSD_average[t])
+        eMSDs = bootstrap.means(self.MSD.T, N, seed=seed).T  # (nT, N) average MSDs of randomly chosen particles
+
+        # determine a 68 % error bound for each tau (out of n MSD's, use that for the error bars)
+        self.limits = bootstrap.errorbars(eMSDs.T, self.MSD_average, confidence=68)
 
         npts = self.endfit - self.startfit
         if self.weights:
@@ -312,12 +328,9 @@ class Diffusivity(object):
         else:
             self.W = 'none'
 
-        slopes = np.zeros([N])
-        for b in range(N):
-            # fit line to each bootstrapped MSD
-            A = Poly_fit.poly_fit(self.time[self.startfit:self.endfit], eMSDs[self.startfit:self.endfit, b],
-                                  1, self.W)[-1]
-            slopes[b] = A[1]
+        # fit line to each bootstrapped MSD
+        slopes = Poly_fit.find_A(self.time[self.startfit:self.endfit], eMSDs[self.startfit:self.endfit, :], 1,
+                                 self.W)[1]
 
         slopes /= (2*1000000*len(self.axis))
 
@@ -477,29 +490,32 @@ if __name__ == "__main__":
 
         show = False
 
-        D_ensemble = Diffusivity(args.trajectory, args.gro, args.axis, residue=args.residue, atoms=args.atoms)
+        D_ensemble = Diffusivity(args.trajectory, args.gro, args.axis, residue=args.residue, atoms=args.atoms,
+                                 chunk=args.chunk, make_whole=args.make_whole,
+                                 use_cache=not args.no_cache)
 
         if args.pores or args.tails:  # do this if solutes are restricted to tails or pores
             D_ensemble.restrict_to_pore(args.pore_radius, tails=args.tails)
 
         D_ensemble.calculate(ensemble=True)
         # D_ensemble.fit_linear()  # make sure diffusivity is being measured from linear region of the MSD curve
-        D_ensemble.bootstrap(args.nboot)
+        D_ensemble.bootstrap(args.nboot, seed=args.seed)
         D_ensemble.plot(args.axis, fracshow=args.fracshow)
         print('D = %1.2e +/- %1.2e m^2/s' % (D_ensemble.Davg, np.abs(D_ensemble.Davg -
                                                                      D_ensemble.confidence_interval[0])))
     else:
         show = True
 
-    D = Diffusivity(args.trajectory, args.gro, args.axis, residue=args.residue, atoms=args.atoms)
+    D = Diffusivity(args.trajectory, args.gro, args.axis, residue=args.residue, atoms=args.atoms, chunk=args.chunk,
+                    make_whole=args.make_whole, use_cache=not args.no_cache)
 
     if args.pores or args.tails:  # do this if solutes are restricted to tails or pores
         D.restrict_to_pore(args.pore_radius, tails=args.tails)
 
-    D.calculate(ensemble=args.ensemble)
+    D.calculate(ensemble=args.ensemble, single=args.single, nt=args.nthreads)
 
     if args.power_law and not args.nofit:
-        D.bootstrap_power_law(args.nboot)
+        D.bootstrap_power_law(args.nboot, seed=args.seed)
         D.plot_power_law()
     else:
         if not args.compare and not args.nofit:
@@ -513,7 +529,7 @@ if __name__ == "__main__":
         D.step_autocovariance()
         D.plot_autocovariance()
 
-    D.bootstrap(args.nboot)
+    D.bootstrap(args.nboot, seed=args.seed)
 
     if args.ensemble:
         args.fracshow = 1  # same amount of statistics at each frame
@@ -11,8 +11,8 @@ from scipy.interpolate import griddata
 from matplotlib import animation
 import argparse
 from pymbar import timeseries
-import random as ran
 import mdtraj as md
+from llcsim.llclib import trajectory, parallel, bootstrap
 from scipy.optimize import curve_fit
 from scipy import spatial
 import tqdm
@@ -30,6 +30,8 @@ def initialize():
     parser.add_argument('--begin', default=0, type=int, help='Frame to begin calculations')
     parser.add_argument('--end', default=-1, type=int, help='Frame to stop calculations')
     parser.add_argument('--skip', default=1, type=int, help='Sample every nth frame')
+    parser.add_argument('--chunk', default=100, type=int, help='Number of frames read into memory at once')
+    parser.add_argument('--nproc', default=1, type=int, help='Number of processes to split frames between')
 
     # System-dependent parameters
     parser.add_argument('-p', '--pores', default=4, help='Number of pores in unit cell')
@@ -45,6 +47,7 @@ def initialize():
     parser.add_argument('--auto_exclude', action="store_true", help="Specifying this will override args.exclude and "
                         "decide which pore-to-pore distance to exclude automatically by dropping the highest value")
     parser.add_argument('-b', '--nboot', default=2000, help='Number of bootstrap trials for generating statistics')
+    parser.add_argument('--seed', type=int, help='Random seed used for bootstrapping')
 
     # plotting details
     parser.add_argument('--plot_every', default=1, type=int, help='Plot every n frames')
@@ -75,6 +78,28 @@ def restrict_atoms(t, component):
     :return:
     """
 
+    atoms_to_keep = component_indices(t.topology, component)
+
+    if atoms_to_keep is not None:
+        pos = t.xyz[:, atoms_to_keep, :]
+    else:
+        pos = t.xyz
+
+    return pos
+
+
+def component_indices(topology, component):
+    """ Get the indices of the atoms used to track pore positions
+
+    :param topology: mdtraj topology object
+    :param component: names of components to be used for tracking pore centers.
+
+    :type topology: mdtraj.core.topology.Topology
+    :type component: str or list
+
+    :return: indices of atoms making up component, or None if the whole system ('sys') should be used
+    """
+
     # Check for certain special arguments
     if component == 'tails' or component == 'Tails':
         atoms = ['C7', 'C8', 'C9', 'C10', 'C11', 'C12', 'C13', 'C14', 'C15', 'C16', 'C17', 'C18', 'C19', 'C20', 'C21',
@@ -97,28 +122,63 @@ def restrict_atoms(t, component):
 
     if component != 'sys':
 
-        atoms_to_keep = [a.index for a in t.topology.atoms if a.name in atoms and a.residue.name != 'HOH']
-        pos = t.xyz[:, atoms_to_keep, :]
+        return [a.index for a in topology.atoms if a.name in atoms and a.residue.name != 'HOH']
 
     else:
         # NOTE: if you use 'sys', use gmx trjconv -f *.trr -s *.tpr -pbc atom
         #                        then gmx trjconv -f *.trr -s *.tpr -pbc whole
         # This will make sure everything is in the box and whole.
-        pos = t.xyz
+        return None
 
-    return pos
 
+def _pore_centers(pos, npores=4, buffer=0):
+    """ Average xy location of each pore at each frame of a block of frames. See avg_pore_loc
 
-def avg_pore_loc(npores, pos, buffer=0):
+    :param pos: the coordinates of the component(s) used to locate the pore centers, shape(nframes, ncomponents, 3)
+    :param npores: the number of pores in the unit cell
+    :param buffer: fraction (of membrane thickness) of top and bottom of membrane to exclude from p2p calculations
+
+    :type pos: numpy.ndarray
+    :type npores: int
+    :type buffer: float
+
+    :return: x, y coordinates of the center of each pore at each frame, shape(nframes, 2, npores)
+    """
+
+    nT = np.shape(pos)[0]
+    comp_ppore = np.shape(pos)[1] // npores
+
+    p_center = np.zeros([nT, 2, npores])
+
+    for i in range(nT):
+        zmax = np.amax(pos[i, :, 2])  # maximum z value for this frame
+        zmin = np.amin(pos[i, :, 2])  # minimum z value for this frame
+        thick = zmax - zmin
+        zmax -= buffer*thick
+        zmin += buffer*thick
+        for j in range(npores):
+            count = 0
+            for k in range(comp_ppore*j, comp_ppore*(j + 1)):
+                if zmax >= pos[i, k, 2] >= zmin:
+                    p_center[i, :, j] += pos[i, k, :2]
+                    count += 1
+            p_center[i, :, j] /= count  # take the average
+
+    return p_center
+
+
+def avg_pore_loc(npores, pos, buffer=0, nproc=1):
     """ Calculate average pore location for each pore at each frame
 
     :param no_pores: the number of pores in the unit cell
     :param pos: the coordinates of the component(s) which you are using to locate the pore centers
     :param buffer: fraction (of membrane thickness) of top and bottom of membrane to exclude from p2p calculations
+    :param nproc: number of processes to split frames between
 
     :type no_pores: int
     :type pos: numpy.ndarray, shape(ncomponents, 3) or numpy.ndarray, shape(nframes, ncomponents, 3)
     :type buffer: float
+    :type nproc: int
 
     :return: numpy array containing the x, y coordinates of the center of each pore at each frame
     """
@@ -127,24 +187,8 @@ def avg_pore_loc(npores, pos, buffer=0):
 
     if len(pos.shape) == 3:  # multiple frames
 
-        nT = np.shape(pos)[0]
-        comp_ppore = np.shape(pos)[1] // npores
-
-        p_center = np.zeros([2, npores, nT])
-
-        for i in range(nT):
-            zmax = np.amax(pos[i, :, 2])  # maximum z value for this frame
-            zmin = np.amin(pos[i, :, 2])  # minimum z value for this frame
-            thick = zmax - zmin
-            zmax -= buffer*thick
-            zmin += buffer*thick
-            for j in range(npores):
-                count = 0
-                for k in range(comp_ppore*j, comp_ppore*(j + 1)):
-                    if zmax >= pos[i, k, 2] >= zmin:
-                        p_center[:, j, i] += pos[i, k, :2]
-                        count += 1
-                p_center[:, j, i] /= count  # take the average
+        p_center = parallel.frame_map(_pore_centers, (pos,), nproc=nproc, npores=npores, buffer=buffer)
+        p_center = np.moveaxis(p_center, 0, -1)  # (2, npores, nT)
 
     elif len(pos.shape) == 2:  # single frame
 
@@ -191,7 +235,7 @@ def p2p(p_centers, distances):
     return p2ps
 
 
-def p2p_stats(p2ps, exclude, nboot, equil):
+def p2p_stats(p2ps, exclude, nboot, equil, seed=None):
     """ Calculate the average and spread of pore-to-pore distances
 
     :param p2ps: all of the pore-to-pore distances
@@ -200,11 +244,13 @@ def p2p_stats(p2ps, exclude, nboot, equil):
     :param nboot: number of bootstrap trials to use when generating statistics
     :param equil: the trajectory frame at which to start generating statistics. Care about this parameter if you
            choose to detect equilibration manually. Otherwise 'auto' will use pymbar to find it for you
+    :param seed: random seed used for bootstrapping
 
     :type p2ps: numpy.ndarray, shape(nframes, np2p_distances)
     :type exclude: int or str
     :type nboot: int
     :type equil: int or str
+    :type seed: int
 
     :return: the average and standard deviation of pore to pore distances
     """
@@ -245,25 +291,13 @@ def p2p_stats(p2ps, exclude, nboot, equil):
     if tau == 0:
         tau = 1
 
-    ind_trajectories = (nT - t) // tau  # the number of independent trajectories
-    print('%s Independent Trajectories' % ind_trajectories)
-
-    trajectories = np.zeros([ndist, ind_trajectories, tau])  # Create a new array to hold all the trajectories
+    # average of each distance over each independent trajectory (ind_trajectories, ndist)
+    trajectories = bootstrap.blocks(p2ps[:, t:].T, tau)
+    print('%s Independent Trajectories' % trajectories.shape[0])
 
-    # fill up trajectory array
-    for i in range(ndist):
-        for j in range(ind_trajectories):
-            # trajectories[i*ind_trajectories + j, :] = p2ps[i, (t + j*tau):(t + (j + 1)*tau)]
-            trajectories[i, j, :] = p2ps[i, (t + j*tau):(t + (j + 1)*tau)]
-
-    # bootstrap to get statistics
-    p2p_boot = np.zeros([nboot, ndist, ind_trajectories*tau])  # a bunch of full trajectories assembled from independent trajectories
-    avg_trials = np.zeros([nboot, ndist])
-    for i in range(nboot):
-        for k in range(ind_trajectories):
-            T = ran.randrange(0, ind_trajectories)  # pick a random trajectory from all the independent trajectories
-            p2p_boot[i, :, k*tau:(k+1)*tau] = trajectories[:, T, :]
-        avg_trials[i, :] = np.mean(p2p_boot[i, :, :], axis=1)  # Average value of each pore for each trial
+    # bootstrap to get statistics. Each trial is a full trajectory assembled from randomly chosen independent
+    # trajectories
+    avg_trials = bootstrap.means(trajectories, nboot, seed=seed)  # Average value of each pore for each trial
 
     average_distances = np.mean(avg_trials, axis=0)
     avg = np.mean(average_distances)
@@ -325,7 +359,7 @@ def parse_txt(txt, points, times, std=False):
             begin = np.where(times == time[i])[0][0]
             end = np.where(times == time[i + 1])[0][0]
             slice = p2ps[:, begin:end]
-            p2p_avg, p2p_std, equil = p2p_stats(slice, exclude, '%s' % args.nboot, '%s' % args.equil)
+            p2p_avg, p2p_std, equil = p2p_stats(slice, exclude, '%s' % args.nboot, '%s' % args.equil, seed=args.seed)
             std_equil[:, i] = [p2p_avg, p2p_std, equil + begin, end]
 
         for i in range(std_equil.shape[1]):
@@ -379,16 +413,17 @@ if __name__ == '__main__':
 
     args = initialize().parse_args()  # parse the args
 
-    t = md.load(args.input, top=args.gro)[args.begin:args.end:args.skip]
-
-    pos = restrict_atoms(t, args.component)  # convenience function
+    # only the atoms used to locate the pores are read from the trajectory
+    source = trajectory.Source(args.input, args.gro, begin=args.begin, end=args.end, skip=args.skip, chunk=args.chunk)
+    keep = component_indices(source.topology, args.component)  # convenience function
+    pos, time = source.gather(lambda block: (block.xyz, block.time), atom_indices=keep, progress=True)
     nT = np.shape(pos)[0]
 
     tot_atoms = np.shape(pos)[1]
     n_pores = int(args.pores)  # number of pores
     comp_ppore = tot_atoms // n_pores
 
-    p_centers = avg_pore_loc(n_pores, pos, args.buffer)
+    p_centers = avg_pore_loc(n_pores, pos, args.buffer, nproc=args.nproc)
 
     distances = 6  # number of p2p distances to calculate. The following algorithm isn't smart enough for >6 yet
     p2ps = p2p(p_centers, distances)
@@ -401,8 +436,8 @@ if __name__ == '__main__':
     else:
         exclude = [int(i) for i in args.exclude]
 
-    p2p_avg, p2p_std, equil = p2p_stats(p2ps, exclude, '%s' % args.nboot, '%s' % args.equil)
-    print('Equilibration detected after %d ns' % (t.time[equil] / 1000))
+    p2p_avg, p2p_std, equil = p2p_stats(p2ps, exclude, '%s' % args.nboot, '%s' % args.equil, seed=args.seed)
+    print('Equilibration detected after %d ns' % (time[equil] / 1000))
     print('Average Pore to Pore distance: %.3f' % p2p_avg)
     print('Standard Deviation of Pore to Pore distances: %.3f' % p2p_std)
 
@@ -427,11 +462,11 @@ if __name__ == '__main__':
 
         avg /= n
 
-        ax1.plot(t.time[::args.plot_every]/1000, avg[::args.plot_every], linewidth=2)
+        ax1.plot(time[::args.plot_every]/1000, avg[::args.plot_every], linewidth=2)
 
         if args.T:
 
-            xbounds, ybounds = parse_txt(args.T, avg[::args.plot_every], t.time[::args.plot_every]/1000, std=args.plot_std)
+            xbounds, ybounds = parse_txt(args.T, avg[::args.plot_every], time[::args.plot_every]/1000, std=args.plot_std)
             plt.ylim(ybounds)
             plt.xlim(xbounds)
 
@@ -447,7 +482,7 @@ if __name__ == '__main__':
 
         for i in range(distances):
             if i not in exclude:
-                plt.plot(t.time[::args.plot_every], p2ps[i, ::args.plot_every], label='%s' % labels[i])
+                plt.plot(time[::args.plot_every], p2ps[i, ::args.plot_every], label='%s' % labels[i])
 
         plt.tight_layout()
 
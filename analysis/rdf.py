@@ -1,8 +1,7 @@
 #!/usr/bin/env python
 
 import argparse
-import mdtraj as md
-from llcsim.llclib import physical, topology, file_rw
+from llcsim.llclib import physical, topology, file_rw, trajectory, cache, bootstrap
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -21,8 +20,13 @@ def initialize():
     parser.add_argument('--begin', default=0, type=int, help='Frame to begin calculations')
     parser.add_argument('--end', default=-1, type=int, help='Frame to stop doing calculations')
     parser.add_argument('-skip', '--skip', default=1, type=int, help='Analyze every skip frames')
+    parser.add_argument('-chunk', '--chunk', default=100, type=int, help='Number of frames read into memory at once')
+    parser.add_argument('-nproc', '--nproc', default=1, type=int, help='Number of processes to split frames between')
+    parser.add_argument('--no_cache', action="store_true", help='Do not load or store centers of mass and pore centers '
+                                                               'in the on-disk cache')
     parser.add_argument('-l', '--load', help='Name of compressed .npz to load')
     parser.add_argument('-nboot', default=200, type=int, help='Number of bootstrap trials')
+    parser.add_argument('--seed', type=int, help='Random seed used for bootstrapping')
     parser.add_argument('-spline', '--spline', action="store_true", help='Trace pore centers using a spline')
     parser.add_argument('-spts', '--spline_pts', default=20, type=int, help='Number of points making up the spline of'
                                                                             'each pore')
@@ -38,7 +42,8 @@ def initialize():
 
 class System(object):
 
-    def __init__(self, gro, traj, residue, monomer, begin=0, end=-1, skip=1, npores=4, atoms=None):
+    def __init__(self, gro, traj, residue, monomer, begin=0, end=-1, skip=1, npores=4, atoms=None, chunk=100,
+                 use_cache=True):
         """ Calculate the radial distribution of residue in a hexagonal phase LLC Membrane
 
         :param gro: Coordinate file (.gro or .pdb)
@@ -50,6 +55,9 @@ class System(object):
         :param skip: Skip every 'skip' frames
         :param npores: Number of pores
         :param atoms: Calculate RDF of atoms specified here which are a part of residue
+        :param chunk: Number of frames read into memory at once
+        :param use_cache: Load centers of mass and pore centers from the on-disk cache if they were already calculated
+        for this trajectory, and store them there otherwise
 
         :type gro: str
         :type traj: str
@@ -60,10 +68,14 @@ class System(object):
         :type skip: int
         :type npores: int
         :type atoms: list
+        :type chunk: int
+        :type use_cache: bool
         """
 
-        self.t = md.load(traj, top=gro)[begin:end:skip]
-        self.box = self.t.unitcell_vectors
+        self.use_cache = use_cache
+        self.source = trajectory.Source(traj, gro, begin=begin, end=end, skip=skip, chunk=chunk)
+        self.topology = self.source.topology
+        self.n_frames = self.source.n_frames
         self.npores = npores
 
         if residue == 'SOL':  # workaround for mdtraj
@@ -73,13 +85,36 @@ class System(object):
         self.monomer = topology.LC('%s.gro' % monomer)
 
         if atoms is not None and 'all' not in atoms:
-            res = [a.index for a in self.t.topology.atoms if a.residue.name == residue and a.name in atoms]
+            res = [a.index for a in self.topology.atoms if a.residue.name == residue and a.name in atoms]
             mass = [self.residue.mass[v] for v in self.residue.mass.keys() if v in atoms]
         else:
-            res = [a.index for a in self.t.topology.atoms if a.residue.name == residue]
+            res = [a.index for a in self.topology.atoms if a.residue.name == residue]
             mass = [v for v in self.residue.mass.values()]
 
-        self.com = physical.center_of_mass(self.t.xyz[:, res, :], mass)
+        pore_defining_atoms = [a.index for a in self.topology.atoms if a.name in self.monomer.pore_defining_atoms
+                               and a.residue.name == self.monomer.name]
+
+        self.pore_atoms = pore_defining_atoms
+        self.pore_xyz = None
+
+        def read():
+            # only read the atoms needed for the COMs and pore locations. Indices in the loaded blocks are relative to
+            # the sorted union of both selections
+            selection = np.union1d(res, pore_defining_atoms)
+            res_ndx = np.searchsorted(selection, res)
+            pore_ndx = np.searchsorted(selection, pore_defining_atoms)
+
+            print('Reading trajectory and calculating centers of mass...')
+            com, self.pore_xyz, box = self.source.gather(lambda block: (
+                physical.center_of_mass(block.xyz[:, res_ndx, :], mass), block.xyz[:, pore_ndx, :],
+                block.unitcell_vectors), atom_indices=selection, progress=True)
+
+            return com, box
+
+        self.com, self.box = cache.fetch('com', read, traj, use_cache=self.use_cache, selection=res, mass=mass,
+                                         frames=self.source.frames)
+
+        self.last = self.source.frame(-1)  # full final configuration for visualization
 
         self.r = None
         self.density = None
@@ -96,16 +131,16 @@ class System(object):
         :return: structure file, 'spline.gro'
         """
 
-        pos = np.concatenate((self.t.xyz[-1, ...], self.com[-1, ...]))
+        pos = np.concatenate((self.last.xyz[0, ...], self.com[-1, ...]))
 
-        ids = [a.name for a in self.t.topology.atoms]
-        res = [a.residue.name for a in self.t.topology.atoms]
+        ids = [a.name for a in self.topology.atoms]
+        res = [a.residue.name for a in self.topology.atoms]
         ids += [rep] * self.com.shape[1]
         res += [rep] * self.com.shape[1]
 
         file_rw.write_gro_pos(pos, 'com.gro', ucell=self.box[-1, ...], ids=ids, res=res)
 
-    def radial_distribution_function(self, bins=50, cut=1.5, spline=False, progress=True, npts_spline=10):
+    def radial_distribution_function(self, bins=50, cut=1.5, spline=False, progress=True, npts_spline=10, nproc=1):
         """ Calculate the radial distribution function based on xy distance of solute center of mass from pore center
 
         :param bins: number of bins in histogram of radial distances
@@ -113,27 +148,32 @@ class System(object):
         :param spline: locate pore centers as a function of z. Recommended. Slower, but more accurate
         :param progress: Show progress bar while generating spline
         :param npts_spline: Number of points making up spline tr each pore
+        :param nproc: Number of processes to split frames between
         :return:
         """
 
         self.r = np.zeros([bins])
-        self.density = np.zeros([self.t.n_frames, bins])
-
-        pore_defining_atoms = [a.index for a in self.t.topology.atoms if a.name in self.monomer.pore_defining_atoms
-                               and a.residue.name == self.monomer.name]
+        self.density = np.zeros([self.n_frames, bins])
 
         if spline:
             print('Generating spline through each pore...')
 
-        pore_centers = physical.avg_pore_loc(4, self.t.xyz[:, pore_defining_atoms, :], self.box, spline=spline,
-                                             progress=progress, npts=npts_spline)
+        def locate_pores():
+            if self.pore_xyz is None:  # centers of mass came from the cache. Pore atoms still need to be read
+                self.pore_xyz = self.source.xyz(atom_indices=self.pore_atoms)
+            return physical.avg_pore_loc(4, self.pore_xyz, self.box, spline=spline, progress=progress,
+                                         npts=npts_spline, nproc=nproc)
+
+        pore_centers = cache.fetch('pore_centers', locate_pores, self.source.traj, use_cache=self.use_cache,
+                                   selection=self.pore_atoms, frames=self.source.frames, npores=4, spline=spline,
+                                   npts=npts_spline)
 
         if spline:
             self.build_spline(pore_centers)  # to check that the spline was constructed properly
             print('Calculating component density')
 
-        self.r, self.density = physical.compdensity(self.com, pore_centers, self.t.unitcell_vectors,
-                                                    nbins=bins, spline=spline, cut=cut)
+        self.r, self.density = physical.compdensity(self.com, pore_centers, self.box,
+                                                    nbins=bins, spline=spline, cut=cut, nproc=nproc)
 
     def build_spline(self, pore_centers, rep='K'):
         """ Build the spline into the last frame of the trajectory
@@ -143,34 +183,26 @@ class System(object):
 
         :return: 'spline.gro'
         """
-        pos = self.t.xyz[-1, ...]
+        pos = self.last.xyz[0, ...]
 
         for i in range(4):
             pos = np.concatenate((pos, pore_centers[-1, i, ...]))
-        ids = [a.name for a in self.t.topology.atoms]
-        res = [a.residue.name for a in self.t.topology.atoms]
+        ids = [a.name for a in self.topology.atoms]
+        res = [a.residue.name for a in self.topology.atoms]
         ids += [rep]*pore_centers.shape[2]*pore_centers.shape[1]
         res += [rep]*pore_centers.shape[2]*pore_centers.shape[1]
 
         file_rw.write_gro_pos(pos, 'spline.gro', ucell=self.box[-1, ...], ids=ids, res=res)
 
-    def bootstrap(self, nboot):
+    def bootstrap(self, nboot, seed=None):
+        """ Estimate a 95 % confidence interval at each point of the RDF by resampling frames
 
-        nT = self.density.shape[0]
-        self.bootstraps = np.zeros([nboot, self.density.shape[1]])
-
-        for i in range(nboot):
-            frames = np.random.choice(nT, size=nT, replace=True)  # choose random frames with replacement
-            self.bootstraps[i, :] = self.density[frames, :].mean(axis=0)  # average rdf from all frames
-
-        confidence = 95  # percent confidence interval
-        lower_confidence = (100 - confidence) / 2
-        upper_confidence = 100 - lower_confidence
+        :param nboot: number of bootstrap trials
+        :param seed: random seed
+        """
 
-        self.errorbars = np.zeros([2, self.density.shape[1]])
-        self.errorbars[0, :] = np.abs(np.percentile(self.bootstraps, lower_confidence, axis=0) -
-                                      self.density.mean(axis=0))  # 2.5 percent of data below this value
-        self.errorbars[1, :] = np.percentile(self.bootstraps, upper_confidence, axis=0) - self.density.mean(axis=0)
+        self.bootstraps = bootstrap.means(self.density, nboot, seed=seed)  # average rdf of randomly chosen frames
+        self.errorbars = bootstrap.errorbars(self.bootstraps, self.density.mean(axis=0), confidence=95)
 
     def plot(self, show=False, normalize=False, save=True, savename='rdf.pdf'):
 
@@ -220,10 +252,11 @@ if __name__ == "__main__":
         print(status)
 
         rdfs.append(System(args.gro, args.traj, r[0], args.build_monomer_residue, begin=args.begin,
-                           end=args.end, skip=args.skip, atoms=args.atoms[i]))
+                           end=args.end, skip=args.skip, atoms=args.atoms[i], chunk=args.chunk,
+                           use_cache=not args.no_cache))
         rdfs[i].radial_distribution_function(bins=args.bins, spline=args.spline, npts_spline=args.spline_pts,
-                                             cut=args.cut)
-        rdfs[i].bootstrap(args.nboot)
+                                             cut=args.cut, nproc=args.nproc)
+        rdfs[i].bootstrap(args.nboot, seed=args.seed)
         rdfs[i].plot(show=False, normalize=True, save=True)
 
     #plt.show()
\ No newline at end of file
@@ -3,7 +3,7 @@
 import mdtraj as md
 import argparse
 import numpy as np
-from llcsim.llclib import physical
+from llcsim.llclib import physical, neighbors
 from llcsim.analysis import p2p
 import matplotlib.pyplot as plt
 import tqdm
@@ -31,33 +31,6 @@ def initialize():
     return args
 
 
-def duplicate(pos, box):
-    """
-    Duplicate a set of positions periodically once in the +/- xy directions
-    :param pos: xyz positions of a set of coordinates to be duplicated periodically
-    :param box: box vectors in mdtraj format (t.unitcell_vectors : [nframes, 3, 3]) for every frame
-    :return: Periodically duplicated system
-    """
-
-    n = pos.shape[1]  # number atoms in original unit cell
-
-    p = np.zeros([pos.shape[0], n*9, 3])  # will hold periodically duplicated system
-    p[:, :n, :] = pos
-
-    # x-direction
-    for t in range(pos.shape[0]):
-        p[t, n:2*n, :] = pos[t, :, :] + box[t, 0, :]
-        p[t, 2*n:3*n, :] = pos[t, :, :] - box[t, 0, :]
-
-    # y-direction
-    n *= 3
-    for t in range(pos.shape[0]):
-        p[t, n:2*n, :] = p[t, :n, :] + box[t, 1, :]
-        p[t, 2*n:3*n, :] = p[t, :n, :] - box[t, 1, :]
-
-    return p
-
-
 def compdensity(component, pore_centers, start, box, cut=1.5, pores=4, nbins=50, rmax=3.5, buffer=0.0):
     """ Measure the density of a component as a function of the distance from the pore centers
 
@@ -101,19 +74,19 @@ def compdensity(component, pore_centers, start, box, cut=1.5, pores=4, nbins=50,
 
     density = np.zeros([nbins])  # number / nm^3
     for t in tqdm.tqdm(range(start, nT)):
-        for p in range(pores):
-            # narrow down the positions to those that are within 'cut' of at least one pore
-            distances = np.linalg.norm(component[t, :, :2] - pore_centers[t, p, :], axis=1)
-            d_sorted = np.sort(distances)
-            # find where the distances exceed the cutoff
-            stop = 0
-            while d_sorted[stop] < cut:
-                stop += 1
+        # radial distances are measured in the xy plane between each pore center and the nearest periodic image of
+        # each component, so components across a periodic boundary from a pore are counted
+        xy = np.zeros([tot_atoms, 3])
+        xy[:, :2] = component[t, :, :2]
+        centers = np.zeros([pores, 3])
+        centers[:, :2] = pore_centers[t, :pores, :2]
 
-            hist, bin_edges = np.histogram(d_sorted[:stop], bins=nbins, range=(0, cut))  # the range option is necessary
-            #  to make sure we have equal sized bins on every iteration
+        distances = neighbors.pairs(centers, box[t, ...], cut, y=xy)[2]  # only distances within 'cut' of a pore
 
-            density += hist
+        hist, bin_edges = np.histogram(distances, bins=nbins, range=(0, cut))  # the range option is necessary
+        #  to make sure we have equal sized bins on every iteration
+
+        density += hist
 
     density /= zbox * (nT - start)  # take average
     bin_width = cut / nbins
@@ -257,8 +230,6 @@ if __name__ == "__main__":
 
             pos = p2p.restrict_atoms(t, reg)  # restrict trajectory to region
 
-            p = duplicate(pos, t.unitcell_vectors)  # duplicate things periodically
-
             equil = 0
             density, r, bin_width = compdensity(pos, p_centers, equil, box, pores=npores, nbins=args.bins)
 
@@ -274,7 +245,6 @@ if __name__ == "__main__":
             print('Calculating number density of solvent')
             keep = [a.index for a in t.topology.atoms if a.residue.name == 'HOH' and a.name == 'O']
             pos = t.xyz[:, keep, :]
-            p = duplicate(pos, t.unitcell_vectors)
             equil = 0
             density, r, bin_width = Structure_char.compdensity(pos, p_centers, equil, t.unitcell_vectors, pores=npores, buffer=0, nbins=args.bins)
             results[-1, :] = density
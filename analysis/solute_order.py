@@ -3,7 +3,7 @@
 import argparse
 import numpy as np
 import mdtraj as md
-from llcsim.llclib import topology, physical
+from llcsim.llclib import topology, physical, cache
 import matplotlib.pyplot as plt
 
 
@@ -18,6 +18,8 @@ def initialize():
     parser.add_argument('-b', '--build_monomer', default='NAcarb11V.gro', help='Name of monomer structure file used to'
                                                                                ' build LLC membrane')
     parser.add_argument('-s', '--solute', default='ETH', help='Name of solute to be analysed')
+    parser.add_argument('--no_cache', action="store_true", help='Do not load or store centers of mass and pore centers '
+                                                               'in the on-disk cache')
 
     return parser
 
@@ -39,7 +41,7 @@ def moving_average(a, n=3):
 
 class System(object):
 
-    def __init__(self, solute, gro, traj, build_monomer, spline=False, npores=4):
+    def __init__(self, solute, gro, traj, build_monomer, spline=False, npores=4, use_cache=True):
 
         self.npores = npores
 
@@ -60,12 +62,18 @@ class System(object):
         solutes_indices = [a.index for a in self.t.topology.atoms if a.residue.name == solute]
         self.nsolute = len(solutes_indices) // self.solute.natoms
         self.solute_vectors = self.direction_vectors()
-        self.com = physical.center_of_mass(self.t.xyz[:, solutes_indices, :], [v for v in self.solute.mass.values()])
+        mass = [v for v in self.solute.mass.values()]
+        self.com = cache.fetch('com', lambda: physical.center_of_mass(self.t.xyz[:, solutes_indices, :], mass), traj,
+                               use_cache=use_cache, selection=solutes_indices, mass=mass, frames=None)
 
         reference_atoms = [a.index for a in self.t.topology.atoms if a.name in self.monomer.pore_defining_atoms and
                            a.residue.name in self.monomer.residues]
 
-        self.pore_centers = physical.avg_pore_loc(4, self.t.xyz[:, reference_atoms, :], self.t.unitcell_vectors)
+        def locate_pores():
+            return physical.avg_pore_loc(4, self.t.xyz[:, reference_atoms, :], self.t.unitcell_vectors)
+
+        self.pore_centers = cache.fetch('pore_centers', locate_pores, traj, use_cache=use_cache,
+                                        selection=reference_atoms, frames=None, npores=4, spline=False, npts=20)
 
         self.pore_vectors = self.pore_center_vectors()
 
@@ -165,6 +173,6 @@ if __name__ == "__main__":
 
     args = initialize().parse_args()
 
-    sys = System(args.solute, args.gro, args.traj, args.build_monomer)
+    sys = System(args.solute, args.gro, args.traj, args.build_monomer, use_cache=not args.no_cache)
 
     sys.plot(ma=False)
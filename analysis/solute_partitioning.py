@@ -2,7 +2,7 @@
 
 import argparse
 import mdtraj as md
-from llcsim.llclib import physical, topology
+from llcsim.llclib import physical, topology, cache
 from llcsim.analysis import Atom_props
 import numpy as np
 import matplotlib.pyplot as plt
@@ -45,6 +45,9 @@ def initialize():
 
     parser.add_argument('--load', action="store_true")
     parser.add_argument('--savename', default='solute_partitioning.pl')
+    parser.add_argument('-nproc', '--nproc', default=1, type=int, help='Number of processes to split frames between')
+    parser.add_argument('--no_cache', action="store_true", help='Do not load or store centers of mass and pore centers '
+                                                               'in the on-disk cache')
 
     parser.add_argument('-boot', '--nboot', default=200, type=int, help='Number of bootstrap trials')
     parser.add_argument('--single_frame', action='store_true', help='Specify this flag in order to analyze a single'
@@ -170,7 +173,7 @@ def bootstrap(data, tau, nboot):
 
 class System(object):
 
-    def __init__(self, gro, build_monomer, residue, traj=False, begin=0, end=-1, skip=1, npores=4):
+    def __init__(self, gro, build_monomer, residue, traj=False, begin=0, end=-1, skip=1, npores=4, use_cache=True):
         """ Define the system and boundaries for pore and tail region
 
         :param gro: coordinate file
@@ -180,8 +183,14 @@ class System(object):
         :param end: last frame to include
         :param skip: skip every n frames
         :param npores: number of pores. Assumes that atoms are number sequentially by pore
+        :param use_cache: load centers of mass and pore centers from the on-disk cache if they were already calculated
+        for this trajectory, and store them there otherwise
         """
 
+        self.traj = traj if traj else gro
+        self.frames = (begin, end, skip)
+        self.use_cache = use_cache
+
         print('Loading trajectory...', flush=True, end='')
         if traj:
             self.t = md.load(traj, top=gro)[begin:end:skip]
@@ -201,6 +210,7 @@ class System(object):
         self.pore_atoms = topology.LC(build_monomer).pore_defining_atoms
         self.npores = npores
         self.pore_centers = None
+        self.spline = False
         self.pore_water = []
         self.tail_water = []
 
@@ -226,29 +236,52 @@ class System(object):
         residue_atom_names = [a.name for a in self.t.topology.atoms if a.residue.name == residue]
         masses = [self.residue.mass[x] for x in residue_atom_names[:self.residue.natoms]]
 
-        print('Calculating centers of mass...', end='', flush=True)
-        self.com = physical.center_of_mass(self.pos[:, self.residue_indices, :], masses)
-        print('Done!')
+        def com():
+            print('Calculating centers of mass...', end='', flush=True)
+            c = physical.center_of_mass(self.pos[:, self.residue_indices, :], masses)
+            print('Done!')
+            return c
+
+        self.com = cache.fetch('com', com, self.traj, use_cache=use_cache, selection=self.residue_indices,
+                               mass=masses, frames=self.frames)
+
+    def locate_pore_centers(self, spline=False, nproc=1):
+        """ Find the center of each pore at each frame
 
-    def locate_pore_centers(self, spline=False):
+        :param spline: trace the pore centers with a spline
+        :param nproc: number of processes to split frames between
+
+        :type spline: bool
+        :type nproc: int
+        """
 
         # find pore centers
         # can use physical.avg_pore_loc with spline argument instead of if/else below
         pore_atoms = [a.index for a in self.t.topology.atoms if a.name in self.pore_atoms]
-        if spline:
-            print('Creating pore splines')
-            self.pore_centers = physical.trace_pores(self.pos[:, pore_atoms, :], self.t.unitcell_vectors, 20)
-        else:
-            self.pore_centers = physical.avg_pore_loc(self.npores, self.pos[:, pore_atoms, :], self.t.unitcell_vectors)
+        self.spline = spline
 
-    def partition(self, r, buffer=0):
+        def locate_pores():
+            if spline:
+                print('Creating pore splines')
+                return physical.trace_pores(self.pos[:, pore_atoms, :], self.t.unitcell_vectors, 20, nproc=nproc)[0]
+            else:
+                return physical.avg_pore_loc(self.npores, self.pos[:, pore_atoms, :], self.t.unitcell_vectors,
+                                             nproc=nproc)
+
+        self.pore_centers = cache.fetch('pore_centers', locate_pores, self.traj, use_cache=self.use_cache,
+                                        selection=pore_atoms, frames=self.frames, npores=self.npores, spline=spline,
+                                        npts=20)
+
+    def partition(self, r, buffer=0, nproc=1):
         """ Partition solute residue into tail and pore region
 
         :param r: pore radius, outside of which atoms will be considered in the tail region
         :param buffer: z distance (nm) to cut out from top and bottom of membrane (in cases where there is a water gap)
+        :param nproc: number of processes to split frames between
 
         :type r: float
         :type buffer: float
+        :type nproc: int
 
         """
 
@@ -256,28 +289,20 @@ class System(object):
         # plt.hist(self.com[0, :, 2], bins=50)
         # plt.show()
 
-        print('Calculating solute partition...')
-        for i in tqdm.tqdm(range(self.t.n_frames)):
-            pore = []
+        pore = physical.partition(self.com, self.pore_centers, r, buffer=buffer, unitcell=self.t.unitcell_vectors,
+                                  npores=self.npores, spline=self.spline, nproc=nproc)
 
-            if buffer > 0:
-                xy_positions = self.com[i, (self.com[i, :, 2] > buffer) & (self.com[i, :, 2] <
-                                        self.t.unitcell_vectors[i, 2, 2] - buffer), :2]
-            else:
-                xy_positions = self.com[i, :, :2]
-
-            for p in range(self.npores):
-                d = np.linalg.norm(xy_positions - self.pore_centers[i, p, :], axis=1)
-                pore += np.where(d <= r)[0].tolist()
+        if buffer > 0:  # number of centers of mass between the buffers at each frame
+            zmax = self.t.unitcell_vectors[:, 2, 2, np.newaxis] - buffer
+            ncom = np.sum((self.com[..., 2] > buffer) & (self.com[..., 2] < zmax), axis=1)
+        else:
+            ncom = np.full(self.t.n_frames, self.com.shape[1])
 
-            self.pore_water.append(np.unique(pore).tolist())
+        for i in range(self.t.n_frames):
 
-            tails = np.full(xy_positions.shape[0], True, dtype=bool)  # array of True. Booleans are fast
-            tails[self.pore_water[i]] = False  # set pore indices to False
-            self.tail_water.append(np.where(tails)[0])  # list of tail indices where tails = True
+            self.pore_water.append(np.nonzero(pore[i, :])[0].tolist())
+            self.tail_water.append(np.nonzero(~pore[i, :ncom[i]])[0])  # list of tail indices
 
-            # vvv slow vvv
-            #self.tail_water.append([x for x in np.arange(0, self.com.shape) if x not in self.pore_water[i]])
     # def flux(self):
 
     def plot(self, resname='Water'):
@@ -305,9 +330,9 @@ if __name__ == "__main__":
     if not args.load:
         # heavy calcuations
         sys = System(args.gro, args.build_monomer, args.residue, traj=args.traj, begin=args.begin, end=args.end,
-                     skip=args.skip)
+                     skip=args.skip, use_cache=not args.no_cache)
 
-        sys.locate_pore_centers(spline=args.spline)
+        sys.locate_pore_centers(spline=args.spline, nproc=args.nproc)
 
         with open(args.savename, "wb") as f:
             pickle.dump(sys, f)
@@ -317,7 +342,7 @@ if __name__ == "__main__":
             sys = pickle.load(f)
 
     print('Calculating solute partition by frame')
-    sys.partition(args.pore_radius, buffer=args.buffer)
+    sys.partition(args.pore_radius, buffer=args.buffer, nproc=args.nproc)
 
     name = '%s' % args.residue
     if args.residue == 'SOL' or args.residue == 'HOH':
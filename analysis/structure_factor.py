@@ -8,8 +8,8 @@ import mdtraj as md
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 import numpy as np
-from scipy.interpolate import RegularGridInterpolator
 from scipy.optimize import curve_fit
+from llcsim.llclib import transform
 
 
 def initialize():
@@ -20,6 +20,8 @@ def initialize():
     # Options that affect structure factor calculation
     parser.add_argument('-g', '--grid', nargs='+', default=[128, 128, 128], help='Number of real space grid points in'
                         'each direction (list of ints). Length of array must match number of dimensions')
+    parser.add_argument('-nthreads', '--nthreads', default=-1, type=int, help='Number of threads used by each FFT. '
+                        '-1 uses all available cores')
 
     # Options for GROMACS trajectories (implementation needs to be copied over (and restructured) from fft3d.py)
     parser.add_argument('-gro', help='Name of coordinate file to fourier transform')
@@ -423,7 +425,20 @@ class Trajectory(object):
         #         elif z > self.box[2]:
         #             self.locations[t, i, 2] -= self.box[2]
 
-    def compute_structure_factor(self, grid, hexagonal=False, weights=None):
+    def compute_structure_factor(self, grid, hexagonal=False, weights=None, workers=-1):
+        """ Calculate the structure factor averaged over all frames. Frames are histogrammed and fourier transformed
+        one at a time so memory use does not grow with the number of frames
+
+        :param grid: number of grid points in each dimension
+        :param hexagonal: transform coordinates from a monoclinic cell with angle self.theta to a cubic cell first
+        :param weights: atomic form factor of each atom. If None, all atoms are weighted equally
+        :param workers: number of threads used by each FFT. -1 uses all available cores
+
+        :type grid: list
+        :type hexagonal: bool
+        :type weights: numpy.ndarray
+        :type workers: int
+        """
 
         if hexagonal:
             print("Transforming coordinates to cubic cell")
@@ -432,27 +447,17 @@ class Trajectory(object):
 
         self.put_in_box()
 
-        # put locations into discrete bins
-        # define bin edges in each dimension
+        # grid spacing in each dimension
         x = np.linspace(0, self.box[0], grid[0] + 1)
         y = np.linspace(0, self.box[1], grid[1] + 1)
         z = np.linspace(0, self.box[2], grid[2] + 1)
 
-        print('Histogramming...')
-        H = np.zeros([self.nframes, grid[0], grid[1], grid[2]])
-        for f in tqdm.tqdm(range(self.nframes)):
-            H[f, ...] = np.histogramdd(self.locations[f, ...], bins=(x, y, z))[0]
-
-        # fourier transform
         print('Computing Fourier Transforms')
-        sf = np.zeros([grid[0], grid[1], grid[2]])
-        rpi = np.zeros([self.nframes])
+        engine = transform.StructureFactor(grid, subtract_mean=True, workers=workers)
         for f in tqdm.tqdm(range(self.nframes)):
-            #fft = np.fft.fftn(H[f, ...])
-            fft = np.fft.fftn(H[f, ...] - H[f, ...].mean())
-            sf += (fft * fft.conjugate()).real
+            engine.add(self.locations[f, ...] / self.box, weights=weights)
 
-        sf /= (self.nframes * self.locations.shape[1])
+        sf = engine.structure_factor() / self.locations.shape[1]
 
         # fft frequencies organized so 0 frequency is at the center in all dimensions
         freq_x = np.fft.fftfreq(grid[0], d=x[1]-x[0])
@@ -546,67 +551,15 @@ class Trajectory(object):
         if show:
             plt.show()
 
-    def angle_average(self, ucell=None, NBR=80, rmax=-1, zbins=-1, zmax=-1, plot=True, show=False, save=False):
-
-        ES = RegularGridInterpolator((self.freq_x, self.freq_y, self.freq_z), self.sf, bounds_error=False)
-
-        THETA_BINS_PER_INV_ANG = 20.
-        MIN_THETA_BINS = 10  # minimum allowed bins
-        RBINS = NBR
-
-        a1 = self.unit_cell[0]
-        a2 = self.unit_cell[1]
-        a3 = self.unit_cell[2]
-
-        b1 = (np.cross(a2, a3)) / (np.dot(a1, np.cross(a2, a3)))
-        b2 = (np.cross(a3, a1)) / (np.dot(a2, np.cross(a3, a1)))
-        b3 = (np.cross(a1, a2)) / (np.dot(a3, np.cross(a1, a2)))
-
-        b_inv = np.linalg.inv(np.vstack((b1, b2, b3)))
-
-        if zbins == -1:
-            ZBINS = self.freq_z.shape[0]  # 400
-        else:
-            ZBINS = zbins
-
-        if zmax == -1:
-            ZMAX = self.freq_z[-1]
-        else:
-            ZMAX = zmax
-
-        XR = (self.freq_x[-1] - self.freq_x[0])
-        YR = (self.freq_y[-1] - self.freq_y[0])
-
-        if rmax == -1:
-            Rmax = min(XR, YR) / 2.0
-            Rmax *= 0.95
-        else:
-            Rmax = rmax
-
-        rarr, rspace = np.linspace(0.0, Rmax, RBINS, retstep=True)
-        zar = np.linspace(-ZMAX, ZMAX, ZBINS)
-
-        oa = np.zeros((rarr.shape[0], zar.shape[0]))
-
-        circ = 2. * np.pi * rarr  # circumference
-
-        for ir in range(rarr.shape[0]):
-
-            NTHETABINS = max(int(THETA_BINS_PER_INV_ANG * circ[ir]),
-                             MIN_THETA_BINS)  # calculate number of bins at this r
-            thetas = np.linspace(0.0, np.pi * 2.0, NTHETABINS, endpoint=False)  # generate theta array
-
-            t, r, z = np.meshgrid(thetas, rarr[ir], zar)  # generate grid of cylindrical points
-
-            xar = r * np.cos(t)  # set up x,y coords
-            yar = r * np.sin(t)
-
-            pts = np.vstack((xar.ravel(), yar.ravel(), z.ravel())).T  # reshape for interpolation
-
-            if ucell is not None:
-                pts = np.matmul(pts, b_inv)
+    def angle_average(self, ucell=None, NBR=80, rmax=-1, zbins=-1, zmax=-1, plot=True, show=False, save=False,
+                      interpolate=False):
+        """ Average the structure factor about the qz axis. See transform.angle_average for the meaning of ucell,
+        NBR, rmax, zbins, zmax and interpolate. If ucell is not None, q points are transformed using self.unit_cell
+        """
 
-            oa[ir, :] = np.average(ES(pts).reshape(r.shape), axis=1)  # store average values in final array
+        oa, rarr, zar = transform.angle_average(self.freq_x, self.freq_y, self.freq_z, self.sf,
+                                                ucell=self.unit_cell if ucell is not None else None, NBR=NBR,
+                                                rmax=rmax, zbins=zbins, zmax=zmax, interpolate=interpolate)
 
         mn = np.nanmin(oa)
         oa = np.where(np.isnan(oa), mn, oa)
@@ -617,7 +570,7 @@ class Trajectory(object):
         # set up data for contourf plot by making it symmetrical
         self.angle_averaged = np.append(oa[::-1, :], oa[1:], axis=0)  # SF
         self.r_angle_averaged = np.append(-rarr[::-1], rarr[1:])  # R
-        self.z_angle_averaged = np.append(z[:, 0, :], z[1:, 0, :], axis=0)[0]  # Z
+        self.z_angle_averaged = zar  # Z
 
         if plot:
             fig, ax = plt.subplots()
@@ -688,7 +641,7 @@ if __name__ == "__main__":
     # plot points in 3D before any modification
     t.scatter3d(show=False)
 
-    t.compute_structure_factor(grid, hexagonal=args.hexagonal)
+    t.compute_structure_factor(grid, hexagonal=args.hexagonal, workers=args.nthreads)
     # t.plot_sf_slice('y', [0, 0], show=True)
     # exit()
     t.plot_sf_slice('z', [0, 0], show=False)
@@ -9,7 +9,7 @@ import numpy as np
 import mdtraj as md
 import argparse
 import tilt
-from llcsim.llclib import file_rw
+from llcsim.llclib import file_rw, neighbors, parallel, physical
 from scipy import spatial
 import matplotlib.pyplot as plt
 import math
@@ -35,6 +35,7 @@ def initialize():
     parser.add_argument('--load', action="store_true", help='load previously saved arrays')
     parser.add_argument('--write_gro', action="store_true", help='create .gro file of centroids')
     parser.add_argument('--all', action="store_true", help='Calculate angle distribution using all atoms')
+    parser.add_argument('-nproc', '--nproc', default=1, type=int, help='Number of processes to split frames between')
 
     args = parser.parse_args()
 
@@ -48,88 +49,81 @@ def tail_centroid(pos, grps):
     :return: centroids for each tail
     """
 
-    ngrps = len(grps)
-    natoms = pos.shape[1]
-    atomsptail = len(grps[0])
     nT = pos.shape[0]
-    nmon = int(natoms / len(grps[0]) / ngrps)
+    atomsptail = len(grps[0])
+
+    # atoms of each tail are listed consecutively, tail after tail, monomer after monomer
+    return pos.reshape(nT, -1, atomsptail, 3).mean(axis=2)
+
+
+def _neighbor_pairs(pos, box, upper, lower=0):
+    """ Find pairs of points separated by a distance between lower and upper at each frame of a block of frames. See
+    nearest_neighbors
+    """
+
+    counts = np.zeros([pos.shape[0]], dtype=int)
+    first, second = [], []
+
+    for t in range(pos.shape[0]):
 
-    centroids = np.zeros([nT, nmon * ngrps, 3])
+        if box is None:
+            found = spatial.cKDTree(pos[t, ...]).query_pairs(upper, output_type='ndarray')
+            i = np.concatenate((found[:, 0], found[:, 1]))
+            j = np.concatenate((found[:, 1], found[:, 0]))
+            d = np.linalg.norm(pos[t, i, :] - pos[t, j, :], axis=1)
+        else:
+            i, j, d = neighbors.pairs(pos[t, ...], box[t, ...], upper)
+
+        keep = (d >= lower) & (d <= upper)
+        i, j, d = i[keep], j[keep], d[keep]
 
-    print('Calculating tail centroids')
-    for t in tqdm.tqdm(list(range(nT))):
-        for i in range(nmon):
-            for j in range(ngrps):
-                centroid = np.zeros([3])
-                for k in range(atomsptail):
-                    centroid += pos[t, i*ngrps*atomsptail + j*atomsptail + k, :]
-                centroid /= atomsptail
-                centroids[t, i*ngrps + j, :] = centroid
+        order = np.lexsort((j, d, i))  # neighbors of each point from closest to farthest
 
-    return centroids
+        counts[t] = order.size
+        first.append(i[order])
+        second.append(j[order])
 
+    return counts, np.concatenate(first).astype(int), np.concatenate(second).astype(int)
 
-def nearest_neighbors(arr, d, lower_limit=0.4):
+
+def nearest_neighbors(arr, d, lower_limit=0.4, box=None, nproc=1):
     """
-    :param arr: array of points [npoints, dimension]
+    :param arr: array of points [nframes, npoints, dimension]
     :param d: furthest distance out to search (nm)
-    :return: list of list of indices. List i contains all nearest neighbors to position i
+    :param lower_limit: closest distance of a neighbor (nm)
+    :param box: box vectors at each frame [nframes, 3, 3]. If given, distances obey the minimum image convention
+    :param nproc: number of processes to split frames between
+    :return: number of neighbor pairs at each frame, then the index of each point and of its neighbor. Pairs of all
+    frames are stored end to end, ordered by frame, then point, then distance
     """
 
-    nT = arr.shape[0]
-    npts = arr.shape[1]
-    nn_list = []
-    for t in range(nT):
-        nn_list.append([])
-        for i in range(npts):
-            nn_list[t].append([])  # using lists since this will vary in length
-
     print('Calculating nearest neighbors')
-    for t in tqdm.tqdm(list(range(nT))):
-        frame = arr[t, :, :]
-        for i in tqdm.tqdm(list(range(npts))):
-            others = np.delete(frame, i, 0)  # delete self entry or else the nearest neighbor is itself
-            nn = spatial.cKDTree(others).query(frame[i, :])[1]  # find index of nearest neighbor
-            index = np.where(frame == others[nn])  # find the index in others corresponding to nn in arr
-            ld = np.linalg.norm(frame[i, :] - frame[index[0][0]])  # calc linear distance between position and nearest neighbor
-            while ld <= d:  # make sure its within d and then keep finding nearest neighbors within this range
-                if ld >= lower_limit:
-                    nn_list[t][i].append(index[0][0])  # add index of nearest neighbor to list i
-                others = np.delete(others, nn, 0)  # delete row containing already counted nearest neighbor
-                nn = spatial.KDTree(others).query(frame[i, :])[1]  # calculate new nearest neighbor
-                index = np.where(frame == others[nn])  # find the index in others corresponding to nn in arr
-                ld = np.linalg.norm(frame[i, :] - frame[index[0][0]])  # calc linear distance between position and nearest neighbor
-
-    return nn_list
-
-
-def angles_ld(arr, indices, normal=[0, 0, 1]):
+
+    return parallel.frame_map(_neighbor_pairs, (arr, box), nproc=nproc, progress=True, upper=d, lower=lower_limit)
+
+
+def angles_ld(arr, counts, i, j, box=None, normal=[0, 0, 1]):
     """
     :param arr: array of positions
-    :param indices: indices of nearest neighbors (output from nearest_neighbors function)
+    :param counts: number of neighbor pairs at each frame (output from nearest_neighbors function)
+    :param i: index of each point with a neighbor (output from nearest_neighbors function)
+    :param j: index of each neighbor (output from nearest_neighbors function)
+    :param box: box vectors at each frame. If given, minimum image vectors between neighbors are used
+    :param normal: vector normal to the plane with respect to which angles are measured
     :return: a distribution of angles and linear distances between nearest neighbors. Angles are w.r.t the plane
     perpendicular to normal. Default is the xy plane
     """
 
-    nT = arr.shape[0]
-    npts = arr.shape[1]
-    angles = []
-    ld = []
+    frames = np.repeat(np.arange(arr.shape[0]), counts)
+
+    v = arr[frames, i, :] - arr[frames, j, :]
+    if box is not None:
+        v = physical.minimum_image_distance(v[:, np.newaxis, :], box[frames, ...])[:, 0, :]
 
-    print('Calculating angles between nearest neigbors')
-    for t in tqdm.tqdm(list(range(nT))):
-        for i in range(npts):
-            # for j in range(len(indices[i])):
-            for j in indices[t][i]:
-                v = arr[t, i, :] - arr[t, j, :]
-                vn = np.dot(v, normal)
-                nn = np.linalg.norm(normal)
-                vv = np.linalg.norm(v)
-                angle = np.arcsin(old_div(vn, (nn * vv))) * (old_div(180, np.pi))
-                angles.append(angle)
-                ld.append(vv)
+    vv = np.linalg.norm(v, axis=1)
+    angles = np.arcsin(np.dot(v, normal) / (np.linalg.norm(normal) * vv)) * (180 / np.pi)
 
-    return angles, ld
+    return angles, vv
 
 
 def cn(n, T, bin_locations):
@@ -165,25 +159,27 @@ if __name__ == "__main__":
 
         keep = [a.index for a in t.topology.atoms if a.name in all_atoms]
         tails = t.atom_slice(keep).xyz
+        box = t.unitcell_vectors
         if not args.all:
             centroids = tail_centroid(tails, grps)
-            nlist = nearest_neighbors(centroids, args.cutoff)
-            angles, ld = angles_ld(centroids, nlist)
-            np.savez_compressed('angles_ld_%s.npz' % args.suffix, angles=angles, ld=ld, nlist=nlist, centroids=centroids)
+            counts, i, j = nearest_neighbors(centroids, args.cutoff, box=box, nproc=args.nproc)
+            angles, ld = angles_ld(centroids, counts, i, j, box=box)
+            np.savez_compressed('angles_ld_%s.npz' % args.suffix, angles=angles, ld=ld, counts=counts, i=i, j=j,
+                                centroids=centroids)
         else:
-            nlist = nearest_neighbors(tails, args.cutoff)
-            angles, ld = angles_ld(tails, nlist)
-            np.savez_compressed('angles_ld_%s.npz' % args.suffix, angles=angles, ld=ld, nlist=nlist)
+            counts, i, j = nearest_neighbors(tails, args.cutoff, box=box, nproc=args.nproc)
+            angles, ld = angles_ld(tails, counts, i, j, box=box)
+            np.savez_compressed('angles_ld_%s.npz' % args.suffix, angles=angles, ld=ld, counts=counts, i=i, j=j)
 
     else:
         print("Loading saved arrays")
         arrays = np.load('angles_ld_%s.npz' % args.suffix, encoding='bytes')
         angles = arrays['angles']
         centroids = arrays['centroids']
-        atoms_per_frame = int(angles.shape[0] / centroids.shape[0])
-        angles = angles[args.start * atoms_per_frame:args.end * atoms_per_frame]
+        counts = arrays['counts']
+        offsets = np.cumsum(counts) - counts  # index of the first pair of each frame
+        angles = angles[offsets[args.start]:offsets[args.end]]
         ld = arrays['ld']
-        nlist = arrays['nlist']
 
     if args.write_gro:
         file_rw.write_gro_pos(centroids[-1, :, :], 'centroids.gro', name='NA')
@@ -17,6 +17,7 @@ import math
 import matplotlib.pyplot as plt
 from matplotlib import animation
 import tqdm
+from llcsim.llclib import bootstrap as resample
 
 
 def initialize():
@@ -98,17 +99,19 @@ def angles(pos, atoms, normal=[0, 0, 1]):
     return w
 
 
-def bootstrap(angles, nboot):
+def bootstrap(angles, nboot, seed=None):
+    """ Resample tilt angles with replacement
+
+    :param angles: tilt angles
+    :param nboot: number of bootstrap trials
+    :param seed: random seed
+
+    :return: resampled angles (nboot, angles.size)
+    """
 
     angles = angles.flatten()
-    bootstrap = np.zeros([nboot, angles.size])
-    print('Boostrapping...', end='\r', flush=True)
-    for i in tqdm.tqdm(range(nboot)):
-        indices = np.random.randint(0, angles.size)
-        bootstrap[i, :] = angles[indices]
-    print('Done!')
-
-    return bootstrap
+
+    return angles[resample.indices(angles.size, nboot, seed=seed)]
 
 
 if __name__ == "__main__":
@@ -3,12 +3,12 @@
 import argparse
 import os
 import numpy as np
-import mdtraj as md
 import matplotlib.pyplot as plt
+from llcsim.llclib import timeseries, topology, trajectory
 
 """
-Calculate the distribution of torsions for a given type of dihedral. Improper dihedrals not implemented! They shouldn't
-be moving anyways.
+Calculate the distribution of torsions for a given type of dihedral, or for every type of dihedral in a residue (--all).
+Improper dihedrals not implemented! They shouldn't be moving anyways.
 """
 
 
@@ -28,6 +28,18 @@ def initialize():
                                                                          'it appears in the .gro file')
     parser.add_argument('-exclude', nargs='+', help='Names of atoms to exclude. If that atom appears in a dihedral,'
                                                     'then that dihedral will not be calculated')
+    parser.add_argument('--all', action="store_true", help='Analyze every type of proper dihedral in the residue '
+                                                           'instead of only the type given by -d')
+    parser.add_argument('-b', '--begin', default=0, type=int, help='Start frame')
+    parser.add_argument('-e', '--end', default=None, type=int, help='Last frame. By default, all frames are used')
+    parser.add_argument('-skip', default=1, type=int, help='Include every skip frames in calculation')
+    parser.add_argument('-bins', default=100, type=int, help='Number of histogram bins between -180 and 180 degrees')
+    parser.add_argument('-ff', '--forcefield', default='gaff', type=str, help='Force field whose dihedral potentials '
+                                                                              'are plotted over the distributions')
+    parser.add_argument('-m', '--mode', default='cos', type=str, help="Quantity whose autocorrelation is calculated: "
+                        "'angle', 'cos' or 'vector' (the unit vector (cos, sin))")
+    parser.add_argument('-nt', '--nthreads', default=1, type=int, help='Number of threads used by the FFTs')
+    parser.add_argument('--noshow', action="store_true", help='Do not show plots at end')
 
     args = parser.parse_args()
 
@@ -38,23 +50,21 @@ script_location = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__f
 
 
 def load_topology(top):
+    """ Parse the topology of a monomer, looking first in the current directory and then in llcsim/top/topologies
 
-    try:
-        f = open('%s' % top, 'r')
-    except FileNotFoundError:
-        try:
-            f = open('%s/../top/topologies/%s' % (script_location, top), 'r')
-        except FileNotFoundError:
-            print('No topology %s found' % top)
-            exit()
+    :param top: name of .itp file
 
-    monomer_topology = []
-    for line in f:
-        monomer_topology.append(line)
+    :type top: str
 
-    f.close()
+    :return: llcsim.llclib.topology.Itp object
+    """
+
+    for f in [top, '%s/../top/topologies/%s' % (script_location, top)]:
+        if os.path.isfile(f):
+            return topology.read_itp(f)
 
-    return monomer_topology
+    print('No topology %s found' % top)
+    exit()
 
 
 def calculate_dihedral(pos, indices):
@@ -73,8 +83,6 @@ def calculate_dihedral(pos, indices):
     :return: angles of all dihedrals at all frames
     """
 
-    nframes = pos.shape[0]
-
     b1 = pos[:, indices[:, 1], :] - pos[:, indices[:, 0], :]  # vector from atom1 to atom2 for all dihedrals + frames
     b2 = pos[:, indices[:, 2], :] - pos[:, indices[:, 1], :]  # vector from atom2 to atom3 for all dihedrals + frames
     b3 = pos[:, indices[:, 3], :] - pos[:, indices[:, 2], :]  # vector from atom3 to atom4 for all dihedrals + frames
@@ -84,24 +92,14 @@ def calculate_dihedral(pos, indices):
     n2 = np.cross(b2, b3)
 
     # normalize
-    for t in range(nframes):
-        n1[t, :, :] /= np.linalg.norm(n1[t, :, :], axis=1)[:, None]
-        n2[t, :, :] /= np.linalg.norm(n2[t, :, :], axis=1)[:, None]
-        b2[t, :, :] /= np.linalg.norm(b2[t, :, :], axis=1)[:, None]
+    n1 /= np.linalg.norm(n1, axis=2)[..., np.newaxis]
+    n2 /= np.linalg.norm(n2, axis=2)[..., np.newaxis]
+    b2 /= np.linalg.norm(b2, axis=2)[..., np.newaxis]
 
     m1 = np.cross(n1, b2)
 
-    # dot product of n1 and n2. faster than np.dot since you have to do it one vector at a time that way
-    x = np.zeros([nframes, indices.shape[0]])
-    x += n1[:, :, 0] * n2[:, :, 0]
-    x += n1[:, :, 1] * n2[:, :, 1]
-    x += n1[:, :, 2] * n2[:, :, 2]
-
-    # dot product of m1 and n2
-    y = np.zeros([nframes, indices.shape[0]])
-    y += m1[:, :, 0] * n2[:, :, 0]
-    y += m1[:, :, 1] * n2[:, :, 1]
-    y += m1[:, :, 2] * n2[:, :, 2]
+    x = np.einsum('ijk,ijk->ij', n1, n2)  # dot product of n1 and n2 for every dihedral at every frame
+    y = np.einsum('ijk,ijk->ij', m1, n2)  # dot product of m1 and n2
 
     return np.arctan2(y, x) * (180 / np.pi)  # convert to degrees
 
@@ -117,15 +115,12 @@ def ryckaert_belleman(theta, C, mode='degree', normalize=False):
     :return: potential energy, float
     """
 
-    theta = np.copy(theta)  # need to make a copy or it will modify input array globally
+    theta = np.array(theta, dtype=float)  # need to make a copy or it will modify input array globally
 
     if mode == 'degree':
         theta *= (np.pi / 180)
 
-    V = np.zeros_like(theta)
-    for i in range(theta.shape[0]):
-        for j in range(6):
-            V[i] += C[j] * np.cos(theta[i] - np.pi) ** j
+    V = np.polynomial.polynomial.polyval(np.cos(theta - np.pi), C)  # sum of C[j] * cos(theta - pi) ** j
 
     if normalize:
         V /= np.amax(V)
@@ -133,6 +128,49 @@ def ryckaert_belleman(theta, C, mode='degree', normalize=False):
     return V
 
 
+def rb_parameters(dihedral_type, ff='gaff'):
+    """ Look up the ryckaert-belleman parameters of a dihedral type in a force field's ffbonded.itp
+
+    :param dihedral_type: atom types making up the dihedral, in either order
+    :param ff: name of force field, as it appears in llcsim/top/Forcefields
+
+    :type dihedral_type: list or tuple
+    :type ff: str
+
+    :return: list of form [C0, C1, C2, C3, C4, C5], or None if the dihedral type is not parameterized
+    """
+
+    dihedral_type = list(dihedral_type)
+
+    section = None
+    with open('%s/../top/Forcefields/%s/ffbonded.itp' % (script_location, ff), 'r') as f:
+        for line in f:
+            line = line.split(';')[0].strip()
+            if line.startswith('['):
+                section = line.strip('[] ')
+            elif section == 'dihedraltypes' and line:
+                data = line.split()
+                if len(data) > 10 and data[4] == '3' and (data[:4] == dihedral_type or data[3::-1] == dihedral_type):
+                    return [float(x) for x in data[5:11]]
+
+    return None
+
+
+def canonical_type(dihedral_type):
+    """ A dihedral type is the same read forwards or backwards. Choose one order so that types can be compared
+
+    :param dihedral_type: atom types making up a dihedral, in order of connectivity
+
+    :type dihedral_type: list or tuple
+
+    :return: tuple of atom types
+    """
+
+    dihedral_type = tuple(str(x) for x in dihedral_type)
+
+    return min(dihedral_type, dihedral_type[::-1])
+
+
 def largest_prime_factor(n):
     i = 2
     while i * i <= n:
@@ -177,179 +215,177 @@ def autocorrelation_slow(d):
 
 class Dihedral(object):
 
-    def __init__(self, gro, traj, top, d, resname, exclusions=[]):
-        """
+    def __init__(self, gro, traj, top, d, resname, exclusions=None, begin=0, end=None, skip=1, bins=100, chunk=100):
+        """ Calculate the angles of every dihedral of one or more types in all residues, streaming the trajectory a
+        block of frames at a time. A histogram of each dihedral type over the full circle is accumulated as blocks are
+        read.
+
         :param gro: coordinate file (GROMACS .gro format)
         :param traj: trajectory file (GROMACS .trr or .xtc)
         :param top: name of topology file (GROMACS top format). File should be stored in directory where this script
         is located or with all other monomer topologies.
-        :param d: names of atoms, in order of connectivity, that define the dihedral/torsion of interest
+        :param d: names of atoms, in order of connectivity, that define the dihedral/torsion of interest. If None,
+        every type of proper dihedral in the residue is analyzed
+        :param resname: name of residue that the dihedrals are a part of
         :param exclusion: list of atoms to be excluded in dihedral calculations. If that atom is present in exclusions,
         any dihedrals that is a part of will not be counted.
+        :param begin: first frame to analyze
+        :param end: last frame to analyze (python slice convention). None includes the final frame
+        :param skip: analyze every skip frames
+        :param bins: number of histogram bins spanning -180 to 180 degrees
+        :param chunk: number of frames read from the trajectory at once
         """
 
-        print('Loading trajectory...', end='', flush=True)
-        t = md.load(traj, top=gro)
-        print('Done!')
+        monomer = load_topology(top)
+        types = dict(zip(monomer.names, monomer.types))  # atom names with corresponding type
+
+        dihedrals = monomer.dihedrals[~monomer.impropers]  # improper dihedrals shouldn't be moving anyways
+
+        if exclusions:  # drop dihedrals that contain an excluded atom
+            dihedrals = dihedrals[~np.isin(monomer.names[dihedrals], exclusions).any(axis=1)]
+
+        dtypes = [canonical_type(monomer.types[dihedral]) for dihedral in dihedrals]
+
+        if d is None:
+            self.dihedral_types = list(dict.fromkeys(dtypes))  # every type, in order of first appearance
+        else:
+            self.dihedral_types = [canonical_type([types[name] for name in d])]  # we want all dihedrals of this type
+
+        self.type_index = np.array([self.dihedral_types.index(x) if x in self.dihedral_types else -1 for x in dtypes],
+                                   dtype=int)
+        self.dihedrals = dihedrals[self.type_index != -1]
+        self.type_index = self.type_index[self.type_index != -1]
+
+        self.ndihedrals = self.dihedrals.shape[0]  # number of dihedrals to analyze
+        self.ntypes = len(self.dihedral_types)
+
+        for i, dtype in enumerate(self.dihedral_types):
+            print('Dihedral Type: %s (%d per residue)' % ('--'.join(dtype), np.sum(self.type_index == i)))
+
+        source = trajectory.Source(traj, gro, begin=begin, end=end, skip=skip, chunk=chunk)
+
+        # index of first atom of each residue
+        residue_atoms = [a.index for a in source.topology.atoms if a.residue.name == resname]
+        first = np.array(residue_atoms[::monomer.natoms], dtype=int)
+        self.nres = first.size
+
+        # atom indices of every dihedral in every residue. Column i * nres + j is dihedral i of residue j
+        indices = (self.dihedrals[:, np.newaxis, :] + first[np.newaxis, :, np.newaxis]).reshape(-1, 4)
+        self.column_type = np.repeat(self.type_index, self.nres)
+
+        atoms, local = np.unique(indices, return_inverse=True)  # only read atoms that are part of a dihedral
+        local = local.reshape(-1, 4)
+
+        self.bin_edges = np.linspace(-180, 180, bins + 1)
+        self.histograms = np.zeros([self.ntypes, bins], dtype=int)
+
+        def block_angles(block):
+
+            angles = calculate_dihedral(block.xyz, local)
+
+            b = np.minimum(((angles + 180) * (bins / 360)).astype(int), bins - 1)
+            bin_index = self.column_type[np.newaxis, :] * bins + b
+            self.histograms += np.bincount(bin_index.ravel(), minlength=self.ntypes * bins).reshape(self.ntypes, bins)
+
+            return angles, block.time
+
+        print('Calculating dihedral angles')
+        self.angles, self.time = source.gather(block_angles, atom_indices=atoms, progress=True)  # (nframes, ncolumns)
+
+        # [ndihedrals, nframes, nres]. weird way to set this up but oh well
+        self.all_dihedral_angles = self.angles.reshape(-1, self.ndihedrals, self.nres).transpose(1, 0, 2)
 
-        self.pos = t.xyz
-        self.time = t.time
         self.autocorr_fxn = None
 
-        monomer_topology = load_topology(top)
-
-        atoms_index = 0
-        while monomer_topology[atoms_index].count('[ atoms ]') == 0:
-            atoms_index += 1
-
-        atoms_index += 2  # skip over directive and line of comments (this can be made smarter if necessary)
-
-        types = {}  # atom names with corresponding type
-        names = {}  # atom numbers (starting at one) with corresponding names
-        natoms_residue = 0  # number of atoms in the residue
-        while monomer_topology[atoms_index] != '\n':
-            linedata = monomer_topology[atoms_index].split()
-            types[linedata[4]] = linedata[1]
-            names[linedata[0]] = linedata[4]
-            atoms_index += 1
-            natoms_residue += 1
-
-        self.dihedral_type = [types[d[0]], types[d[1]], types[d[2]], types[d[3]]]  # we want all dihedrals of this type
-        print('Dihedral Type: %s--%s--%s--%s' % (self.dihedral_type[0], self.dihedral_type[1], self.dihedral_type[2],
-                                                 self.dihedral_type[3]))
-
-        excluded_atom_numbers = []
-        if exclusions:
-            for number, name in names.items():
-                if name in exclusions:
-                    excluded_atom_numbers.append(number)
-
-        # read all the dihedrals
-        dihedrals_index = 0
-        while monomer_topology[dihedrals_index].count('[ dihedrals ]') == 0:
-            dihedrals_index += 1
-
-        dihedrals_index += 2  # skip over directive and line of comments (this can be made smarter if necessary)
-
-        dihedrals = []
-        while monomer_topology[dihedrals_index] != '\n':
-            dihedral = monomer_topology[dihedrals_index].split()[:4]
-            dtype = [types[names[dihedral[i]]] for i in range(4)]
-            if dtype == self.dihedral_type or dtype[::-1] == self.dihedral_type:
-                # print(dihedral)
-                # print(set(dihedral).isdisjoint(exclusions))
-                if set(dihedral).isdisjoint(excluded_atom_numbers):  # check that the dihedrals do not contain an excluded atom
-                    dihedral = np.array([int(x) for x in dihedral])
-                    dihedrals.append(dihedral - 1)  # convert from serial to indices by subtracting 1
-            dihedrals_index += 1
-
-        self.ndihedrals = len(dihedrals)  # number of dihedrals to analyze
-
-        res = [a.residue.name for a in t.topology.atoms]
-        nres = res.count(resname) // natoms_residue
-
-        self.all_dihedral_angles = np.zeros([self.ndihedrals, t.n_frames, nres])  # weird way to set this up but oh well
-
-        for i in range(self.ndihedrals):
-            indices = np.zeros([nres, 4], dtype=int)
-            for j in range(nres):
-                indices[j, :] = dihedrals[i]*(j + 1)
-            self.all_dihedral_angles[i, ...] = calculate_dihedral(self.pos, indices)
-
-    def plot_histogram(self, bins=100, rb=False, ff='gaff', save=False, out='Dihedral.png', show=False):
-
-        hist, bin_edges = np.histogram(self.all_dihedral_angles, bins=bins)
-        bin_width = bin_edges[1] - bin_edges[0]
-        bin_centers = np.array([bin_edges[i] + bin_width / 2 for i in range(len(bin_edges) - 1)])
-        hist = hist / np.amax(hist)  # hist /= np.amax(hist) doesn't work
+    def plot_histogram(self, dihedral=0, rb=False, ff='gaff', save=False, out='Dihedral', show=False):
+        """ Plot the distribution of angles of one dihedral type
 
-        if rb:
+        :param dihedral: index of dihedral type in self.dihedral_types
+        :param rb: plot the ryckaert-belleman dihedral potential on top of the distribution
+        :param ff: name of force field from which dihedral parameters are read
+        :param save: save the figure as out.png
+        :param out: name of output figure, without extension
+        :param show: show the figure
+        """
 
-            forcefield = []
-            with open('%s/../top/Forcefields/%s/ffbonded.itp' % (script_location, ff), 'r') as f:
-                for line in f:
-                    forcefield.append(line)
+        hist = self.histograms[dihedral, :]
+        bin_width = self.bin_edges[1] - self.bin_edges[0]
+        bin_centers = self.bin_edges[:-1] + bin_width / 2
+        hist = hist / np.amax(hist)  # hist /= np.amax(hist) doesn't work
+
+        dihedral_type = self.dihedral_types[dihedral]
 
-            dihedral_parameter_index = 0
-            while forcefield[dihedral_parameter_index].count('[ dihedraltypes ]') == 0:
-                dihedral_parameter_index += 1
+        plt.figure()
 
-            dihedral_parameter_index += 2
-            d = forcefield[dihedral_parameter_index].split()[:4]
-            while d != self.dihedral_type and d[::-1] != self.dihedral_type:
-                dihedral_parameter_index += 1
-                d = forcefield[dihedral_parameter_index].split()[:4]
-                if dihedral_parameter_index == len(forcefield) - 1:
-                    print('Parameter not found >:(')
-                    exit()
+        if rb:
 
-            C = [float(x) for x in forcefield[dihedral_parameter_index].split()[5:]]
+            C = rb_parameters(dihedral_type, ff=ff)
 
-            plt.plot(bin_centers, ryckaert_belleman(bin_centers, C, mode='degree', normalize=True), '--', color='black',
-                     label='Dihedral Potential')
+            if C is None:
+                print('Parameters for %s not found >:(' % '--'.join(dihedral_type))
+            else:
+                plt.plot(bin_centers, ryckaert_belleman(bin_centers, C, mode='degree', normalize=True), '--',
+                         color='black', label='Dihedral Potential')
 
         plt.bar(bin_centers, hist, bin_width)
-        plt.xlabel('Angle ($\degree$)', fontsize=14)
+        plt.xlabel('Angle ($\\degree$)', fontsize=14)
         plt.ylabel('Count', fontsize=14)
-        plt.title('Dihedral Type: %s--%s--%s--%s' % (self.dihedral_type[0], self.dihedral_type[1], self.dihedral_type[2],
-                                                     self.dihedral_type[3]))
+        plt.title('Dihedral Type: %s' % '--'.join(dihedral_type))
         plt.tight_layout()
         if save:
             plt.savefig('%s.png' % out)
         if show:
             plt.show()
 
-    def autocorrelation(self, largest_prime=500, cos=False):
-        """ FFT based autocorrelation function, which is faster than numpy.correlate. Efficiency is key in order to avoid
-        headaches.
-        :param largest_prime : the largest prime factor of array length allowed. The smaller the faster. 1.6M points takes
-        about 5 seconds with largest_prime=1000. Just be aware that you are losing data by truncating. But 5-6 data points
-        isn't a big deal for large arrays.
-        """
-
-        shape = self.all_dihedral_angles.shape
-        # np.reshape won't quite work how I need it to. This way is ~50x slower than reshape but still fast enough
-
-        dihedrals = np.zeros([shape[1], shape[0]*shape[2]])  # of size [nframes, ndihedrals]
-
-        for i in range(shape[0]):
-            dihedrals[:, i*shape[2]:(i+1)*shape[2]] = self.all_dihedral_angles[i, ...]
+    def autocorrelation(self, mode='cos', workers=1):
+        """ Autocorrelation function of each dihedral type, averaged over all dihedrals of that type. The time series of
+        every dihedral are transformed together with one batched FFT along the time axis (see timeseries.acf_batch)
 
-        if cos:
-            dihedrals *= (np.pi/180)
-            dihedrals = np.cos(dihedrals)
+        :param mode: 'angle' : autocorrelation of the dihedral angle
+                     'cos' : autocorrelation of the cosine of the dihedral angle
+                     'vector' : autocorrelation of the unit vector (cos, sin), which does not depend on where the
+                     angle wraps around at +/-180 degrees
+        :param workers: number of threads used by the FFTs
 
-        # Don't allow a prime factor larger than 'largest_prime'. Truncate data until that condition is met
-        l = 2 * dihedrals.shape[0] - 1
+        :type mode: str
+        :type workers: int
 
-        while largest_prime_factor(l) >= largest_prime or l % 2 == 0:
-            l -= 1
-
-        dihedrals = dihedrals[:(l + 1) // 2, :]
-        length = dihedrals.shape[0] * 2 - 1
+        :return: normalized autocorrelation function of each dihedral type (nframes, ntypes)
+        """
 
-        dihedrals -= np.mean(dihedrals, axis=0)
+        theta = np.asarray(self.angles, dtype=float) * (np.pi / 180)
 
-        fftx = np.fft.fft(dihedrals, n=length, axis=0)
-        ret = np.fft.ifft(fftx * np.conjugate(fftx), axis=0)
-        ret = np.fft.fftshift(ret, axes=(0,))
+        if mode == 'angle':
+            C = timeseries.acf_batch(self.angles, workers=workers)
+        elif mode == 'cos':
+            C = timeseries.acf_batch(np.cos(theta), workers=workers)
+        elif mode == 'vector':
+            cov = timeseries.acf_batch(np.stack((np.cos(theta), np.sin(theta)), axis=1), normalize=False,
+                                       workers=workers)
+            C = cov.sum(axis=1) / cov[0, ...].sum(axis=0)  # lag 0 autocovariance is the variance
+        else:
+            raise ValueError("Autocorrelation mode must be 'angle', 'cos' or 'vector', not '%s'" % mode)
 
-        self.autocorr_fxn = ret[length // 2:].real
-        self.autocorr_fxn /= np.arange(dihedrals.shape[0], 0, -1)[:, None]
-        self.autocorr_fxn /= np.var(dihedrals, axis=0)
+        # average over all dihedrals of each type
+        weights = np.zeros([self.column_type.size, self.ntypes])
+        weights[np.arange(self.column_type.size), self.column_type] = 1
+        weights /= weights.sum(axis=0)
 
-        self.autocorr_fxn = np.mean(self.autocorr_fxn, axis=1)
+        self.autocorr_fxn = C @ weights
 
         return self.autocorr_fxn  # normalized
 
     def plot_autocorrelation(self, show=False, save=True, savename='dihedral_autocorrelation'):
 
         plt.figure()
-        plt.plot(self.time/1000, self.autocorr_fxn, linewidth=3)
+        for i, dihedral_type in enumerate(self.dihedral_types):
+            plt.plot(self.time/1000, self.autocorr_fxn[:, i], linewidth=3, label='--'.join(dihedral_type))
         #plt.plot([self.time[0]/1000, self.time[-1]/1000], [0, 0], '--', color='black')
         plt.xlabel('Time (ns)', fontsize=18)
         plt.ylabel('Autocorrelation', fontsize=18)
         plt.gcf().get_axes()[0].tick_params(labelsize=18)
+        if self.ntypes > 1:
+            plt.legend()
         plt.tight_layout()
         if save:
             plt.savefig('%s.pdf' % savename)
@@ -361,7 +397,16 @@ if __name__ == "__main__":
 
     args = initialize()
 
-    dihedrals = Dihedral(args.gro, args.traj, args.topology, args.dihedral, args.residue, exclusions=args.exclude)
-    dihedrals.plot_histogram(rb=True, save=True, show=True)
-    dihedrals.autocorrelation(cos=True)
-    dihedrals.plot_autocorrelation(show=True)
+    d = None if args.all else args.dihedral
+
+    dihedrals = Dihedral(args.gro, args.traj, args.topology, d, args.residue, exclusions=args.exclude,
+                         begin=args.begin, end=args.end, skip=args.skip, bins=args.bins)
+
+    for i, dihedral_type in enumerate(dihedrals.dihedral_types):
+        dihedrals.plot_histogram(i, rb=True, ff=args.forcefield, save=True, out='dihedral_%s' % '-'.join(dihedral_type))
+
+    dihedrals.autocorrelation(mode=args.mode, workers=args.nthreads)
+    dihedrals.plot_autocorrelation(save=True)
+
+    if not args.noshow:
+        plt.show()
@@ -4,6 +4,7 @@ import argparse
 import mdtraj as md
 from llcsim.setup.place_solutes import trace_pores
 from llcsim.analysis import Atom_props, p2p
+from llcsim.llclib import cache, bootstrap
 import numpy as np
 import matplotlib.pyplot as plt
 import tqdm
@@ -24,6 +25,9 @@ def initialize():
     parser.add_argument('-begin', default=0, type=int, help='First frame to read')
     parser.add_argument('-end', default=-1, type=int, help='Last frame to read')
     parser.add_argument('-skip', default=1, type=int, help='Skip every n frames')
+    parser.add_argument('-nproc', '--nproc', default=1, type=int, help='Number of processes to split frames between')
+    parser.add_argument('--no_cache', action="store_true", help='Do not load or store pore centers in the on-disk '
+                                                               'cache')
 
     # define system
     parser.add_argument('-p', '--pore_atoms', nargs='+', default=['C', 'C1', 'C2', 'C3', 'C4', 'C5'], help='Atoms that'
@@ -44,6 +48,7 @@ def initialize():
     parser.add_argument('--load', action="store_true")
     parser.add_argument('--save', action="store_true")
     parser.add_argument('-boot', '--nboot', default=200, type=int, help='Number of bootstrap trials')
+    parser.add_argument('--seed', type=int, help='Random seed used for bootstrapping')
     parser.add_argument('--single_frame', action='store_true', help='Specify this flag in order to analyze a single'
                                                                     '.gro file. No statistics will be generated')
     parser.add_argument('--tcl', action='store_true', help='Create .tcl file that create representation of water within'
@@ -136,40 +141,23 @@ def water_content(pos, ref_pos, r, write=False):
         return n
 
 
-def bootstrap(data, tau, nboot):
+def block_bootstrap(data, tau, nboot, seed=None):
     """
     :param data: equilibrated data from a timeseries
     :param tau: autocorrelation time (number of points in timeseries between uncorrelated samples)
     :param nboot: number of bootstrap trials
+    :param seed: random seed
     :return: average and standard deviation
     """
 
-    tau = int(tau)
-    nsub = data.shape[0] // tau  # number of uncorrelated subtrajectories to break data into
-
-    # divide data into independent subtrajectories
-    subtrajectories = np.zeros([nsub, tau])
-    for i in range(nsub):
-        if i == 0:
-            subtrajectories[i, :] = data[-tau:]
-        else:
-            subtrajectories[i, :] = data[-(i+1)*tau:-i*tau]
-
-    choices = np.linspace(0, tau - 1, tau, dtype=int)  # indices of each subtrajectory
-    boot = np.zeros([nboot])
-    for b in range(nboot):
-        trial = np.zeros([nsub])  # the statistic will be the average of each independent subtrajectory
-        for s in range(nsub):
-            ndx = np.random.choice(choices, size=tau, replace=True)
-            trial[s] = np.mean(subtrajectories[s, choices])
-        boot[b] = np.mean(trial)
+    boot = bootstrap.block_means(data, nboot, block=tau, seed=seed)  # resample independent subtrajectories
 
     return np.mean(boot), np.std(boot)
 
 
 class System(object):
 
-    def __init__(self, gro, pore_atoms, residue, traj=False, begin=0, end=-1, skip=1):
+    def __init__(self, gro, pore_atoms, residue, traj=False, begin=0, end=-1, skip=1, nproc=1, use_cache=True):
         """ Define the system and boundaries for pore and tail region
 
         :param gro: coordinate file
@@ -178,6 +166,9 @@ class System(object):
         :param begin: first frame to include
         :param end: last frame to include
         :param skip: skip every n frames
+        :param nproc: number of processes to split frames between when locating pores
+        :param use_cache: load pore centers from the on-disk cache if they were already calculated for this trajectory,
+        and store them there otherwise
         """
 
         print('Loading trajectory...', flush=True, end='')
@@ -197,14 +188,17 @@ class System(object):
 
         # find pore centers
         pore_atoms = [a.index for a in self.t.topology.atoms if a.name in pore_atoms]
-        self.pore_centers = p2p.avg_pore_loc(4, self.pos[:, pore_atoms, :])
+        self.pore_centers = cache.fetch('p2p_pore_centers', lambda: p2p.avg_pore_loc(4, self.pos[:, pore_atoms, :],
+                                        nproc=nproc), traj if traj else gro, use_cache=use_cache,
+                                        selection=pore_atoms, frames=(begin, end, skip), npores=4)
 
 
 if __name__ == "__main__":
 
     args = initialize()
 
-    sys = System(args.gro, args.pore_atoms, traj=args.traj, begin=args.begin, end=args.end, skip=args.skip)
+    sys = System(args.gro, args.pore_atoms, traj=args.traj, begin=args.begin, end=args.end, skip=args.skip,
+                 nproc=args.nproc, use_cache=not args.no_cache)
 
     # print('Loading trajectory...', flush=True, end='')
     # if args.single_frame:
@@ -302,8 +296,8 @@ if __name__ == "__main__":
         if (wt_tails.shape[0] - tails_equil) / tails_autocorrelation < 5:
             tails_autocorrelation = (wt_pores.shape[0] - tails_equil) // 5
 
-        mean_pores, std_pores = bootstrap(wt_pores[pore_equil:], pore_autocorrelation, args.nboot)
-        mean_tails, std_tails = bootstrap(wt_tails[tails_equil:], tails_autocorrelation, args.nboot)
+        mean_pores, std_pores = block_bootstrap(wt_pores[pore_equil:], pore_autocorrelation, args.nboot, args.seed)
+        mean_tails, std_tails = block_bootstrap(wt_tails[tails_equil:], tails_autocorrelation, args.nboot, args.seed)
 
         print('Pore water content: %2.2f +/- %2.2f' % (100*mean_pores, 100*std_pores))
         print('Tail water content: %2.2f +/- %2.2f' % (100*mean_tails, 100*std_tails))
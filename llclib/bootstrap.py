@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+"""
+Bootstrap estimates of uncertainty. All resamples of a bootstrap are drawn at once as an integer matrix of indices
+(one row per trial) from a seedable random number generator. Averages over each resample are then calculated with a
+matrix product between per-trial counts of how often each sample was drawn and the data, a block of trials at a time
+so that memory stays bounded for large numbers of trials.
+
+Correlated time series are handled with a block bootstrap: the series is cut into non-overlapping blocks at least as
+long as its statistical inefficiency (the number of frames between uncorrelated samples) and whole blocks are
+resampled.
+"""
+
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+from llcsim.llclib import timeseries
+
+
+def generator(seed=None):
+    """ Random number generator used for resampling
+
+    :param seed: seed, or an existing generator which is returned unchanged. None draws a fresh seed from the operating
+    system
+
+    :type seed: int or numpy.random.Generator
+
+    :return: numpy.random.Generator
+    """
+
+    if isinstance(seed, np.random.Generator):
+        return seed
+    else:
+        return np.random.default_rng(seed)
+
+
+def indices(n, nboot, size=None, seed=None):
+    """ Draw the samples making up every bootstrap trial
+
+    :param n: number of samples to choose from
+    :param nboot: number of bootstrap trials
+    :param size: number of samples drawn per trial. Defaults to n
+    :param seed: random seed or generator (see generator())
+
+    :type n: int
+    :type nboot: int
+    :type size: int
+
+    :return: indices of samples drawn with replacement (nboot, size)
+    """
+
+    return generator(seed).integers(0, n, size=(nboot, n if size is None else size))
+
+
+def counts(ndx, n):
+    """ Count how many times each sample was drawn in each bootstrap trial
+
+    :param ndx: indices drawn in each trial (ntrials, size). See indices()
+    :param n: number of samples
+
+    :type ndx: numpy.ndarray
+    :type n: int
+
+    :return: counts (ntrials, n)
+    """
+
+    c = np.zeros([ndx.shape[0], n])
+    np.add.at(c, (np.arange(ndx.shape[0])[:, np.newaxis], ndx), 1)
+
+    return c
+
+
+def means(data, nboot, seed=None, chunk=1000):
+    """ Bootstrap the mean of data along its first axis
+
+    :param data: samples (n, ...). Each sample may itself be an array, e.g. an RDF or MSD curve
+    :param nboot: number of bootstrap trials
+    :param seed: random seed or generator (see generator())
+    :param chunk: number of trials calculated at once
+
+    :type data: numpy.ndarray
+    :type nboot: int
+    :type chunk: int
+
+    :return: mean of each resampled data set (nboot, ...)
+    """
+
+    data = np.asarray(data)
+    n = data.shape[0]
+    flat = data.reshape(n, -1)
+
+    ndx = indices(n, nboot, seed=seed)
+
+    boot = np.zeros([nboot, flat.shape[1]])
+    for start in range(0, nboot, chunk):
+        boot[start:start + chunk] = counts(ndx[start:start + chunk], n) @ flat / n
+
+    return boot.reshape((nboot,) + data.shape[1:])
+
+
+def statistical_inefficiency(x):
+    """ Number of frames between uncorrelated samples of a time series, g = 1 + 2 * sum_t (1 - t / N) * C(t), where the
+    sum over the normalized autocorrelation function, C(t), is truncated at its first non-positive value
+
+    :param x: time series
+
+    :type x: numpy.ndarray
+
+    :return: statistical inefficiency (>= 1)
+    """
+
+    x = np.array(x, dtype=float)
+
+    if x.size < 3 or np.var(x) == 0:
+        return 1.
+
+    C = timeseries.acf(x)
+    N = C.size
+
+    cut = np.nonzero(C[1:] <= 0)[0]
+    T = cut[0] + 1 if cut.size > 0 else N
+
+    t = np.arange(1, T)
+
+    return max(1., 1 + 2 * np.sum((1 - t / N) * C[1:T]))
+
+
+def blocks(data, block):
+    """ Split a time series into non-overlapping blocks and average each one. Blocks are counted back from the end of
+    the series so that any leftover frames are dropped from its (less equilibrated) beginning
+
+    :param data: time series (nframes, ...)
+    :param block: number of frames per block
+
+    :type data: numpy.ndarray
+    :type block: int
+
+    :return: average of each block (nblocks, ...)
+    """
+
+    data = np.asarray(data)
+    block = max(1, int(block))
+    nblocks = data.shape[0] // block
+
+    if nblocks == 0:
+        raise ValueError('Time series of %d frames is shorter than a single block of %d frames' %
+                         (data.shape[0], block))
+
+    kept = data[data.shape[0] - nblocks * block:]
+
+    return kept.reshape((nblocks, block) + data.shape[1:]).mean(axis=1)
+
+
+def block_means(data, nboot, block=None, seed=None, chunk=1000):
+    """ Block bootstrap of the mean of a correlated time series. Resampling whole blocks preserves the correlation
+    within them
+
+    :param data: time series (nframes, ...)
+    :param nboot: number of bootstrap trials
+    :param block: number of frames per block. If None, the ceiling of the statistical inefficiency of the series is
+    used (the largest one if data holds several series)
+    :param seed: random seed or generator (see generator())
+    :param chunk: number of trials calculated at once
+
+    :type data: numpy.ndarray
+    :type nboot: int
+    :type block: int
+    :type chunk: int
+
+    :return: mean of each resampled time series (nboot, ...)
+    """
+
+    data = np.asarray(data)
+
+    if block is None:
+        series = data.reshape(data.shape[0], -1)
+        block = int(np.ceil(max(statistical_inefficiency(series[:, i]) for i in range(series.shape[1]))))
+
+    return means(blocks(data, block), nboot, seed=seed, chunk=chunk)
+
+
+def errorbars(boot, center, confidence=95):
+    """ Distances from an estimate to the bounds of a bootstrapped confidence interval
+
+    :param boot: bootstrapped values of a quantity (nboot, ...)
+    :param center: estimate of the quantity, usually its value calculated from the full data set
+    :param confidence: percent confidence
+
+    :type boot: numpy.ndarray
+    :type center: numpy.ndarray or float
+    :type confidence: float
+
+    :return: lower and upper error bars (2, ...). Readily plotted with plt.errorbar
+    """
+
+    lower_confidence = (100 - confidence) / 2
+    upper_confidence = 100 - lower_confidence
+
+    return np.array([np.abs(np.percentile(boot, lower_confidence, axis=0) - center),
+                     np.abs(np.percentile(boot, upper_confidence, axis=0) - center)])
@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+
+"""
+Content-addressed on-disk cache for quantities derived from trajectories, such as pore centers, pore splines and
+centers of mass. Entries are keyed on a hash of the trajectory file's contents together with the atom selection,
+frame slice and parameters used to calculate them, so a later run on the same trajectory can skip the calculation.
+Arrays are stored as .npy files and loaded memory-mapped. When the cache grows past its size limit, the least
+recently used entries are deleted.
+
+The cache lives in ~/.cache/llcsim unless the LLCSIM_CACHE environment variable points elsewhere. Its size limit
+(in GB) can be set with LLCSIM_CACHE_SIZE. Run this file to list or clear entries.
+"""
+
+from __future__ import division
+from __future__ import print_function
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows. The index is then not protected from concurrent writers
+    fcntl = None
+
+default_root = os.path.join(os.path.expanduser('~'), '.cache', 'llcsim')
+default_size = 4  # GB
+
+
+def initialize():
+
+    parser = argparse.ArgumentParser(description='List or clear cached trajectory analysis results')
+
+    parser.add_argument('action', choices=['list', 'clear'], help='list entries or clear them')
+    parser.add_argument('keys', nargs='*', help='Keys (or unique beginnings of keys) of entries to clear. If none are '
+                                                'given, clear removes every entry')
+    parser.add_argument('-d', '--directory', default=None, help='Cache directory. Defaults to $LLCSIM_CACHE or '
+                                                                '%s' % default_root)
+
+    return parser
+
+
+def file_hash(filename, blocksize=2**20):
+    """ SHA-1 hash of the contents of a file
+
+    :param filename: name of file
+    :param blocksize: number of bytes read at a time
+
+    :type filename: str
+    :type blocksize: int
+
+    :return: hexadecimal digest
+    """
+
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def parameter_hash(value, sha):
+    """ Add a parameter to a running hash. Arrays are hashed by their contents so that selections of atom indices can
+    be used as parameters
+
+    :param value: parameter value (number, string, bool, None, list, tuple, dict or numpy.ndarray)
+    :param sha: running hash
+
+    :type sha: hashlib.sha1
+    """
+
+    if isinstance(value, np.ndarray) or (isinstance(value, (list, tuple)) and len(value) > 0 and
+                                         all(isinstance(v, (int, np.integer)) for v in value)):
+        value = np.asarray(value)
+        sha.update(('%s%s' % (value.dtype.str, value.shape)).encode())
+        sha.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        for k in sorted(value):
+            sha.update(repr(k).encode())
+            parameter_hash(value[k], sha)
+    elif isinstance(value, (list, tuple)):
+        sha.update(b'[')
+        for v in value:
+            parameter_hash(v, sha)
+        sha.update(b']')
+    elif isinstance(value, range):
+        sha.update(repr((value.start, value.stop, value.step)).encode())
+    else:
+        sha.update(repr(value).encode())
+
+
+class Cache(object):
+
+    def __init__(self, root=None, max_size=None):
+        """ Open (or create) a cache directory
+
+        :param root: directory where cached arrays are stored
+        :param max_size: largest total size of the cache in GB
+
+        :type root: str
+        :type max_size: float
+        """
+
+        if root is None:
+            root = os.environ.get('LLCSIM_CACHE', default_root)
+
+        if max_size is None:
+            max_size = float(os.environ.get('LLCSIM_CACHE_SIZE', default_size))
+
+        self.root = root
+        self.max_size = max_size * 1e9  # bytes
+        self.index_file = os.path.join(self.root, 'index.json')
+        self.lock_file = os.path.join(self.root, 'index.lock')
+        self._lock = None  # open lock file while this process holds the lock
+        self._lock_depth = 0
+
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """ Hold an exclusive lock on the cache index so that reading, updating and writing it is not interleaved with
+        other processes sharing the cache. The lock can be re-entered by the process holding it
+        """
+
+        if self._lock_depth == 0 and fcntl is not None:
+            self._lock = open(self.lock_file, 'a')
+            fcntl.flock(self._lock, fcntl.LOCK_EX)
+
+        self._lock_depth += 1
+
+        try:
+            yield
+        finally:
+            self._lock_depth -= 1
+            if self._lock_depth == 0 and self._lock is not None:
+                fcntl.flock(self._lock, fcntl.LOCK_UN)
+                self._lock.close()
+                self._lock = None
+
+    def _read_index(self):
+
+        if os.path.isfile(self.index_file):
+            with open(self.index_file, 'r') as f:
+                return json.load(f)
+        else:
+            return {'entries': {}, 'files': {}}
+
+    def _write_index(self, index):
+
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp, self.index_file)
+
+    def trajectory_hash(self, traj):
+        """ Hash of a trajectory file's contents. Hashes are remembered by path, size and modification time so that
+        large trajectories are only read once
+
+        :param traj: name of trajectory file
+
+        :type traj: str
+
+        :return: hexadecimal digest
+        """
+
+        path = os.path.abspath(traj)
+        stat = os.stat(path)
+
+        known = self._read_index()['files'].get(path)
+        if known is not None and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+            return known['hash']
+
+        digest = file_hash(path)  # hash outside of the lock. It can take a while
+
+        with self._locked():
+            index = self._read_index()
+            index['files'][path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': digest}
+            self._write_index(index)
+
+        return digest
+
+    def key(self, name, traj, **params):
+        """ Generate the key of a cache entry
+
+        :param name: name of the quantity being stored (e.g. 'pore_centers')
+        :param traj: trajectory file the quantity was calculated from
+        :param params: everything else the quantity depends on (atom selection, frame slice, parameters...)
+
+        :type name: str
+        :type traj: str
+
+        :return: key
+        """
+
+        sha = hashlib.sha1()
+        sha.update(name.encode())
+        sha.update(self.trajectory_hash(traj).encode())
+        parameter_hash(params, sha)
+
+        return '%s-%s' % (name, sha.hexdigest())
+
+    def load(self, key):
+        """ Load the arrays stored under a key
+
+        :param key: key of entry. See key()
+
+        :type key: str
+
+        :return: tuple of read-only memory-mapped arrays, or None if there is no such entry
+        """
+
+        with self._locked():
+
+            index = self._read_index()
+            if key not in index['entries']:
+                return None
+
+            entry = index['entries'][key]
+            location = os.path.join(self.root, key)
+
+            try:
+                arrays = tuple(np.load(os.path.join(location, 'arr_%d.npy' % i), mmap_mode='r')
+                               for i in range(entry['narrays']))
+            except (IOError, ValueError):  # entry was removed or damaged outside of this interface
+                self.clear([key])
+                return None
+
+            entry['last_used'] = time.time()
+            self._write_index(index)
+
+        return arrays
+
+    def store(self, key, arrays, description=''):
+        """ Store arrays under a key then evict the least recently used entries until the cache fits within its size
+        limit
+
+        :param key: key of entry. See key()
+        :param arrays: arrays to store
+        :param description: human-readable description shown by 'list'
+
+        :type key: str
+        :type arrays: tuple
+        :type description: str
+        """
+
+        size = sum(np.asarray(a).nbytes for a in arrays)
+        if size > self.max_size:
+            print('Not caching %s. It is larger than the cache size limit' % key)
+            return
+
+        # write to a temporary directory then move it into place so incomplete entries are never visible
+        tmp = tempfile.mkdtemp(dir=self.root)
+        for i, a in enumerate(arrays):
+            np.save(os.path.join(tmp, 'arr_%d.npy' % i), np.asarray(a))
+
+        with self._locked():
+
+            location = os.path.join(self.root, key)
+            if os.path.isdir(location):
+                shutil.rmtree(location)
+            os.rename(tmp, location)
+
+            index = self._read_index()
+            index['entries'][key] = {'narrays': len(arrays), 'size': size, 'created': time.time(),
+                                     'last_used': time.time(), 'description': description}
+
+            total = sum(e['size'] for e in index['entries'].values())
+            for old in sorted(index['entries'], key=lambda k: index['entries'][k]['last_used']):
+                if total <= self.max_size:
+                    break
+                if old != key:
+                    total -= index['entries'][old]['size']
+                    shutil.rmtree(os.path.join(self.root, old), ignore_errors=True)
+                    del index['entries'][old]
+
+            self._write_index(index)
+
+    def entries(self):
+        """ Information about every entry in the cache
+
+        :return: dict of dicts keyed by entry key, ordered from most to least recently used
+        """
+
+        entries = self._read_index()['entries']
+
+        return dict(sorted(entries.items(), key=lambda e: e[1]['last_used'], reverse=True))
+
+    def clear(self, keys=None):
+        """ Remove entries from the cache
+
+        :param keys: keys (or unique beginnings of keys) of entries to remove. If None, remove every entry
+
+        :type keys: list
+        """
+
+        with self._locked():
+
+            index = self._read_index()
+
+            if keys is None:
+                remove = list(index['entries'].keys())
+            else:
+                remove = []
+                for k in keys:
+                    matches = [e for e in index['entries'] if e.startswith(k)]
+                    if len(matches) != 1:
+                        print('%s does not match exactly one cache entry. Skipping' % k)
+                    else:
+                        remove += matches
+
+            for k in remove:
+                shutil.rmtree(os.path.join(self.root, k), ignore_errors=True)
+                del index['entries'][k]
+
+            self._write_index(index)
+
+    def fetch(self, name, compute, traj, description='', **params):
+        """ Load a quantity from the cache or calculate and store it if it is not there yet
+
+        :param name: name of the quantity being stored (e.g. 'pore_centers')
+        :param compute: function, taking no arguments, that calculates the quantity. It should return an array or a
+        tuple of arrays
+        :param traj: trajectory file the quantity is calculated from
+        :param description: human-readable description shown by 'list'
+        :param params: everything else the quantity depends on. See key()
+
+        :type name: str
+        :type compute: function
+        :type traj: str
+        :type description: str
+
+        :return: output of compute, either freshly calculated or memory-mapped from the cache
+        """
+
+        key = self.key(name, traj, **params)
+        arrays = self.load(key)
+
+        if arrays is not None:
+            print('Loaded %s from cache (%s)' % (name, key))
+        else:
+            result = compute()
+            arrays = result if isinstance(result, tuple) else (result,)
+            self.store(key, arrays, description=description or '%s of %s' % (name, os.path.basename(traj)))
+
+        return arrays if len(arrays) > 1 else arrays[0]
+
+
+def fetch(name, compute, traj, use_cache=True, **params):
+    """ Convenience wrapper around Cache.fetch that uses the default cache directory
+
+    :param name: name of the quantity being stored
+    :param compute: function, taking no arguments, that calculates the quantity
+    :param traj: trajectory file the quantity is calculated from
+    :param use_cache: if False, compute the quantity without touching the cache
+    :param params: everything else the quantity depends on
+
+    :type name: str
+    :type compute: function
+    :type traj: str
+    :type use_cache: bool
+
+    :return: output of compute
+    """
+
+    if not use_cache:
+        return compute()
+
+    return Cache().fetch(name, compute, traj, **params)
+
+
+if __name__ == "__main__":
+
+    args = initialize().parse_args()
+
+    cache = Cache(root=args.directory)
+
+    if args.action == 'list':
+
+        entries = cache.entries()
+        total = sum(e['size'] for e in entries.values())
+        print('%d entries using %.1f of %.1f MB in %s' % (len(entries), total / 1e6, cache.max_size / 1e6, cache.root))
+        for k, e in entries.items():
+            print('%-55s %10.1f MB  %s  %s' % (k, e['size'] / 1e6, time.strftime('%Y-%m-%d %H:%M',
+                                               time.localtime(e['last_used'])), e['description']))
+
+    elif args.action == 'clear':
+
+        cache.clear(args.keys if args.keys else None)
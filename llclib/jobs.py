@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+
+"""
+Run GROMACS (grompp, mdrun, energy, ...) as external jobs. Every job's stdout and stderr are captured in a log file,
+jobs can be given a timeout, and a Runner never has more than a fixed number of jobs running at once so that
+independent calculations (candidate solute placements, umbrella windows, ...) can be launched from a pool of threads.
+
+The backend that actually executes commands is pluggable. LocalBackend runs them with subprocess. FakeBackend only
+pretends to, writing the files that later steps of a pipeline expect (a .tpr, an output .gro and a .log file with a
+potential energy), so pipelines can be exercised on machines without GROMACS. Set the environment variable
+LLCSIM_GMX_BACKEND=fake to make fake the default.
+"""
+
+from __future__ import division
+from __future__ import print_function
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobError(Exception):
+    pass
+
+
+class Job(object):
+
+    def __init__(self, command, name=None, cwd=None, timeout=None, stdin=None):
+        """ A single command to run
+
+        :param command: command and its arguments
+        :param name: short name used to label the job's log file. Defaults to the name of the program being run
+        :param cwd: directory to run the command from. Defaults to the current working directory
+        :param timeout: seconds after which the job is killed. None means no limit
+        :param stdin: text passed to the command's standard input (e.g. group selections for gmx make_ndx)
+
+        :type command: list
+        :type name: str
+        :type cwd: str
+        :type timeout: float
+        :type stdin: str
+        """
+
+        self.command = [str(c) for c in command]
+        self.name = name if name is not None else os.path.basename(self.command[0])
+        self.cwd = cwd if cwd is not None else os.getcwd()
+        self.timeout = timeout
+        self.stdin = stdin
+
+        # filled in once the job has run
+        self.returncode = None
+        self.timed_out = False
+        self.log = None  # name of file holding the job's stdout and stderr
+        self.elapsed = 0
+
+    def __repr__(self):
+
+        return 'Job(%s)' % ' '.join(self.command)
+
+
+class LocalBackend(object):
+    """ Run jobs on this machine with subprocess """
+
+    def execute(self, job, log):
+        """ Run a job, writing its output to an open log file
+
+        :param job: job to run
+        :param log: file object to which stdout and stderr are written
+
+        :type job: Job
+
+        :return: return code of the job, or None if it was killed because it ran longer than its timeout
+        """
+
+        try:
+            p = subprocess.run(job.command, cwd=job.cwd, stdout=log, stderr=subprocess.STDOUT, timeout=job.timeout,
+                               input=job.stdin.encode() if job.stdin is not None else None)
+        except subprocess.TimeoutExpired:
+            return None
+
+        return p.returncode
+
+
+class FakeBackend(object):
+
+    def __init__(self, energy=-1e5, delay=0):
+        """ Stand-in for GROMACS. Records every command it is given and creates the files a successful run would
+
+        grompp remembers which configuration a .tpr was made from, mdrun copies that configuration to <deffnm>.gro and
+        writes <deffnm>.log containing a potential energy. Other commands do nothing.
+
+        :param energy: potential energy written to .log files. Can also be a function taking the Job and returning
+        the energy, e.g. to make some runs fail
+        :param delay: seconds each job takes
+
+        :type energy: float or function
+        :type delay: float
+        """
+
+        self.energy = energy
+        self.delay = delay
+        self.commands = []
+        self.lock = threading.Lock()
+
+    def execute(self, job, log):
+
+        with self.lock:
+            self.commands.append(job.command)
+
+        time.sleep(self.delay)
+
+        log.write(('fake: %s\n' % ' '.join(job.command)).encode())
+
+        args = job.command[job.command.index('grompp'):] if 'grompp' in job.command else \
+            job.command[job.command.index('mdrun'):] if 'mdrun' in job.command else []
+
+        def option(flag, default=None):
+            return args[args.index(flag) + 1] if flag in args else default
+
+        path = lambda f: os.path.join(job.cwd, f)
+
+        if args and args[0] == 'grompp':
+
+            tpr = option('-o', 'topol')
+            tpr = tpr if tpr.endswith('.tpr') else '%s.tpr' % tpr
+            with open(path(tpr), 'w') as f:
+                f.write(os.path.abspath(path(option('-c', 'conf.gro'))))
+
+        elif args and args[0] == 'mdrun':
+
+            deffnm = option('-deffnm', 'md')
+            with open(path('%s.tpr' % deffnm)) as f:
+                shutil.copyfile(f.read().strip(), path('%s.gro' % deffnm))
+
+            energy = self.energy(job) if callable(self.energy) else self.energy
+            with open(path('%s.log' % deffnm), 'w') as f:
+                f.write('   Energies (kJ/mol)\nPotential Energy  = %.5e\n' % energy)
+
+        return 0
+
+
+def default_backend():
+    """ Backend named by the LLCSIM_GMX_BACKEND environment variable ('local', the default, or 'fake')
+    """
+
+    name = os.environ.get('LLCSIM_GMX_BACKEND', 'local')
+
+    if name == 'local':
+        return LocalBackend()
+    elif name == 'fake':
+        return FakeBackend()
+    else:
+        raise ValueError("LLCSIM_GMX_BACKEND must be 'local' or 'fake', not '%s'" % name)
+
+
+def potential_energy(logname, default=None):
+    """ Read the final potential energy from a GROMACS .log file
+
+    :param logname: name of .log file
+    :param default: value returned if the file does not exist or contains no potential energy (e.g. because the run
+    crashed)
+
+    :type logname: str
+
+    :return: potential energy (kJ/mol)
+    """
+
+    nrg = default
+
+    if os.path.isfile(logname):
+        with open(logname) as f:
+            for line in f:
+                match = re.search(r'Potential Energy\s+=\s+(\S+)', line)
+                if match:
+                    try:
+                        nrg = float(match.group(1))
+                    except ValueError:
+                        pass
+
+    return nrg
+
+
+class Runner(object):
+
+    def __init__(self, max_jobs=1, mpi=False, nproc=4, timeout=None, logdir='gmx_logs', backend=None):
+        """ Launch GROMACS jobs with a limit on how many run at once
+
+        :param max_jobs: largest number of jobs allowed to run at the same time
+        :param mpi: run GROMACS through mpirun with gmx_mpi
+        :param nproc: number of MPI processes given to mdrun when mpi is True
+        :param timeout: default number of seconds after which a job is killed. None means no limit
+        :param logdir: directory, relative to each job's working directory, where job output is saved
+        :param backend: object with an execute(job, log) method. Defaults to default_backend()
+
+        :type max_jobs: int
+        :type mpi: bool
+        :type nproc: int
+        :type timeout: float
+        :type logdir: str
+        """
+
+        self.max_jobs = max(1, int(max_jobs))
+        self.mpi = mpi
+        self.nproc = nproc
+        self.timeout = timeout
+        self.logdir = logdir
+        self.backend = backend if backend is not None else default_backend()
+
+        self.slots = threading.BoundedSemaphore(self.max_jobs)
+        self.lock = threading.Lock()
+        self.count = 0  # number of jobs launched. Used to give log files unique names
+
+    def gmx(self, *args, **kwargs):
+        """ Build a GROMACS command
+
+        :param args: GROMACS subcommand and its arguments, e.g. 'grompp', '-f', 'em.mdp'
+        :param kwargs: nproc: number of MPI processes (default self.nproc for mdrun and 1 otherwise)
+
+        :return: command as a list
+        """
+
+        if self.mpi:
+            nproc = kwargs.get('nproc', self.nproc if args[0] == 'mdrun' else 1)
+            return ['mpirun', '-np', str(nproc), 'gmx_mpi'] + [str(a) for a in args]
+        else:
+            return ['gmx'] + [str(a) for a in args]
+
+    def run(self, job, check=False):
+        """ Run a job, waiting for a free slot if max_jobs jobs are already running
+
+        :param job: job to run
+        :param check: raise JobError if the job fails or times out
+
+        :type job: Job
+        :type check: bool
+
+        :return: the job, with its returncode, timed_out, log and elapsed attributes filled in
+        """
+
+        if job.timeout is None:
+            job.timeout = self.timeout
+
+        with self.lock:
+            self.count += 1
+            n = self.count
+
+        logdir = os.path.join(job.cwd, self.logdir)
+        os.makedirs(logdir, exist_ok=True)
+        job.log = os.path.join(logdir, '%04d_%s.out' % (n, re.sub(r'[^\w.-]', '_', job.name)))
+
+        with self.slots:
+            start = time.time()
+            with open(job.log, 'wb') as log:
+                job.returncode = self.backend.execute(job, log)
+            job.elapsed = time.time() - start
+
+        job.timed_out = job.returncode is None
+
+        if check and job.returncode != 0:
+            if job.timed_out:
+                raise JobError('%s timed out after %s seconds. See %s' % (job, job.timeout, job.log))
+            else:
+                raise JobError('%s failed with exit code %d. See %s' % (job, job.returncode, job.log))
+
+        return job
+
+    def grompp(self, mdp, top, config, out, restraints=None, index=None, cwd=None, check=False):
+        """ Generate a run input (.tpr) file
+
+        :param mdp: .mdp file
+        :param top: topology
+        :param config: input coordinates
+        :param out: name of output .tpr file (extension optional)
+        :param restraints: coordinate file used as reference for position restraints
+        :param index: index file
+        :param cwd: directory to run from. File names are relative to it
+        :param check: raise JobError if grompp fails
+
+        :return: finished Job
+        """
+
+        # each job writes its own processed .mdp so that concurrent grompp jobs in one directory don't collide
+        args = ['grompp', '-f', mdp, '-p', top, '-c', config, '-o', out, '-po',
+                '%s_mdout.mdp' % os.path.splitext(out)[0]]
+        if restraints is not None:
+            args += ['-r', restraints]
+        if index is not None:
+            args += ['-n', index]
+
+        return self.run(Job(self.gmx(*args), name='grompp_%s' % os.path.basename(out), cwd=cwd), check=check)
+
+    def mdrun(self, deffnm, cwd=None, verbose=False, check=False, nproc=None):
+        """ Run a simulation from <deffnm>.tpr
+
+        :param deffnm: default file name of all input and output files
+        :param cwd: directory to run from
+        :param verbose: pass -v to mdrun
+        :param check: raise JobError if mdrun fails
+        :param nproc: number of MPI processes. Defaults to self.nproc
+
+        :return: finished Job
+        """
+
+        args = ['mdrun', '-deffnm', deffnm]
+        if verbose:
+            args.append('-v')
+
+        kwargs = {} if nproc is None else {'nproc': nproc}
+
+        return self.run(Job(self.gmx(*args, **kwargs), name='mdrun_%s' % os.path.basename(deffnm), cwd=cwd),
+                        check=check)
+
+    def simulate(self, mdp, top, config, out, restraints=None, index=None, cwd=None, verbose=False):
+        """ grompp then mdrun. Returns the potential energy reported in <out>.log (None if there is none)
+
+        :param mdp: .mdp file
+        :param top: topology
+        :param config: input coordinates
+        :param out: default file name of the run
+        :param restraints: coordinate file used as reference for position restraints
+        :param index: index file
+        :param cwd: directory to run from
+        :param verbose: pass -v to mdrun
+
+        :return: potential energy (kJ/mol) or None
+        """
+
+        logname = os.path.join(cwd if cwd is not None else os.getcwd(), '%s.log' % out)
+        if os.path.isfile(logname):
+            os.remove(logname)  # so a failed run is not mistaken for an earlier successful one
+
+        self.grompp(mdp, top, config, out, restraints=restraints, index=index, cwd=cwd)
+        self.mdrun(out, cwd=cwd, verbose=verbose)
+
+        return potential_energy(logname)
+
+    def map(self, fxn, *iterables):
+        """ Apply a function to each item of one or more iterables using a pool of max_jobs threads. The function will
+        usually launch jobs with this Runner. Results are returned in order
+
+        :param fxn: function to apply
+
+        :return: list of results
+        """
+
+        with ThreadPoolExecutor(max_workers=self.max_jobs) as pool:
+            return list(pool.map(fxn, *iterables))
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""
+Periodic neighbor searches. Pairs of points closer than a cutoff are found with a KD-tree, so memory scales with the
+number of pairs found rather than with the number of possible pairs. Rectangular boxes use scipy's built-in periodic
+KD-tree. Triclinic boxes (such as the monoclinic HII unit cell) are handled by wrapping all points into the unit cell
+and surrounding it with only those periodic images that are within the cutoff of its faces.
+"""
+
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+from scipy.spatial import cKDTree
+import tqdm
+from llcsim.llclib import physical
+
+
+def rectangular(box, tol=1e-6):
+    """ Determine whether box vectors describe a rectangular box
+
+    :param box: box vectors (3, 3)
+    :param tol: largest allowed magnitude of off-diagonal elements
+
+    :type box: numpy.ndarray
+    :type tol: float
+
+    :return: True if the box is rectangular
+    """
+
+    return np.all(np.abs(box - np.diag(np.diag(box))) < tol)
+
+
+def periodic_images(positions, box, cut, shifts=False):
+    """ Generate the periodic images of points that lie within a distance 'cut' of the unit cell. This replaces
+    explicitly duplicating a system into its 26 (or 8) neighboring cells: only the images that can be within 'cut' of
+    a point in the unit cell are made, and any triclinic (e.g. monoclinic HII) cell is handled
+
+    :param positions: coordinates of points wrapped into the unit cell (n, 3)
+    :param box: box vectors (3, 3)
+    :param cut: distance from the faces of the unit cell within which images are kept
+    :param shifts: also return the integer lattice translation that generated each image
+
+    :type positions: numpy.ndarray
+    :type box: numpy.ndarray
+    :type cut: float
+    :type shifts: bool
+
+    :return: coordinates of images, (nimages, 3), the index of the point each image was generated from and, if
+    shifts is True, the lattice translation of each image (nimages, 3)
+    """
+
+    fractional = physical.fractional_coordinates(positions, box)
+
+    # a point within 'cut' of the unit cell lies within cut / width of it along each fractional axis
+    a, b, c = box
+    volume = np.abs(np.dot(a, np.cross(b, c)))
+    margin = np.linalg.norm(np.array([np.cross(b, c), np.cross(c, a), np.cross(a, b)]), axis=1) * cut / volume
+
+    images = []
+    index = []
+    translations = []
+    for shift in physical.lattice_shifts(images=int(np.ceil(margin.max()))):
+        shifted = fractional + shift
+        keep = np.all((shifted >= -margin) & (shifted < 1 + margin), axis=1)
+        images.append(shifted[keep])
+        index.append(np.nonzero(keep)[0])
+        translations.append(np.tile(shift, (index[-1].size, 1)))
+
+    images = physical.cartesian_coordinates(np.concatenate(images), box)
+
+    if shifts:
+        return images, np.concatenate(index), np.concatenate(translations)
+    else:
+        return images, np.concatenate(index)
+
+
+def pairs(x, box, cut, y=None, order='index'):
+    """ Find all pairs of points within a cutoff distance of each other according to the minimum image convention
+
+    :param x: coordinates of first set of points (n, 3)
+    :param box: box vectors (3, 3)
+    :param cut: cutoff distance. Only pairs separated by less than this are returned
+    :param y: coordinates of second set of points (m, 3). If None, pairs are found within x, excluding each point
+    with itself. In that case each pair is reported twice, as (i, j) and (j, i)
+    :param order: 'index' to sort pairs by x then y index, 'distance' to sort them from closest to farthest (ties are
+    broken by x then y index)
+
+    :type x: numpy.ndarray
+    :type box: numpy.ndarray
+    :type cut: float
+    :type y: numpy.ndarray
+    :type order: str
+
+    :return: indices into x, indices into y and minimum image distances of each pair
+    """
+
+    box = np.asarray(box, dtype=float)
+    x = physical.wrap_box(np.asarray(x, dtype=float), box)
+    self_search = y is None
+    if self_search:
+        y = x
+    else:
+        y = physical.wrap_box(np.asarray(y, dtype=float), box)
+
+    if rectangular(box):
+
+        boxsize = np.diag(box)
+        x = np.where(x >= boxsize, 0, x)  # floating point wrapping can land exactly on the upper boundary
+        y = np.where(y >= boxsize, 0, y)
+
+        found = cKDTree(x, boxsize=boxsize).sparse_distance_matrix(cKDTree(y, boxsize=boxsize), cut,
+                                                                     output_type='ndarray')
+        i, j, d = found['i'], found['j'], found['v']
+
+    else:
+
+        images, origin = periodic_images(y, box, cut)
+        found = cKDTree(x).sparse_distance_matrix(cKDTree(images), cut, output_type='ndarray')
+        i, j, d = found['i'], origin[found['j']], found['v']
+
+        # more than one image of a point can be within the cutoff if the cutoff is large relative to the box
+        closest = np.lexsort((d, j, i))
+        i, j, d = i[closest], j[closest], d[closest]
+        first = np.ones(i.size, dtype=bool)
+        first[1:] = (i[1:] != i[:-1]) | (j[1:] != j[:-1])
+        i, j, d = i[first], j[first], d[first]
+
+    keep = d < cut
+    if self_search:
+        keep &= (i != j)
+
+    i, j, d = i[keep], j[keep], d[keep]
+
+    if order == 'index':
+        ndx = np.lexsort((j, i))
+    elif order == 'distance':
+        ndx = np.lexsort((j, i, d))
+    else:
+        raise ValueError("order must be 'index' or 'distance', not '%s'" % order)
+
+    return i[ndx], j[ndx], d[ndx]
+
+
+def pair_lists(x, box, cut, y=None, progress=False):
+    """ Find pairs of points within a cutoff distance of each other at every frame of a trajectory
+
+    :param x: coordinates of first set of points (n_frames, n, 3)
+    :param box: box vectors at each frame (n_frames, 3, 3)
+    :param cut: cutoff distance
+    :param y: coordinates of second set of points (n_frames, m, 3). If None, pairs are found within x
+    :param progress: show a progress bar
+
+    :type x: numpy.ndarray
+    :type box: numpy.ndarray
+    :type cut: float
+    :type y: numpy.ndarray
+    :type progress: bool
+
+    :return: list of (i, j, d) tuples, one per frame. See pairs()
+    """
+
+    frames = tqdm.tqdm(range(x.shape[0]), unit=' Frames', disable=(not progress))
+
+    return [pairs(x[t], box[t], cut, y=None if y is None else y[t]) for t in frames]
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+"""
+Split per-frame calculations across a pool of processes. Arrays indexed by frame are copied once into shared memory
+and every worker reads the frames it is responsible for directly from there, so coordinates are never pickled. The
+output of each block of frames is combined in a final reduction step.
+"""
+
+from __future__ import division
+from __future__ import print_function
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import tqdm
+
+_attached = {}  # shared arrays a worker process has already attached to, keyed by name
+
+
+class SharedArray(object):
+
+    def __init__(self, array):
+        """ Copy an array into a block of shared memory. Pickling a SharedArray only sends the information needed to
+        find the block, never the data itself
+
+        :param array: array to share
+
+        :type array: numpy.ndarray
+        """
+
+        array = np.ascontiguousarray(array)
+
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.name = self.shm.name
+
+        np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)[...] = array
+
+    def __getstate__(self):
+
+        return {'name': self.name, 'shape': self.shape, 'dtype': self.dtype}
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self.shm = None
+
+    def array(self):
+        """ View of the shared data. Attaches to the shared memory block the first time it is called in a process
+
+        :return: numpy.ndarray backed by shared memory
+        """
+
+        if self.name not in _attached:
+            shm = self.shm if self.shm is not None else shared_memory.SharedMemory(name=self.name)
+            _attached[self.name] = (shm, np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf))
+
+        return _attached[self.name][1]
+
+    def detach(self):
+        """ Close this process's mapping of the shared memory block without freeing it. Workers call this after each
+        task so that mappings don't accumulate for the life of the pool
+        """
+
+        entry = _attached.pop(self.name, None)
+
+        if entry is not None:
+            entry[0].close()
+
+    def release(self):
+        """ Free the shared memory block. Only the process that created the array should call this
+        """
+
+        _attached.pop(self.name, None)
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _run(task):
+    """ Apply a function to one block of frames. This is what each worker executes
+
+    :param task: (function, arguments, first frame, last frame, keyword arguments)
+
+    :return: output of the function
+    """
+
+    fxn, args, start, stop, kwargs = task
+
+    try:
+        frames = [a.array()[start:stop] if isinstance(a, SharedArray) else a for a in args]
+        result = fxn(*frames, **kwargs)
+
+        # the shared memory is unmapped below, so output may not be a view of it
+        views = [f for f, a in zip(frames, args) if isinstance(a, SharedArray)]
+        own = lambda r: np.array(r) if isinstance(r, np.ndarray) and any(np.may_share_memory(r, v) for v in views) \
+            else r
+        result = tuple(own(r) for r in result) if isinstance(result, tuple) else own(result)
+
+        del frames, views
+        return result
+    finally:
+        for a in args:
+            if isinstance(a, SharedArray):
+                a.detach()
+
+
+def combine(results, reduce='concatenate'):
+    """ Combine the output of each block of frames
+
+    :param results: output of each block, in frame order. Each is an array or tuple of arrays
+    :param reduce: 'concatenate' to join results along the frame axis, 'sum' to add them (e.g. histograms)
+
+    :type results: list
+    :type reduce: str
+
+    :return: combined output
+    """
+
+    if reduce == 'concatenate':
+        join = np.concatenate
+    elif reduce == 'sum':
+        join = lambda x: np.sum(x, axis=0)
+    else:
+        raise ValueError("reduce must be 'concatenate' or 'sum', not '%s'" % reduce)
+
+    if isinstance(results[0], tuple):
+        return tuple(join([r[i] for r in results]) for i in range(len(results[0])))
+    else:
+        return join(results)
+
+
+def frame_map(fxn, arrays, nproc=1, reduce='concatenate', progress=False, **kwargs):
+    """ Apply a per-frame calculation to every frame of a trajectory, optionally in parallel
+
+    fxn is called as fxn(*blocks, **kwargs) where each block is a contiguous slice of frames taken from the
+    corresponding entry of arrays. fxn must be defined at the top level of a module so that it can be sent to worker
+    processes.
+
+    :param fxn: function that operates on a block of frames
+    :param arrays: arrays whose first dimension is the number of frames. None entries are passed through unchanged
+    :param nproc: number of processes to use
+    :param reduce: how to combine the output of each block. See combine()
+    :param progress: show a progress bar
+    :param kwargs: extra keyword arguments passed to fxn. These should be small since they are sent to every worker
+
+    :type fxn: function
+    :type arrays: list or tuple
+    :type nproc: int
+    :type reduce: str
+    :type progress: bool
+
+    :return: combined output of fxn
+    """
+
+    nframes = [a.shape[0] for a in arrays if a is not None][0]
+
+    if nproc > 1:
+        nblocks = min(nframes, 4 * nproc)  # a few blocks per process to balance the load
+    elif progress:
+        nblocks = min(nframes, 100)
+    else:
+        nblocks = 1
+
+    edges = np.linspace(0, nframes, nblocks + 1).astype(int)
+
+    results = []
+    with tqdm.tqdm(total=nframes, unit=' Frames', disable=(not progress)) as bar:
+
+        if nproc > 1:
+
+            shared = [SharedArray(a) if a is not None else None for a in arrays]
+            tasks = [(fxn, shared, edges[i], edges[i + 1], kwargs) for i in range(nblocks)]
+
+            try:
+                with multiprocessing.Pool(processes=nproc) as pool:
+                    for i, result in enumerate(pool.imap(_run, tasks)):
+                        results.append(result)
+                        bar.update(edges[i + 1] - edges[i])
+            finally:
+                for s in shared:
+                    if s is not None:
+                        s.release()
+
+        else:
+
+            for i in range(nblocks):
+                blocks = [a[edges[i]:edges[i + 1]] if a is not None else None for a in arrays]
+                results.append(fxn(*blocks, **kwargs))
+                bar.update(edges[i + 1] - edges[i])
+
+    return combine(results, reduce=reduce)
@@ -2,7 +2,7 @@
 
 from __future__ import division
 from builtins import range
-from llcsim.llclib import file_rw, transform
+from llcsim.llclib import file_rw, transform, parallel
 import mdtraj as md
 import numpy as np
 import matplotlib.path as mplPath
@@ -206,7 +206,7 @@ def conc(t, comp, b):
     return avg_conc, std, avg_cross, thick, z_max, z_min
 
 
-def avg_pore_loc(npores, pos, box, buffer=0, spline=False, npts=20, progress=False, bins=False):
+def avg_pore_loc(npores, pos, box, buffer=0, spline=False, npts=20, progress=False, bins=False, nproc=1):
     """ Calculate average pore location for each pore at each frame
 
     :param no_pores: the number of pores in the unit cell
@@ -217,6 +217,7 @@ def avg_pore_loc(npores, pos, box, buffer=0, spline=False, npts=20, progress=Fal
     :param npts: number of points making up the spline in each pore
     :param progress: show progress bar while constructing splines
     :param bins: return the bin centers of each spline for plotting purposes
+    :param nproc: number of processes to split frames between
 
     :type no_pores: int
     :type pos: numpy.ndarray, shape(ncomponents, 3) or numpy.ndarray, shape(nframes, ncomponents, 3)
@@ -226,6 +227,7 @@ def avg_pore_loc(npores, pos, box, buffer=0, spline=False, npts=20, progress=Fal
     :type npts: int
     :type progress: bool
     :type bins: bool
+    :type nproc: int
 
     :return: numpy array containing the x, y coordinates of the center of each pore at each frame
     """
@@ -239,7 +241,7 @@ def avg_pore_loc(npores, pos, box, buffer=0, spline=False, npts=20, progress=Fal
         else:
 
             print('Calculating pore spline...')
-            centers, bin_centers = trace_pores(pos, box, npts, npores=4, progress=progress)
+            centers, bin_centers = trace_pores(pos, box, npts, npores=4, progress=progress, nproc=nproc)
 
             if bins:
                 return centers, bin_centers
@@ -249,35 +251,7 @@ def avg_pore_loc(npores, pos, box, buffer=0, spline=False, npts=20, progress=Fal
 
         if len(pos.shape) == 3:  # multiple frames
 
-            nT = np.shape(pos)[0]
-            comp_ppore = np.shape(pos)[1] // npores
-
-            p_center = np.zeros([nT, npores, 2])
-
-            for i in range(nT):
-
-                positions = wrap_box(pos[i, ...], box[i, ...])
-
-                if buffer > 0:
-
-                    include = np.full(pos.shape[1], True)
-
-                    include[np.where(pos[i, :, 2] > box[i, 2, 2] + buffer)] = False
-                    include[np.where(pos[i, :, 2] < buffer)] = False
-
-                    for j in range(npores):
-                        p_center[i, j, :] = positions[comp_ppore * j:comp_ppore * (j + 1), :2].mean(axis=0)
-                        count = 0
-                        for k in range(comp_ppore * j, comp_ppore * (j + 1)):
-                            if include[k]:
-                                p_center[i, j, :] += positions[k, :2]
-                                count += 1
-                        p_center[i, j, :] /= count  # take the average
-
-                else:
-
-                    for j in range(npores):
-                        p_center[i, j, :] = positions[comp_ppore*j:comp_ppore*(j + 1), :2].mean(axis=0)
+            p_center = parallel.frame_map(_pore_centers, (pos, box), nproc=nproc, npores=npores, buffer=buffer)
 
         elif len(pos.shape) == 2:  # single frame
 
@@ -297,6 +271,57 @@ def avg_pore_loc(npores, pos, box, buffer=0, spline=False, npts=20, progress=Fal
         return p_center
 
 
+def _pore_centers(pos, box, npores=4, buffer=0):
+    """ Average xy location of each pore at each frame in a block of frames. See avg_pore_loc
+
+    :param pos: the coordinates of the component(s) which you are using to locate the pore centers
+    :param box: box vectors
+    :param npores: the number of pores in the unit cell
+    :param buffer: fraction (of membrane thickness) of top and bottom of membrane to exclude
+
+    :type pos: numpy.ndarray, shape(nframes, ncomponents, 3)
+    :type box: numpy.ndarray, shape(nframes, 3, 3)
+    :type npores: int
+    :type buffer: float
+
+    :return: numpy array containing the x, y coordinates of the center of each pore at each frame
+    """
+
+    nT = np.shape(pos)[0]
+    comp_ppore = np.shape(pos)[1] // npores
+
+    p_center = np.zeros([nT, npores, 2])
+
+    wrapped = wrap_box(pos, box)  # wrap the whole block at once
+
+    for i in range(nT):
+
+        positions = wrapped[i, ...]
+
+        if buffer > 0:
+
+            include = np.full(pos.shape[1], True)
+
+            include[np.where(pos[i, :, 2] > box[i, 2, 2] + buffer)] = False
+            include[np.where(pos[i, :, 2] < buffer)] = False
+
+            for j in range(npores):
+                p_center[i, j, :] = positions[comp_ppore * j:comp_ppore * (j + 1), :2].mean(axis=0)
+                count = 0
+                for k in range(comp_ppore * j, comp_ppore * (j + 1)):
+                    if include[k]:
+                        p_center[i, j, :] += positions[k, :2]
+                        count += 1
+                p_center[i, j, :] /= count  # take the average
+
+        else:
+
+            for j in range(npores):
+                p_center[i, j, :] = positions[comp_ppore*j:comp_ppore*(j + 1), :2].mean(axis=0)
+
+    return p_center
+
+
 def p2p(p_centers, distances):
     """
     :param p_centers: the x, y locations of the pore centers in the format return from avg_pore_loc()
@@ -317,41 +342,33 @@ def p2p(p_centers, distances):
     return p2ps
 
 
-def limits(pos, pcenters):
+def limits(pos, pcenters, nproc=1):
     """
     Estimate the pore 'radius' based on the position of some component and it's maximum deviation from the pore center
     :param: pos: the positions of all atoms included in making the estimate
     :param: pcenters: the x,y positions of the pore centers for each frame
+    :param: nproc: number of processes to split frames between
     :return: an approximate pore radius. Beyond which, we have entered the alkane region
     """
 
-    nT = pcenters.shape[0]
-    npores = pcenters.shape[1]
-    natoms = pos.shape[1]
-    atom_ppore = natoms // npores
+    return parallel.frame_map(_pore_radii, (pos, pcenters), nproc=nproc, progress=True)
 
-    deviation = np.zeros([nT, npores, atom_ppore])
-    for f in tqdm.tqdm(range(nT)):
-        for i in range(atom_ppore):
-            for j in range(npores):
-                deviation[f, j, i] = np.linalg.norm(pos[f, j*atom_ppore + i, :2] - pcenters[f, j, :])
 
-    #deviation = np.reshape(deviation, (nT, natoms))
+def _pore_radii(pos, pcenters):
+    """ Mean xy distance of atoms from the center of the pore they belong to for a block of frames. See limits
 
-    fr = np.zeros([nT])
-    frstd = np.zeros([nT])
-    #
-    # for i in range(nT):
-    #     fr[i] = np.mean(deviation[i, :])  # + np.std(deviation[i, :]) # maybe?
-    #     frstd[i] = np.std(deviation[i, :])
+    :param: pos: the positions of all atoms included in making the estimate (nframes, natoms, 3)
+    :param: pcenters: the x,y positions of the pore centers for each frame (nframes, npores, 2)
+    :return: mean deviation from the pore center of each pore at each frame (nframes, npores)
+    """
 
-    radii = np.zeros([nT, npores])
+    nT, npores = pcenters.shape[:2]
+    atom_ppore = pos.shape[1] // npores
 
-    for t in range(nT):
-        for p in range(npores):
-            radii[t, p] = np.mean(deviation[t, p, :])
+    xy = np.reshape(pos[:, :npores * atom_ppore, :2], (nT, npores, atom_ppore, 2))
+    deviation = np.linalg.norm(xy - pcenters[:, :, np.newaxis, :2], axis=3)
 
-    return radii
+    return deviation.mean(axis=2)
 
 
 def put_in_box(pt, x_box, y_box, m, angle):
@@ -378,7 +395,7 @@ def put_in_box(pt, x_box, y_box, m, angle):
     return pt
 
 
-def trace_pores(pos, box, npoints, npores=4, progress=True):
+def trace_pores(pos, box, npoints, npores=4, progress=True, nproc=1):
     """
     Find the line which traces through the center of the pores
     :param pos: positions of atoms used to define pore location (args.ref) [natoms, 3]
@@ -387,6 +404,7 @@ def trace_pores(pos, box, npoints, npores=4, progress=True):
     :param npores: number of pores in unit cell (assumed that atoms are number sequentially by pore. i.e. pore 1 atom
     numbers all precede those in pore 2)
     :param progress: set to True if you want a progress bar to be shown
+    :param nproc: number of processes to split frames between
 
     :return: points which trace the pore center
     """
@@ -397,95 +415,177 @@ def trace_pores(pos, box, npoints, npores=4, progress=True):
         box = box[np.newaxis, ...]
         single_frame = True
 
-    nframes = pos.shape[0]
-    atoms_p_pore = int(pos.shape[1] / npores)  # atoms in each pore
-
-    v = np.zeros([nframes, 4, 2])  # vertices of unitcell box
-    bounds = []
+    centers, bin_centers = parallel.frame_map(_trace_pores, (pos, box), nproc=nproc, progress=progress,
+                                              npoints=npoints, npores=npores)
 
-    v[:, 0, :] = [0, 0]
-    v[:, 1, 0] = box[:, 0, 0]
-    v[:, 3, :] = np.vstack((box[:, 1, 0], box[:, 1, 1])).T
-    v[:, 2, :] = v[:, 3, :] + np.vstack((box[:, 0, 0], np.zeros([nframes]))).T
-    center = np.vstack((np.mean(v[..., 0], axis=1), np.mean(v[..., 1], axis=1), np.zeros(nframes))).T
+    if single_frame:
+        return centers[0, ...]  # doesn't return bin center yet
+    else:
+        return centers, bin_centers
 
-    for t in range(nframes):
-        bounds.append(mplPath.Path(v[t, ...]))  # create a path tracing the vertices, v
 
-    angle = np.arcsin(box[:, 1, 1]/box[:, 0, 0])  # specific to case where magnitude of x and y box lengths are equal
-    angle = np.where(box[:, 1, 0] < 0, angle + np.pi / 2, angle)  # haven't tested this well yet
+def _trace_pores(pos, box, npoints=20, npores=4):
+    """ Trace the pore centers of a block of frames. See trace_pores
 
-    m = (v[:, 3, 1] - v[:, 0, 1]) / (v[:, 3, 0] - v[:, 0, 0])  # slope from points connecting first and third vertices
+    All pores of all frames are handled at once. Atoms of each pore are binned along z. Each bin's center is the mean
+    position of its atoms after they are expressed relative to the first atom in the bin and wrapped into the unit
+    cell, which keeps bins that straddle a periodic boundary in one piece.
 
-    centers = np.zeros([nframes, npores, npoints, 3])
-    bin_centers = np.zeros([nframes, npores, npoints])
+    :param pos: positions of atoms used to define pore location (nframes, natoms, 3)
+    :param box: box vectors (nframes, 3, 3)
+    :param npoints: number of points for spline in each pore
+    :param npores: number of pores in unit cell
 
-    for t in tqdm.tqdm(range(nframes), disable=(not progress)):
-        for p in range(npores):
+    :return: points which trace the pore center (nframes, npores, npoints, 3) and the z-coordinate of the center of
+    each bin (nframes, npores, npoints). Bins that contain no atoms are filled with NaN
+    """
 
-            pore = pos[t, p*atoms_p_pore:(p+1)*atoms_p_pore, :]  # coordinates for atoms belonging to a single pore
+    nframes = pos.shape[0]
+    atoms_p_pore = pos.shape[1] // npores  # atoms in each pore
+
+    pore = np.array(pos[:, :npores * atoms_p_pore, :], dtype=float).reshape(nframes, npores, atoms_p_pore, 3)
+
+    # because cross-linked configurations can extend very far up and down
+    pore[..., 2] = wrap_z(pore[..., 2], box[:, np.newaxis, np.newaxis, 2, 2])
+
+    # bin z-positions of each pore with the same edges np.histogram(z, bins=npoints) would use
+    zmin = pore[..., 2].min(axis=2)
+    zmax = pore[..., 2].max(axis=2)
+    flat = zmin == zmax
+    zmin = np.where(flat, zmin - 0.5, zmin)
+    zmax = np.where(flat, zmax + 0.5, zmax)
+    bins = np.linspace(zmin, zmax, npoints + 1, axis=-1)  # (nframes, npores, npoints + 1)
+
+    # equivalent of np.digitize(z, bins) - 1 for every pore. The top-most atom falls outside of the last bin
+    z = pore[..., 2]
+    guess = np.floor((z - zmin[..., np.newaxis]) / (zmax - zmin)[..., np.newaxis] * npoints).astype(int)
+    guess = np.clip(guess, 0, npoints - 1)
+    section = guess - (z < np.take_along_axis(bins, guess, axis=2))
+    section += (z >= np.take_along_axis(bins, guess + 1, axis=2))
+
+    bin_centers = (bins[..., 1:] + bins[..., :-1]) / 2
+
+    # give every (frame, pore, bin) a unique label. Atoms outside of all bins get an extra label that is thrown away
+    ngroups = nframes * npores * npoints
+    label = np.arange(nframes * npores).reshape(nframes, npores, 1) * npoints + section
+    label[(section < 0) | (section >= npoints)] = ngroups
+    label = label.ravel()
+
+    # choose the first atom in each bin as a reference
+    order = np.argsort(label, kind='stable')
+    ordered = label[order]
+    first = np.flatnonzero(np.concatenate(([True], ordered[1:] != ordered[:-1])))
+    reference = np.full([ngroups + 1, 3], np.nan)
+    reference[ordered[first]] = pore.reshape(-1, 3)[order[first]]
+    reference[ngroups] = 0
+
+    # shift everything towards the center of the unitcell and wrap the shifted points in the xy plane
+    xy = box[:, :2, :2]
+    inverse = np.linalg.inv(xy)
+    center = np.zeros([nframes, 3])
+    center[:, :2] = (xy[:, 0, :] + xy[:, 1, :]) / 2
+    shift = pore.reshape(nframes, -1, 3) - reference[label].reshape(nframes, -1, 3) + center[:, np.newaxis, :]
+    shift[..., :2] = _wrap_xy(shift[..., :2], xy, inverse)
+
+    counts = np.bincount(label, minlength=ngroups + 1)[:ngroups]
+    mean = np.zeros([ngroups, 3])
+    for i in range(3):
+        mean[:, i] = np.bincount(label, weights=shift[..., i].ravel(), minlength=ngroups + 1)[:ngroups]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean /= counts[:, np.newaxis]
+
+    # move everything back to where it was and make sure everything is in the box again
+    centers = (mean + reference[:ngroups]).reshape(nframes, npores, npoints, 3)
+    centers -= center[:, np.newaxis, np.newaxis, :]
+    centers = centers.reshape(nframes, -1, 3)
+    centers[..., :2] = _wrap_xy(centers[..., :2], xy, inverse)
+    centers = centers.reshape(nframes, npores, npoints, 3)
+
+    return centers, bin_centers
+
+
+def _wrap_xy(xy, box, inverse):
+    """ Wrap points into the unit cell in the xy plane
+
+    :param xy: xy coordinates (nframes, n, 2)
+    :param box: xy box vectors (nframes, 2, 2)
+    :param inverse: inverse of box
+
+    :return: wrapped xy coordinates
+    """
 
-            while np.min(pore[:, 2]) < 0 or np.max(pore[:, 2]) > box[t, 2, 2]:  # because cross-linked configurations can extend very far up and down
+    fractional = np.matmul(xy, inverse)
+    fractional -= np.floor(fractional)
 
-                pore[:, 2] = np.where(pore[:, 2] < 0, pore[:, 2] + box[t, 2, 2], pore[:, 2])
-                pore[:, 2] = np.where(pore[:, 2] > box[t, 2, 2], pore[:, 2] - box[t, 2, 2], pore[:, 2])
+    return np.matmul(fractional, box)
 
-            _, bins = np.histogram(pore[:, 2], bins=npoints)  # bin z-positions
 
-            section_indices = np.digitize(pore[:, 2], bins)  # list that tells which bin each atom belongs to
-            bin_centers[t, p, :] = [(bins[i] + bins[i + 1])/2 for i in range(npoints)]
+def center_of_mass(pos, mass_atoms, offsets=None, box=None):
+    """ Calculate center of mass of residues over a trajectory
 
-            for l in range(1, npoints + 1):
+    If offsets is None, pos is assumed to hold a series of identical residues, one after the other, and mass_atoms
+    holds the masses of the atoms of a single residue. Atoms after the last complete residue are ignored. Otherwise residues can have different numbers of atoms. Each
+    residue starts at the atom index given in offsets and mass_atoms holds the mass of every atom in pos.
 
-                atom_indices = np.where(section_indices == l)[0]
+    :param pos: xyz coordinates of atoms
+    :param mass_atoms : mass of atoms in order they appear in pos
+    :param offsets: index of the first atom of each residue in pos. Residues must be contiguous
+    :param box: box vectors at each frame. If given, residues broken across periodic boundaries are made whole before
+    their centers of mass are calculated
 
-                before = pore[atom_indices[0], :]  # choose the first atom as a reference
+    :type pos: np.array (nframes, natoms, 3)
+    :type mass_atoms: list or numpy.ndarray
+    :type offsets: list or numpy.ndarray
+    :type box: numpy.ndarray (nframes, 3, 3)
 
-                shift = transform.translate(pore[atom_indices, :], before, center[t, :])  # shift everything to towards the center
+    :return: center of mass of each residue at each frame
+    """
 
-                for i in range(shift.shape[0]):  # check if the points are within the bounds of the unitcell
-                    if not bounds[t].contains_point(shift[i, :2]):
-                        shift[i, :] = put_in_box(shift[i, :], box[t, 0, 0], box[t, 1, 1], m[t], angle[t])  # if its not in the unitcell, shift it so it is
+    mass_atoms = np.asarray(mass_atoms, dtype=float)
+    nframes, natoms = pos.shape[:2]
 
-                c = [np.mean(shift, axis=0)]
+    if offsets is None:
+        nres = natoms // mass_atoms.size
+        natoms = nres * mass_atoms.size
+        pos = pos[:, :natoms, :]  # atoms left over after the last complete residue are ignored
+        offsets = np.arange(0, natoms, mass_atoms.size)
+        mass_atoms = np.tile(mass_atoms, nres)
+    else:
+        offsets = np.asarray(offsets, dtype=int)
+        if mass_atoms.size != natoms:
+            raise ValueError('When offsets are given, mass_atoms must hold the mass of every atom in pos (%d masses '
+                             'for %d atoms)' % (mass_atoms.size, natoms))
 
-                centers[t, p, l - 1, :] = transform.translate(c, center[t, :], before)  # move everything back to where it was
+    if box is not None:  # express each atom relative to the first atom of its residue
+        first = np.repeat(offsets, np.diff(np.append(offsets, natoms)))
+        pos = pos[:, first, :] + minimum_image_distance(pos - pos[:, first, :], box)
 
-                if not bounds[t].contains_point(centers[t, p, l - 1, :]):  # make sure everything is in the box again
-                    centers[t, p, l - 1, :] = put_in_box(centers[t, p, l - 1, :], box[t, 0, 0], box[t, 1, 1], m[t], angle[t])
+    # weight each atom by its mass then sum the coordinates and divide by the mass of the residue
+    com = np.add.reduceat(pos * mass_atoms[:, np.newaxis], offsets, axis=1)
+    com /= np.add.reduceat(mass_atoms, offsets)[:, np.newaxis]
 
-    if single_frame:
-        return centers[0, ...]  # doesn't return bin center yet
-    else:
-        return centers, bin_centers
+    return com
 
 
-def center_of_mass(pos, mass_atoms):
-    """ Calculate center of mass of residues over a trajectory
+def group_offsets(sizes, nrepeats=1):
+    """ Index of the first atom of each group of atoms when groups are listed one after the other. Use the output as
+    offsets for center_of_mass
 
-    :param pos: xyz coordinates of atoms
-    :param mass_atoms : mass of atoms in order they appear in pos
+    :param sizes: number of atoms in each group of a repeating unit (e.g. groups of atoms in a monomer)
+    :param nrepeats: number of times the repeating unit occurs
 
-    :type pos: np.array (nframes, natoms, 3)
-    :type mass_atoms: list
+    :type sizes: list or numpy.ndarray
+    :type nrepeats: int
 
-    :return: center of mass of each residue at each frame
+    :return: index of the first atom of each group, (len(sizes) * nrepeats)
     """
 
-    nframes = pos.shape[0]
-    natoms = len(mass_atoms)
+    sizes = np.tile(sizes, nrepeats)
 
-    com = np.zeros([nframes, pos.shape[1] // natoms, 3])  # track the center of mass of each residue
+    return np.concatenate(([0], np.cumsum(sizes)[:-1]))
 
-    for f in range(nframes):
-        for i in range(com.shape[1]):
-            w = (pos[f, i * natoms:(i + 1) * natoms, :].T * mass_atoms).T  # weight each atom in the residue by its mass
-            com[f, i, :] = np.sum(w, axis=0) / sum(mass_atoms)  # sum the coordinates and divide by the mass of the residue
 
-    return com
-
-
-def compdensity(coord, pore_centers, box, cut=1.5, nbins=50, spline=False):
+def compdensity(coord, pore_centers, box, cut=1.5, nbins=50, spline=False, progress=True, nproc=1):
     """ Measure the density of a component as a function of the distance from the pore centers
 
     :param coord: the coordinates of the component(s) which you want a radial distribution of at each frame
@@ -495,6 +595,8 @@ def compdensity(coord, pore_centers, box, cut=1.5, nbins=50, spline=False):
     :param rmax: maximum distance from pore center to calculate density for, default = 3.5 nm
     :param buffer: percentage used to define the location of z planes between which component density will be computed,
            float, default = 0 (i.e. no buffer). Should be between 0 and 1. e.g. for 1 percent, use 0.01 as the buffer
+    :param progress: show a progress bar
+    :param nproc: number of processes to split frames between
 
     :type component: numpy.ndarray
     :type pore_centers: numpy.ndarray
@@ -502,31 +604,64 @@ def compdensity(coord, pore_centers, box, cut=1.5, nbins=50, spline=False):
     :type pores: int
     :type rmax: float
     :type buffer: float
+    :type progress: bool
+    :type nproc: int
 
     :return: the density of "component" as a function the distance from the pore center. Also
              returns the calculated bin width for plotting
     """
 
-    nT = coord.shape[0]
     zbox = np.mean(box[:, 2, 2])
     pores = pore_centers.shape[1]
-    density = np.zeros([nT, nbins])  # number / nm^3
+
+    density = parallel.frame_map(_radial_histogram, (coord, pore_centers, box), nproc=nproc, progress=progress,
+                                 cut=cut, nbins=nbins, spline=spline)  # number / nm^3 after normalization below
+
+    bin_edges = np.linspace(0, cut, nbins + 1)  # the same edges np.histogram uses with range=(0, cut)
+
+    # normalize based on volume of anulus where bin is located
+    r = np.zeros([nbins])
+    for i in range(nbins):
+        density[:, i] /= (np.pi * (bin_edges[i + 1] ** 2 - bin_edges[i] ** 2))
+        r[i] = (bin_edges[i + 1] + bin_edges[i]) / 2  # center of bins
+
+    density /= (zbox*pores)   # normalize by pore and z-dimension
+
+    return r, density
+
+
+def _radial_histogram(coord, pore_centers, box, cut=1.5, nbins=50, spline=False):
+    """ Histogram the radial distances of a component from the pore centers at each frame in a block of frames. See
+    compdensity
+
+    :param coord: the coordinates of the component(s) at each frame (nframes, ncomponents, 3)
+    :param pore_centers: the locations of each pore center at each frame
+    :param box: box vectors (nframes, 3, 3)
+    :param cut: largest distance from pore center to include
+    :param nbins: number of bins in histogram
+    :param spline: pore_centers describe a spline through each pore
+
+    :return: number of components in each radial bin, summed over pores, at each frame (nframes, nbins)
+    """
+
+    nT = coord.shape[0]
+    pores = pore_centers.shape[1]
+    density = np.zeros([nT, nbins])
 
     if spline:
 
         npts = pore_centers.shape[2]  # number of points making up the spline in each pore
 
         edges = np.zeros([nT, pores, npts + 1])  # bin edges, where bin centers are defined by point in spline.
-        for t in tqdm.tqdm(range(nT), unit=' Frames'):
+
+        z = wrap_z(coord[..., 2], box[:, 2, 2])  # because cross-linked configurations can extend very far up and down
+
+        for t in range(nT):
             for p in range(pores):
                 edges[t, p, 1:-1] = ((pore_centers[t, p, 1:, 2] - pore_centers[t, p, :-1, 2]) / 2) + pore_centers[t, p, :-1, 2]
                 edges[t, p, -1] = box[t, 2, 2]
 
-                while np.min(coord[t, :, 2]) < 0 or np.max(coord[t, :, 2]) > box[t, 2, 2]:  # because cross-linked configurations can extend very far up and down
-                    coord[t, :, 2] = np.where(coord[t, :, 2] < 0, coord[t, :, 2] + box[t, 2, 2], coord[t, :, 2])
-                    coord[t, :, 2] = np.where(coord[t, :, 2] > box[t, 2, 2], coord[t, :, 2] - box[t, 2, 2], coord[t, :, 2])
-
-                zbins = np.digitize(coord[t, :, 2], edges[t, p, :])
+                zbins = np.digitize(z[t, :], edges[t, p, :])
 
                 # handle niche case where coordinate lies exactly on the upper or lower bound
                 zbins = np.where(zbins == 0, zbins + 1, zbins)
@@ -542,7 +677,7 @@ def compdensity(coord, pore_centers, box, cut=1.5, nbins=50, spline=False):
 
     else:
 
-        for t in tqdm.tqdm(range(nT), unit=' Frames'):
+        for t in range(nT):
             for p in range(pores):
                 # narrow down the positions to those that are within 'cut' of at least one pore
                 distances = np.linalg.norm(coord[t, :, :2] - pore_centers[t, p, :], axis=1)
@@ -552,53 +687,92 @@ def compdensity(coord, pore_centers, box, cut=1.5, nbins=50, spline=False):
 
                 density[t, :] += hist
 
-    # normalize based on volume of anulus where bin is located
-    r = np.zeros([nbins])
-    for i in range(nbins):
-        density[:, i] /= (np.pi * (bin_edges[i + 1] ** 2 - bin_edges[i] ** 2))
-        r[i] = (bin_edges[i + 1] + bin_edges[i]) / 2  # center of bins
+    return density
 
-    density /= (zbox*pores)   # normalize by pore and z-dimension
 
-    return r, density
+def minimum_image_distance(dist, box):
+    """ Calculate minimum image distances from a vector of distances. Distance vectors are converted to fractional
+    coordinates of the unit cell and the nearest lattice vector is subtracted in a single step, so this works for any
+    triclinic unit cell (including the monoclinic HII cell) and for vectors that are many box lengths long. Vectors
+    that could still have a shorter image in a skewed cell are checked against their 26 neighboring images.
 
+    :param dist: a vector of distances (n, 3) where n is number of points, or any array of distance vectors whose last
+    dimension is 3, e.g. (nframes, n, 3)
+    :param box: box vectors meant to enclose d, mdtraj format: (3, 3), or one set of box vectors per frame
+    (nframes, 3, 3) when dist has shape (nframes, n, 3)
 
-def minimum_image_distance(dist, box):
-    """ Calculate minimum image distances from a vector of distances. This assumes a monoclinic unit cell where the x
-    box vector is fixed along the x-axis, the z-box vector is perpendicular to the xy plane, and the y-box vector makes
-    an angle, theta, with the x-axis.
+    :type dist: numpy.ndarray
+    :type box: numpy.ndarray
+
+    :return: minimum image distance vectors, same shape as dist
+    """
+
+    box = np.asarray(box, dtype=float)
+
+    d = fractional_coordinates(dist, box)
+    d -= np.round(d)
+    d = cartesian_coordinates(d, box)
+
+    # Rounding fractional coordinates gives the minimum image for any vector that fits in the sphere inscribed in the
+    # unit cell. Vectors outside of it (possible in skewed cells) are compared against their neighboring images
+    length = np.linalg.norm(d, axis=-1)
+    rmax = 0.5 * inscribed_diameter(box)
+    if box.ndim == 3:
+        rmax = np.reshape(rmax, rmax.shape + (1,) * (length.ndim - 1))
+
+    far = np.nonzero(length > rmax)
+
+    if far[0].size > 0:
+
+        shifts = np.matmul(lattice_shifts(), box)  # (27, 3) or (nframes, 27, 3)
+        if box.ndim == 3:
+            shifts = shifts[far[0]]
 
-    :param d: a vector of distances (n, 3) where n is number of points
-    :param box: box vectors meant to enclose d, mdtraj format: (3, 3)
+        candidates = d[far][:, np.newaxis, :] + shifts
+        closest = np.argmin(np.linalg.norm(candidates, axis=-1), axis=1)
+        d[far] = candidates[np.arange(closest.size), closest, :]
 
-    :return:
+    return d.astype(np.result_type(dist, np.float32), copy=False)
+
+
+def lattice_shifts(images=1):
+    """ Integer combinations of the three box vectors needed to reach all neighboring periodic images
+
+    :param images: number of images to include in each direction
+
+    :type images: int
+
+    :return: array of integer lattice translations, ((2*images + 1)**3, 3)
     """
 
-    x_box = box[0, 0]  # length of x-box vector
-    y_box = box[1, 1]  # perpendicular distance from x-axis to top of box in y-direction
-    z_box = box[2, 2]  # length of z-box vector
-    d = np.copy(dist)
-    angle = np.arcsin(y_box / x_box)  # angle between y-box vector and x-box vector in radians
+    n = np.arange(-images, images + 1)
 
-    # check x coordinates
-    while np.max(np.abs(d[:, 0])) > 0.5*x_box:  # iterate in case subtracting/adding box vector length once isn't enough
-        d[:, 0] = np.where(d[:, 0] > 0.5*x_box, d[:, 0] - x_box, d[:, 0])
-        d[:, 0] = np.where(d[:, 0] < -0.5*x_box, d[:, 0] + x_box, d[:, 0])
+    return np.array(np.meshgrid(n, n, n, indexing='ij')).reshape(3, -1).T
 
-    # check y coordinates
-    while np.amax(np.abs(d[:, 1])) > 0.5*y_box:  # written differently because np.where didn't know how to handle 2 axes
-        d[np.where(d[:, 1] > 0.5*y_box)[0], :2] -= [x_box*np.cos(angle), y_box]
-        d[np.where(d[:, 1] < -0.5*y_box)[0], :2] += [x_box*np.cos(angle), y_box]
 
-    # check z coordinates
-    while np.max(np.abs(d[:, 2])) > 0.5*z_box:
-        d[:, 2] = np.where(d[:, 2] > 0.5*z_box, d[:, 2] - z_box, d[:, 2])
-        d[:, 2] = np.where(d[:, 2] < -0.5*z_box, d[:, 2] + z_box, d[:, 2])
+def inscribed_diameter(box):
+    """ Diameter of the largest sphere that fits inside a triclinic unit cell. This is the smallest perpendicular
+    distance between opposite faces of the cell.
+
+    :param box: box vectors (3, 3) or (n_frames, 3, 3)
+
+    :type box: numpy.ndarray
+
+    :return: diameter of inscribed sphere (float or (n_frames) array)
+    """
+
+    box = np.asarray(box, dtype=float)
+    a, b, c = box[..., 0, :], box[..., 1, :], box[..., 2, :]
+    volume = np.abs(np.einsum('...i,...i', a, np.cross(b, c)))
 
-    return d
+    widths = np.stack((volume / np.linalg.norm(np.cross(b, c), axis=-1),
+                       volume / np.linalg.norm(np.cross(c, a), axis=-1),
+                       volume / np.linalg.norm(np.cross(a, b), axis=-1)), axis=-1)
 
+    return widths.min(axis=-1)
 
-def partition(com, pore_centers, r, buffer=0, unitcell=None, npores=4, spline=False):
+
+def partition(com, pore_centers, r, buffer=0, unitcell=None, npores=4, spline=False, nproc=1):
     """ Partition residue center of masses into tail and pore region
 
     :param com: positions of centers of mass of particle whose partition we are calculating
@@ -608,6 +782,7 @@ def partition(com, pore_centers, r, buffer=0, unitcell=None, npores=4, spline=Fa
     :param unitcell: unitcell vectors in mdtraj format (t.unitcell_vectors). Only needed if buffer is used
     :param npores: number of pores
     :param spline: calculate partition with respect to pore spline
+    :param nproc: number of processes to split frames between
 
     :type com: numpy.ndarray (nT, ncom, 3)
     :type pore_centers: numpy.ndarray (nT, npores, 2) or (nT, npores, 3) or (nT, npores, npts, 3) if spline=True where
@@ -617,6 +792,19 @@ def partition(com, pore_centers, r, buffer=0, unitcell=None, npores=4, spline=Fa
     :type unitcell: numpy.ndarray (nT, 3, 3)
     :type npores: int
     :type spline: bool
+    :type nproc: int
+    """
+
+    print('Calculating solute partition...')
+
+    return parallel.frame_map(_partition, (com, pore_centers, unitcell), nproc=nproc, progress=True, r=r,
+                              buffer=buffer, npores=npores, spline=spline)
+
+
+def _partition(com, pore_centers, unitcell, r=1.5, buffer=0, npores=4, spline=False):
+    """ Partition residue centers of mass into tail and pore region for a block of frames. See partition
+
+    :return: boolean array which is True where a center of mass is in the pores (nT, ncom)
     """
 
     nT = com.shape[0]
@@ -626,8 +814,7 @@ def partition(com, pore_centers, r, buffer=0, unitcell=None, npores=4, spline=Fa
 
     part = np.zeros([nT, com.shape[1]], dtype=bool)  # Will be changed to True if solute in pores
 
-    print('Calculating solute partition...')
-    for i in tqdm.tqdm(range(nT)):
+    for i in range(nT):
 
         if buffer > 0:
             xy_positions = com[i, (com[i, :, 2] > buffer) & (com[i, :, 2] < unitcell[i, 2, 2] - buffer), :2]
@@ -636,13 +823,8 @@ def partition(com, pore_centers, r, buffer=0, unitcell=None, npores=4, spline=Fa
 
         if spline:
 
-            z = com[i, :, 2]  # extract z-coordinates for this frame
             zbox = unitcell[i, 2, 2]  # z-box vector for this frame
-
-            # make sure z-component of every particle in the box
-            while np.max(z) > zbox or np.min(z) < 0:  # might need to do this multiple times
-                z = np.where(z > zbox, z - zbox, z)
-                z = np.where(z < 0, z + zbox, z)
+            z = wrap_z(com[i, :, 2], zbox)  # make sure z-component of every particle in the box
 
             zbins = np.digitize(z, np.linspace(0, zbox, npts + 1))
 
@@ -671,10 +853,11 @@ def partition(com, pore_centers, r, buffer=0, unitcell=None, npores=4, spline=Fa
 
 
 def wrap_box(positions, box):
-    """ Put all atoms in box
+    """ Put all atoms in box. Positions are converted to fractional coordinates of the unit cell, wrapped into [0, 1)
+    and converted back to cartesian coordinates. Works for any triclinic unit cell and for whole trajectories at once.
 
-    :param positions: xyz atomic position [n_atoms, 3]
-    :param box: box vectors [3, 3] (as obtained from mdtraj t.unitcell_vectors)
+    :param positions: xyz atomic position [n_atoms, 3] or a trajectory of positions [n_frames, n_atoms, 3]
+    :param box: box vectors [3, 3] or [n_frames, 3, 3] (as obtained from mdtraj t.unitcell_vectors)
 
     :type positions: np.ndarray
     :type box: np.ndarray
@@ -682,26 +865,59 @@ def wrap_box(positions, box):
     :return: positions moved into box
     """
 
-    xy = positions[:, :2]  # xy coordinates have dependent changes so this makes things neater below
-    z = positions[:, 2]
+    fractional = fractional_coordinates(positions, box)
+    fractional -= np.floor(fractional)
+
+    return cartesian_coordinates(fractional, box).astype(np.result_type(positions, np.float32), copy=False)
+
+
+def fractional_coordinates(positions, box):
+    """ Convert cartesian coordinates to fractional coordinates of a triclinic unit cell. mdtraj box vectors are rows,
+    so positions = fractional . box
+
+    :param positions: cartesian coordinates with shape (..., 3)
+    :param box: box vectors (3, 3) or (n_frames, 3, 3). If box vectors are given for each frame, positions must have
+    shape (n_frames, n_atoms, 3)
+
+    :type positions: numpy.ndarray
+    :type box: numpy.ndarray
+
+    :return: fractional coordinates, same shape as positions
+    """
+
+    return np.matmul(positions, np.linalg.inv(np.asarray(box, dtype=float)))
 
-    xbox, ybox, zbox = box[0, 0], box[1, 1], box[2, 2]
 
-    angle = np.arcsin(ybox / xbox)  # angle between y-box vector and x-box vector in radians
-    m = np.tan(angle)
-    b = - m * xbox  # y intercept of box vector that does not pass through origin (right side of box)
+def cartesian_coordinates(fractional, box):
+    """ Convert fractional coordinates of a triclinic unit cell back to cartesian coordinates
 
-    while max(xy[:, 1]) > ybox or min(xy[:, 1]) < 0:
-        xy[np.where(xy[:, 1] > ybox)[0], :2] -= [xbox*np.cos(angle), ybox]
-        xy[np.where(xy[:, 1] < 0)[0], :2] += [xbox * np.cos(angle), ybox]
+    :param fractional: fractional coordinates with shape (..., 3)
+    :param box: box vectors (3, 3) or (n_frames, 3, 3). If box vectors are given for each frame, fractional must have
+    shape (n_frames, n_atoms, 3)
 
-    while len(np.where(xy[:, 0] < (xy[:, 1] / m))[0]) > 0 or len(np.where(xy[:, 0] > ((xy[:, 1] - b) / m))[0]) > 0:
-        xy[np.where(xy[:, 0] < (xy[:, 1] / m))[0], 0] += xbox
-        xy[np.where(xy[:, 0] > ((xy[:, 1] - b) / m))[0], 0] -= xbox
+    :type fractional: numpy.ndarray
+    :type box: numpy.ndarray
+
+    :return: cartesian coordinates, same shape as fractional
+    """
+
+    return np.matmul(fractional, np.asarray(box, dtype=float))
+
+
+def wrap_z(z, zbox):
+    """ Put z coordinates in the interval [0, zbox)
+
+    :param z: z coordinates (n_atoms) or (n_frames, n_atoms)
+    :param zbox: length of z box vector. A scalar, or one length per frame (n_frames) if z has shape (n_frames, n_atoms)
+
+    :type z: numpy.ndarray
+    :type zbox: float or numpy.ndarray
+
+    :return: wrapped z coordinates
+    """
 
-    # check z coordinates
-    while np.max(z) > zbox or np.min(z) < 0:  # might need to do this multiple times
-        z = np.where(z > zbox, z - zbox, z)
-        z = np.where(z < 0, z + zbox, z)
+    zbox = np.asarray(zbox)
+    if zbox.ndim == 1:
+        zbox = zbox[:, np.newaxis]
 
-    return np.concatenate((xy, z[:, np.newaxis]), axis=1)
+    return z - np.floor(z / zbox) * zbox
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 import numpy as np
-from multiprocessing import Pool
+from scipy import fft
 import tqdm
 
 
@@ -77,6 +77,39 @@ def acf(t, largest_prime=500):
     return autocorr_fxn  # normalized
 
 
+def acf_batch(t, normalize=True, workers=1):
+    """ Autocorrelation functions of many time series with one batched FFT along the time axis. Gives the same results
+    as acf(), but rather than truncating the data until the transform length has small prime factors, the zero-padded
+    transform length is chosen with scipy.fft.next_fast_len so no data is lost.
+
+    :param t: time series (npoints, ...). Each series runs along the first axis
+    :param normalize: divide each autocovariance function by the variance of its series
+    :param workers: number of threads used by each FFT
+
+    :type t: numpy.ndarray
+    :type normalize: bool
+    :type workers: int
+
+    :return: autocorrelation (or autocovariance if normalize is False) function of each series (npoints, ...)
+    """
+
+    T = np.array(t, dtype=float)
+    N = T.shape[0]
+
+    T -= T.mean(axis=0)
+
+    length = fft.next_fast_len(2 * N - 1, real=True)  # zero-pad so the circular autocorrelation is a linear one
+
+    F = fft.rfft(T, n=length, axis=0, workers=workers)
+    C = fft.irfft(np.square(F.real) + np.square(F.imag), n=length, axis=0, workers=workers)[:N]
+    C /= np.arange(N, 0, -1).reshape((N,) + (1,) * (T.ndim - 1))  # number of pairs at each lag
+
+    if normalize:
+        C /= T.var(axis=0)
+
+    return C
+
+
 def autocov(joint_distribution, varied_length=False):
 
     """ Calculate the autocovariance function of the joint distribution of multiple realizations of a time series model
@@ -155,7 +188,7 @@ def autocorrFFT(x):
 
 
 def msd_fft(args):
-    """ Calculate msd using a fast fourier transform algorithm
+    """ Calculate msd of a single particle using a fast fourier transform algorithm
 
     :param x: trajectory of particle positions, equispaced in time
     :param axis: axis along which to calculate msd ({x:0, y:1, z:2})
@@ -168,23 +201,70 @@ def msd_fft(args):
 
     x, axis = args
 
-    r = np.copy(x)
-    r = r[:, axis]
+    return msd_batch(x[:, np.newaxis, :], axis)[:, 0]
+
+
+def msd_batch(x, axis, chunk=None, memory=256, dtype=np.float64, workers=1, progress=False):
+    """ Calculate the time-averaged msd of many particles at once. For each particle,
+
+        MSD(m) = S1(m) - 2 * S2(m)
+
+    where S2 is the positional autocorrelation function, calculated with FFTs along the time axis of all particles
+    and dimensions together, and S1(m) = (sum_k |r_k|^2 - sum_{k < m} |r_k|^2 + sum_{k < N - m} |r_k|^2) / (N - m)
+    is calculated with a cumulative sum.
+
+    :param x: particle positions, equispaced in time (n_frames, n_particles, n_dimensions)
+    :param axis: axis or axes along which to calculate msd ({x:0, y:1, z:2})
+    :param chunk: number of particles processed at once. If None, it is chosen so that the FFT of a chunk takes up
+    about 'memory' MB
+    :param memory: approximate memory (MB) used per chunk when chunk is None
+    :param dtype: floating point precision of the calculation. np.float32 halves memory and roughly doubles speed
+    :param workers: number of threads used by each FFT
+    :param progress: show a progress bar over chunks
 
-    if len(r.shape) == 1:
-        r = r[:, np.newaxis]
+    :type x: numpy.ndarray
+    :type axis: int or list
+    :type chunk: int
+    :type memory: float
+    :type dtype: type
+    :type workers: int
+    :type progress: bool
+
+    :return: msd of each particle (n_frames, n_particles)
+    """
+
+    N, n = x.shape[:2]
+    ndim = np.atleast_1d(np.arange(x.shape[2])[axis]).size
+
+    length = fft.next_fast_len(2 * N, real=True)  # zero-pad so the circular autocorrelation is a linear one
+    if chunk is None:
+        nbytes = (length // 2 + 1) * ndim * 2 * np.dtype(dtype).itemsize  # complex transform of one particle
+        chunk = max(1, int(memory * 1024 ** 2 // nbytes))
+
+    lags = np.arange(N, 0, -1)  # number of intervals of each length, N - m
+
+    MSD = np.zeros([N, n], dtype=dtype)
+
+    for start in tqdm.tqdm(range(0, n, chunk), unit=' chunks', disable=(not progress)):
+
+        r = np.asarray(x[:, start:start + chunk, axis], dtype=dtype)
+        if r.ndim == 2:
+            r = r[..., np.newaxis]
 
-    N = len(r)
-    D = np.square(r).sum(axis=1)
-    D = np.append(D, 0)
-    S2 = sum([autocorrFFT(r[:, i]) for i in range(r.shape[1])])
-    Q = 2 * D.sum()
-    S1 = np.zeros(N)
-    for m in range(N):
-      Q = Q - D[m - 1] - D[N - m]
-      S1[m] = Q / (N - m)
+        r = r - r.mean(axis=0)  # msd is unchanged by a shift. Centering limits round-off in S1 - 2*S2
 
-    return S1 - 2 * S2
+        D = np.square(r).sum(axis=2)
+        cumulative = np.zeros([N + 1, D.shape[1]])
+        cumulative[1:] = np.cumsum(D, axis=0, dtype=np.float64)
+        S1 = (cumulative[N] - cumulative[:N] + cumulative[N:0:-1]) / lags[:, np.newaxis]
+
+        F = fft.rfft(r, n=length, axis=0, workers=workers)
+        S2 = fft.irfft(np.square(F.real) + np.square(F.imag), n=length, axis=0, workers=workers)[:N].sum(axis=2)
+        S2 /= lags[:, np.newaxis]
+
+        MSD[:, start:start + chunk] = S1 - 2 * S2
+
+    return MSD
 
 
 def msd_straightforward(x, axis):
@@ -210,39 +290,40 @@ def msd_straightforward(x, axis):
     return MSD, MSDs
 
 
-def msd(x, axis, ensemble=False, nt=1):
+def msd(x, axis, ensemble=False, nt=1, dtype=np.float64, chunk=None):
     """ Calculate mean square displacement based on particle positions
 
     :param x: particle positions
     :param axis: axis along which you want MSD (0, 1, 2, [0, 1], [0, 2], [1, 2], [0, 1, 2])
     :param ensemble: if True, calculate the ensemble MSD instead of the time-averaged MSD
+    :param nt: number of threads used by the FFTs
+    :param dtype: floating point precision of the time-averaged MSD calculation (np.float64 or np.float32)
+    :param chunk: number of particles whose MSDs are calculated at once. See msd_batch()
 
     :type x: ndarray (n_frames, n_particles, 3)
     :type axis: int or list of ints
     :type ensemble: bool
+    :type nt: int
+    :type dtype: type
+    :type chunk: int
 
     :return: MSD of each particle
     """
 
-    frames = x.shape[0]  # number of trajectory frames
-    ntraj = x.shape[1]  # number of trajectories
-    MSD = np.zeros([frames, ntraj], dtype=float)  # a set of MSDs per particle
+    if ensemble:
 
-    size = len(x[0, :, axis].shape)  # number of axes in array where MSDs will be calculated
+        frames = x.shape[0]  # number of trajectory frames
+        ntraj = x.shape[1]  # number of trajectories
+        MSD = np.zeros([frames, ntraj], dtype=float)  # a set of MSDs per particle
 
-    if ensemble:
+        size = len(x[0, :, axis].shape)  # number of axes in array where MSDs will be calculated
 
         for n in range(ntraj):  # start at 1 since all row 0 will be all zeros
             MSD[:, n] = ensemble_msd(x[0, n, axis], x[:, n, axis], size)
 
     else:
-        if nt > 1:
-            with Pool(nt) as pool:
-                for i, t in enumerate(pool.map(msd_fft, [(x[:, n, :], axis) for n in range(ntraj)])):
-                    MSD[:, i] = t
-        else:
-            for n in tqdm.tqdm(range(ntraj)):
-                MSD[:, n] = msd_fft((x[:, n, :], axis))
+
+        MSD = msd_batch(x, axis, chunk=chunk, dtype=dtype, workers=nt, progress=True)
 
     return MSD
 
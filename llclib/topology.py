@@ -1,16 +1,277 @@
 #!/usr/bin/env python
 
+import hashlib
 import os
 import mdtraj as md
 import Atom_props
 import numpy as np
 import sys
+import tempfile
+import zipfile
+from llcsim.llclib import cache
 
 script_location = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
 ions_mw = {}
 ions_mw['NA'] = 22.99
 
+_itps = {}  # .itp files already parsed by this process. key = absolute path, value = (mtime, size, Itp)
+_ions = []
+
+
+class Itp(object):
+
+    def __init__(self, types, resnr, residues, names, cgnr, charges, masses, bonds, dihedrals=None, impropers=None):
+        """ Atoms and bonds of a molecule described by a GROMACS .itp file, stored as arrays. Atoms are assumed to
+        be numbered 1, 2, 3, ... in the order they are listed
+
+        :param types: atom type of each atom
+        :param resnr: residue number of each atom
+        :param residues: residue name of each atom
+        :param names: name of each atom
+        :param cgnr: charge group of each atom
+        :param charges: partial charge of each atom
+        :param masses: mass of each atom (NaN where the .itp does not list one)
+        :param bonds: pairs of bonded atoms as zero-based indices, in the order they appear in the .itp (nbonds, 2)
+        :param dihedrals: zero-based indices of the four atoms making up each dihedral, in the order they appear in the
+        .itp (ndihedrals, 4)
+        :param impropers: True for each dihedral that is an improper dihedral
+
+        :type types: numpy.ndarray
+        :type resnr: numpy.ndarray
+        :type residues: numpy.ndarray
+        :type names: numpy.ndarray
+        :type cgnr: numpy.ndarray
+        :type charges: numpy.ndarray
+        :type masses: numpy.ndarray
+        :type bonds: numpy.ndarray
+        :type dihedrals: numpy.ndarray
+        :type impropers: numpy.ndarray
+        """
+
+        self.types = np.asarray(types, dtype=str)
+        self.resnr = np.asarray(resnr, dtype=int)
+        self.residues = np.asarray(residues, dtype=str)
+        self.names = np.asarray(names, dtype=str)
+        self.cgnr = np.asarray(cgnr, dtype=int)
+        self.charges = np.asarray(charges, dtype=float)
+        self.masses = np.asarray(masses, dtype=float)
+        self.bonds = np.asarray(bonds, dtype=int).reshape(-1, 2)
+        self.dihedrals = np.asarray([] if dihedrals is None else dihedrals, dtype=int).reshape(-1, 4)
+        if impropers is None:
+            self.impropers = np.zeros(self.dihedrals.shape[0], dtype=bool)
+        else:
+            self.impropers = np.asarray(impropers, dtype=bool)
+        self.natoms = self.names.size
+
+        # atoms bonded to each atom in compressed sparse row form. Atom i is bonded to
+        # self.neighbors[self.indptr[i]:self.indptr[i + 1]], listed in the order the bonds appear in the .itp
+        source = self.bonds.ravel()
+        order = np.argsort(source, kind='stable')
+        self.neighbors = self.bonds[:, ::-1].ravel()[order]
+        self.indptr = np.zeros(self.natoms + 1, dtype=int)
+        self.indptr[1:] = np.cumsum(np.bincount(source, minlength=self.natoms))
+
+    def bonded(self, i):
+        """ Atoms bonded to an atom
+
+        :param i: zero-based index of atom
+
+        :type i: int
+
+        :return: zero-based indices of bonded atoms
+        """
+
+        return self.neighbors[self.indptr[i]:self.indptr[i + 1]]
+
+    def bond_dict(self):
+        """
+        :return: dict where keys are zero-based atom indices and values are lists of the atoms bonded to them
+        """
+
+        return {i: self.bonded(i).tolist() for i in range(self.natoms)}
+
+    def save(self, filename, mtime, size):
+
+        np.savez(filename, types=self.types, resnr=self.resnr, residues=self.residues, names=self.names,
+                 cgnr=self.cgnr, charges=self.charges, masses=self.masses, bonds=self.bonds, dihedrals=self.dihedrals,
+                 impropers=self.impropers, mtime=mtime, size=size)
+
+
+def parse_itp(filename):
+    """ Read the [ atoms ], [ bonds ] and [ dihedrals ] sections of the first molecule in a GROMACS .itp file. Dihedrals
+    are marked as impropers if their section is commented as such (e.g. '[ dihedrals ] ; impropers') or if they use an
+    improper function type (2 or 4)
+
+    :param filename: name of .itp file
+
+    :type filename: str
+
+    :return: Itp object
+    """
+
+    types, resnr, residues, names, cgnr, charges, masses, bonds = [], [], [], [], [], [], [], []
+    dihedrals, impropers = [], []
+
+    section = None
+    improper_section = False
+    molecules = 0
+    with open(filename, 'r') as f:
+        for line in f:
+            comment = line.split(';')[1].lower() if ';' in line else ''
+            line = line.split(';')[0].strip()
+            if not line or line.startswith('#'):  # preprocessor directives
+                continue
+            if line.startswith('['):
+                section = line.strip('[] ')
+                improper_section = 'improper' in comment
+                if section == 'moleculetype':
+                    molecules += 1
+                    if molecules > 1:
+                        break
+            elif section == 'atoms':
+                data = line.split()
+                types.append(data[1])
+                resnr.append(int(data[2]))
+                residues.append(data[3])
+                names.append(data[4])
+                cgnr.append(int(data[5]) if len(data) > 5 else int(data[0]))
+                charges.append(float(data[6]) if len(data) > 6 else 0)
+                masses.append(float(data[7]) if len(data) > 7 else np.nan)
+            elif section == 'bonds':
+                data = line.split()
+                bonds.append([int(data[0]) - 1, int(data[1]) - 1])
+            elif section == 'dihedrals':
+                data = line.split()
+                dihedrals.append([int(x) - 1 for x in data[:4]])
+                impropers.append(improper_section or (len(data) > 4 and data[4] in ['2', '4']))
+
+    return Itp(types, resnr, residues, names, cgnr, charges, masses, bonds, dihedrals, impropers)
+
+
+def read_itp(filename, use_cache=True):
+    """ Parse a GROMACS .itp file, reusing earlier results. Parsed files are kept in memory for the rest of the process
+    and saved as .npz files in the llcsim cache directory (see llclib/cache.py). Both are invalidated when the .itp
+    file's modification time or size changes
+
+    :param filename: name of .itp file
+    :param use_cache: if False, always parse the file
+
+    :type filename: str
+    :type use_cache: bool
+
+    :return: Itp object
+    """
+
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+
+    if not use_cache:
+        return parse_itp(path)
+
+    if path in _itps and _itps[path][:2] == (stat.st_mtime, stat.st_size):
+        return _itps[path][2]
+
+    root = os.path.join(os.environ.get('LLCSIM_CACHE', cache.default_root), 'itp')
+    stored = os.path.join(root, '%s.npz' % hashlib.sha1(path.encode()).hexdigest())
+
+    itp = None
+    if os.path.isfile(stored):
+        try:
+            with np.load(stored) as data:
+                if data['mtime'] == stat.st_mtime and data['size'] == stat.st_size:
+                    itp = Itp(data['types'], data['resnr'], data['residues'], data['names'], data['cgnr'],
+                              data['charges'], data['masses'], data['bonds'], data['dihedrals'],
+                              data['impropers'])
+        except (IOError, ValueError, KeyError, EOFError, zipfile.BadZipFile):  # damaged entry. It will be overwritten
+            pass
+
+    if itp is None:
+        itp = parse_itp(path)
+        try:
+            os.makedirs(root, exist_ok=True)
+            # write to a temporary file then move it into place so that concurrent or interrupted runs never leave a
+            # truncated entry behind
+            fd, tmp = tempfile.mkstemp(dir=root, suffix='.npz')
+            os.close(fd)
+            try:
+                itp.save(tmp, stat.st_mtime, stat.st_size)
+                os.replace(tmp, stored)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        except OSError:  # read-only cache location. Keep the result in memory only
+            pass
+
+    _itps[path] = (stat.st_mtime, stat.st_size, itp)
+
+    return itp
+
+
+def find_itp(name):
+    """ Locate name.itp, looking first in the current directory and then in llcsim/top/topologies
+
+    :param name: name of residue
+
+    :type name: str
+
+    :return: path to .itp file, or None if there is none
+    """
+
+    for f in ['%s.itp' % name, '%s/../top/topologies/%s.itp' % (script_location, name)]:
+        if os.path.isfile(f):
+            return f
+
+    return None
+
+
+def ions():
+    """
+    :return: names of residues that are ions, as listed in llcsim/top/topologies/ions.txt
+    """
+
+    if not _ions:
+        with open('%s/../top/topologies/ions.txt' % script_location) as f:
+            for line in f:
+                if line[0] != '#':
+                    _ions.append(str.strip(line))
+
+    return _ions
+
+
+def expand_bonds(itps, counts):
+    """ Bonded neighbors of every atom in a system made of consecutive blocks of identical molecules. Each molecule's
+    bonds are broadcast over all of its copies rather than built one residue at a time
+
+    :param itps: Itp object describing the molecules in each block. Use None for single atoms (e.g. ions)
+    :param counts: number of molecules in each block
+
+    :type itps: list
+    :type counts: list
+
+    :return: indptr and neighbors arrays in compressed sparse row form. Atom i is bonded to
+    neighbors[indptr[i]:indptr[i + 1]]
+    """
+
+    degrees = []
+    neighbors = [np.zeros(0, dtype=int)]
+    offset = 0
+    for itp, n in zip(itps, counts):
+        if itp is None:
+            degrees.append(np.zeros(n, dtype=int))
+            offset += n
+        else:
+            degrees.append(np.tile(np.diff(itp.indptr), n))
+            neighbors.append((itp.neighbors[np.newaxis, :] + offset +
+                              itp.natoms * np.arange(n)[:, np.newaxis]).ravel())
+            offset += itp.natoms * n
+
+    indptr = np.zeros(offset + 1, dtype=int)
+    if degrees:
+        indptr[1:] = np.cumsum(np.concatenate(degrees))
+
+    return indptr, np.concatenate(neighbors)
+
 
 class Residue(object):
 
@@ -20,13 +281,7 @@ class Residue(object):
 
         self.is_ion = False
         # check if residue is an ion
-        with open('%s/../top/topologies/ions.txt' % script_location) as f:
-            ions = []
-            for line in f:
-                if line[0] != '#':
-                    ions.append(str.strip(line))
-
-        if name in ions:
+        if name in ions():
 
             self.is_ion = True
             self.natoms = 1
@@ -47,13 +302,9 @@ class Residue(object):
                     raise OSError('No residue %s found. Perhaps you have not made a %s.pdb yet?' % (name, name))
                     #sys.exit('No residue %s found. Perhaps you have not made a %s.pdb yet?' % (name, name))
 
-            try:
-                f = open('%s.itp' % name, 'r')
-            except FileNotFoundError:
-                try:
-                    f = open('%s/../top/topologies/%s.itp' % (script_location, name), 'r')
-                except FileNotFoundError:
-                    sys.exit('No topology %s.itp found' % name)
+            self.itp_file = find_itp(name)
+            if self.itp_file is None:
+                sys.exit('No topology %s.itp found' % name)
 
             self.res = [a.residue.name for a in self.t.topology.atoms]
 
@@ -64,52 +315,19 @@ class Residue(object):
 
             else:
                 self.resname = self.res[0]
-                self.itp = []
-                for line in f:
-                    self.itp.append(line)
-
-                f.close()
-
-                atoms_index = 0
-                while self.itp[atoms_index].count('[ atoms ]') == 0:
-                    atoms_index += 1
-
-                self.indices = {}  # key = atom name , value = index
-                self.names = {}  # key = index, value = atom name
-                self.mass = {}  # key = atom name, value = mass
-                self.charges = {}
-
-                atoms_index += 2
-                self.natoms = 0
-                while self.itp[self.natoms + atoms_index] != '\n':
-                    data = self.itp[self.natoms + atoms_index].split()
-                    self.indices[data[4]] = int(data[0])
-                    self.names[int(data[0])] = data[4]
-                    self.mass[data[4]] = float(data[7])
-                    self.charges[data[4]] = float(data[6])
-                    self.natoms += 1
+                self.topology = read_itp(self.itp_file)
 
-                self.mw = sum(self.mass.values())
-
-                # find the bonds section
-                bonds_index = 0
-                while self.itp[bonds_index].count('[ bonds ]') == 0:
-                    bonds_index += 1
-                bonds_index += 2
+                self.natoms = self.topology.natoms
+                serials = range(1, self.natoms + 1)
+                names = self.topology.names.tolist()
+                self.indices = dict(zip(names, serials))  # key = atom name , value = index
+                self.names = dict(zip(serials, names))  # key = index, value = atom name
+                self.mass = dict(zip(names, self.topology.masses.tolist()))  # key = atom name, value = mass
+                self.charges = dict(zip(names, self.topology.charges.tolist()))
 
-                bonds = []
-                while self.itp[bonds_index] != '\n':
-                    bond_data = str.split(self.itp[bonds_index])[:2]
-                    bonds.append([int(bond_data[0]), int(bond_data[1])])
-                    bonds_index += 1
+                self.mw = sum(self.mass.values())
 
-                self.bonds = {}
-                for i in range(self.natoms):
-                    self.bonds[i] = []
-                    involvement = [x for x in bonds if i + 1 in x]
-                    for pair in involvement:
-                        atom = [x - 1 for x in pair if x != (i + 1)][0]
-                        self.bonds[i].append(atom)
+                self.bonds = self.topology.bond_dict()
 
 
 class Molecule(object):
@@ -118,13 +336,7 @@ class Molecule(object):
 
         self.is_ion = False
         # check if residue is an ion
-        with open('%s/../top/topologies/ions.txt' % script_location) as f:
-            ions = []
-            for line in f:
-                if line[0] != '#':
-                    ions.append(str.strip(line))
-
-        if name in ions:
+        if name in ions():
             self.is_ion = True
             self.residues = [name]
             self.names = [name]
@@ -145,30 +357,12 @@ class Molecule(object):
                     print('No residue %s found' % name)
                     exit()
 
-            try:
-                f = open('%s.itp' % name, 'r')
-            except FileNotFoundError:
-                try:
-                    f = open('%s/../top/topologies/%s.itp' % (script_location, name), 'r')
-                except FileNotFoundError:
-                    print('No topology %s.itp found' % name)
-
-            itp = []
-            for line in f:
-                itp.append(line)
-
-            f.close()
+            itp_file = find_itp(name)
+            if itp_file is None:
+                print('No topology %s.itp found' % name)
 
             self.natoms = t.n_atoms
-
-            atoms_index = 0
-            while itp[atoms_index].count('[ atoms ]') == 0:
-                atoms_index += 1
-
-            atoms_index += 2
-            self.charge = 0
-            for i in range(self.natoms):
-                self.charge += float(itp[atoms_index + i].split()[6])
+            self.charge = float(np.sum(read_itp(itp_file).charges[:self.natoms]))
 
             self.residues = [a.residue.name for a in t.topology.atoms]
             self.resname = self.residues[0]
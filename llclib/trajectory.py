@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+"""
+Stream trajectories from disk in fixed-size blocks of frames. Frame slicing and atom selection are applied at read
+time so that peak memory is bounded by the block size rather than by the length of the trajectory
+"""
+
+from __future__ import division
+from __future__ import print_function
+import os
+import numpy as np
+import mdtraj as md
+import tqdm
+
+topology_extensions = ['.gro', '.pdb']  # files that contain their own topology and are loaded in one shot
+
+
+def frame_range(traj, begin=0, end=-1, skip=1):
+    """ Determine which frames of a trajectory are selected by the slice [begin:end:skip]
+
+    :param traj: trajectory file (.xtc, .trr, .gro, ...)
+    :param begin: first frame index
+    :param end: last frame index (python slice convention, i.e. -1 excludes the final frame and None includes it)
+    :param skip: analyze every skip frames
+
+    :type traj: str
+    :type begin: int
+    :type end: int
+    :type skip: int
+
+    :return: indices of the selected frames with respect to the full trajectory
+    :rtype: range
+    """
+
+    with md.open(traj) as f:
+        nframes = len(f)
+
+    return range(*slice(begin, end, skip).indices(nframes))
+
+
+def iterload(traj, top=None, begin=0, end=-1, skip=1, atom_indices=None, chunk=100):
+    """ Read a trajectory as a series of blocks of at most 'chunk' frames. This is equivalent to iterating over
+    md.load(traj, top=top, atom_indices=atom_indices)[begin:end:skip] in pieces, without ever holding the full
+    trajectory in memory.
+
+    :param traj: trajectory file (.xtc, .trr, .gro, ...)
+    :param top: coordinate file defining the topology of traj
+    :param begin: first frame index
+    :param end: last frame index (python slice convention)
+    :param skip: analyze every skip frames
+    :param atom_indices: indices of atoms to read from each frame. If None, all atoms are read
+    :param chunk: number of frames per block
+
+    :type traj: str
+    :type top: str
+    :type begin: int
+    :type end: int
+    :type skip: int
+    :type atom_indices: list or numpy.ndarray
+    :type chunk: int
+
+    :return: generator of mdtraj.Trajectory objects
+    """
+
+    if os.path.splitext(traj)[1] in topology_extensions:  # single configurations. Nothing to stream
+
+        t = md.load(traj, atom_indices=atom_indices)[begin:end:skip]
+        for i in range(0, t.n_frames, chunk):
+            yield t[i:(i + chunk)]
+
+    else:
+
+        frames = frame_range(traj, begin=begin, end=end, skip=skip)
+        remaining = len(frames)
+
+        if remaining == 0:
+            return
+
+        for block in md.iterload(traj, top=top, chunk=chunk, skip=frames.start, stride=frames.step,
+                                 atom_indices=atom_indices):
+
+            if block.n_frames >= remaining:
+                yield block[:remaining]
+                return
+
+            remaining -= block.n_frames
+
+            yield block
+
+
+class Source(object):
+
+    def __init__(self, traj, top, begin=0, end=-1, skip=1, atom_indices=None, chunk=100):
+        """ A sliced view of a trajectory on disk that can be iterated over in blocks of frames any number of times
+
+        :param traj: trajectory file (.xtc, .trr, .gro, ...)
+        :param top: coordinate file defining the topology of traj
+        :param begin: first frame index
+        :param end: last frame index (python slice convention)
+        :param skip: analyze every skip frames
+        :param atom_indices: indices of atoms to read from each frame. If None, all atoms are read. Indices refer to
+        self.topology, which always describes the full system
+        :param chunk: number of frames per block
+
+        :type traj: str
+        :type top: str
+        :type begin: int
+        :type end: int
+        :type skip: int
+        :type atom_indices: list or numpy.ndarray
+        :type chunk: int
+        """
+
+        self.traj = traj
+        self.top = top
+        self.begin = begin
+        self.end = end
+        self.skip = skip
+        self.chunk = chunk
+        self.atom_indices = atom_indices
+
+        self.topology = md.load_topology(top)  # topology of the full system
+
+        if os.path.splitext(traj)[1] in topology_extensions:
+            self.frames = range(*slice(begin, end, skip).indices(md.load(traj).n_frames))
+        else:
+            self.frames = frame_range(traj, begin=begin, end=end, skip=skip)
+
+        self.n_frames = len(self.frames)
+
+    def __iter__(self):
+
+        return self.blocks()
+
+    def blocks(self, atom_indices=None):
+        """ Iterate over the trajectory one block of frames at a time
+
+        :param atom_indices: restrict this pass to a subset of atoms. Defaults to the selection given at initialization
+
+        :type atom_indices: list or numpy.ndarray
+
+        :return: generator of mdtraj.Trajectory objects
+        """
+
+        if atom_indices is None:
+            atom_indices = self.atom_indices
+
+        return iterload(self.traj, top=self.top, begin=self.begin, end=self.end, skip=self.skip,
+                        atom_indices=atom_indices, chunk=self.chunk)
+
+    def gather(self, fxn, atom_indices=None, progress=False):
+        """ Apply a function to every block of frames and concatenate the results along the first (frame) axis
+
+        :param fxn: function which takes an mdtraj.Trajectory block and returns an array, or tuple of arrays, whose
+        first dimension is the number of frames in the block
+        :param atom_indices: restrict this pass to a subset of atoms. Defaults to the selection given at initialization
+        :param progress: show a progress bar
+
+        :type fxn: function
+        :type atom_indices: list or numpy.ndarray
+        :type progress: bool
+
+        :return: concatenated output of fxn
+        """
+
+        results = []
+        with tqdm.tqdm(total=self.n_frames, unit=' Frames', disable=(not progress)) as bar:
+            for block in self.blocks(atom_indices=atom_indices):
+                results.append(fxn(block))
+                bar.update(block.n_frames)
+
+        if len(results) == 0:
+            raise ValueError('No frames were selected from %s' % self.traj)
+
+        if isinstance(results[0], tuple):
+            return tuple(np.concatenate([r[i] for r in results]) for i in range(len(results[0])))
+        else:
+            return np.concatenate(results)
+
+    def xyz(self, atom_indices=None):
+        """ Coordinates of a (small) subset of atoms at every selected frame
+
+        :param atom_indices: atoms whose coordinates are desired
+
+        :type atom_indices: list or numpy.ndarray
+
+        :return: coordinates, (n_frames, n_atoms, 3)
+        """
+
+        return self.gather(lambda block: block.xyz, atom_indices=atom_indices)
+
+    def frame(self, index=-1):
+        """ Load a single selected frame with all atoms. Useful for writing out representative configurations
+
+        :param index: index of frame with respect to the selected frames
+
+        :type index: int
+
+        :return: mdtraj.Trajectory with one frame
+        """
+
+        if os.path.splitext(self.traj)[1] in topology_extensions:
+            return md.load(self.traj)[self.frames[index]]
+        else:
+            return md.load_frame(self.traj, self.frames[index], top=self.top)
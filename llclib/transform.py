@@ -6,9 +6,20 @@ Commonly used coordinate transforms and related manipulations of positions, incl
 from __future__ import division
 from __future__ import print_function
 
+import os
 import numpy as np
 import math
 import tqdm
+import scipy.fft
+from scipy.interpolate import RegularGridInterpolator
+
+_cylindrical_bins = {}  # voxel to (r, z) bin assignments of recently averaged grids. See cylindrical_bins()
+_max_cylindrical_bins = 4
+
+try:
+    import pyfftw.builders  # optional. FFTW plans are reused between frames when it is installed
+except ImportError:
+    pyfftw = None
 
 
 def layer_dist(layers, nopores, distribution, monomers, alt_1, alt_2):
@@ -523,42 +534,259 @@ def monoclinic_to_cubic(xyz, theta=60):
     return coordinates
 
 
-def fft_3D_monoclinic(xyz, box_vectors, bins, angle=60, sf=False):
-    """ Calculate 3D discrete fourier transform for each frame of a trajectory of coordinates in monoclinic unit cell
+class StructureFactor(object):
+
+    def __init__(self, grid, subtract_mean=True, workers=-1):
+        """ Accumulate the structure factor, S(q) = |F(q)|^2, of a series of configurations one frame at a time.
+        Atoms are binned onto a real space grid with np.bincount and transformed with a real-to-complex FFT of a
+        float32 grid. Only the non-redundant half of the spectrum is accumulated, so memory use depends on the grid
+        size alone, no matter how many frames are added.
+
+        :param grid: number of grid points along each unit cell vector
+        :param subtract_mean: subtract the mean density of each frame before transforming (removes the q = 0 peak)
+        :param workers: number of threads used by each FFT. -1 uses all available cores
+
+        :type grid: list or tuple
+        :type subtract_mean: bool
+        :type workers: int
+        """
+
+        self.grid = tuple(int(g) for g in grid)
+        self.subtract_mean = subtract_mean
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.nframes = 0
+
+        self.sf = np.zeros(self.grid[:-1] + (self.grid[-1] // 2 + 1,))  # running sum of |F|^2 over half spectrum
+        self.density = np.zeros(self.grid, dtype=np.float32)  # histogram of current frame, reused between frames
+
+        if pyfftw is not None:
+            self.plan = pyfftw.builders.rfftn(self.density, threads=self.workers)
+        else:
+            self.plan = lambda a: scipy.fft.rfftn(a, workers=self.workers)
+
+    def add(self, fractional, weights=None):
+        """ Add a frame
+
+        :param fractional: fractional coordinates of atoms with respect to the unit cell (natoms, 3). Coordinates
+        outside of [0, 1) are wrapped back into the unit cell
+        :param weights: atomic form factor of each atom. If None, every atom has a weight of 1
+
+        :type fractional: numpy.ndarray
+        :type weights: numpy.ndarray
+        """
+
+        index = np.floor(fractional * self.grid).astype(int) % self.grid
+        flat = np.ravel_multi_index(index.T, self.grid)
+        self.density[...] = np.bincount(flat, weights=weights, minlength=self.density.size).reshape(self.grid)
+
+        fft = self.plan(self.density)
+        if self.subtract_mean:
+            fft[(0,) * len(self.grid)] = 0  # equivalent to transforming density - density.mean()
+
+        self.sf += fft.real ** 2 + fft.imag ** 2
+        self.nframes += 1
+
+    def structure_factor(self):
+        """ Structure factor averaged over all frames added so far. The half spectrum is expanded to the full grid
+        using the symmetry S(-q) = S(q) of the transform of a real function
+
+        :return: structure factor with the same ordering as numpy.fft.fftn output, shape grid
+        """
+
+        half = self.grid[-1] // 2 + 1
+        sf = np.zeros(self.grid)
+        sf[..., :half] = self.sf
+
+        # S(q0, q1, q2) = S(-q0, -q1, -q2) fills the remaining q2 values
+        negative = np.ix_(*[(-np.arange(n)) % n for n in self.grid[:-1]])
+        sf[..., half:] = self.sf[negative][..., (self.grid[-1] - np.arange(half, self.grid[-1]))]
+
+        return sf / max(self.nframes, 1)
+
+
+def fft_3D_monoclinic(xyz, box_vectors, bins, angle=60, sf=False, weights=None, workers=-1):
+    """ Calculate the 3D discrete fourier transform of each frame of a trajectory of coordinates in a monoclinic unit
+    cell and average |F|^2 over all frames. Atoms are binned in fractional coordinates of each frame's unit cell,
+    which makes the grid conform to the cell regardless of its shape or fluctuations in its size.
 
     :param xyz: frame-by-frames coordinates of atoms whose 3D DFT we want to calculate
     :param box_vectors: matrix of box vectors of shape (nT, 3, 3)
     :param bins: number of bins in each dimension
-    :return:
+    :param angle: unused. The shape of the unit cell is taken from box_vectors
+    :param sf: subtract the mean density of each frame before taking its fourier transform
+    :param weights: atomic form factor of each atom
+    :param workers: number of threads used by each FFT. -1 uses all available cores
+
+    :return: structure factor on the grid, ordered like numpy.fft.fftn output
     """
 
     nT = xyz.shape[0]  # number of frames
-    L = np.linalg.norm(box_vectors, axis=2)
+    inverse = np.linalg.inv(box_vectors)
 
-    locations, L = rescale(xyz, L)  # make unit cell constant size
+    engine = StructureFactor(bins, subtract_mean=sf, workers=workers)
+    for frame in tqdm.tqdm(range(nT), unit=' Frames'):
+        engine.add(np.matmul(xyz[frame, ...], inverse[frame]), weights=weights)
 
-    # define histograme bin edges
-    x = np.linspace(0, L[0], int(bins[0]))
-    y = np.linspace(0, L[1], int(bins[1]))
-    z = np.linspace(0, L[2], int(bins[2]))
+    return engine.structure_factor()
 
-    zv = [0.0, 0.0, 0.0]  # zero vector
 
-    # put all atoms inside box - works for single frame and multiframe
-    for it in range(locations.shape[0]):  # looped to save memory
-        locations[it, ...] = np.where(locations[it, ...] < L, locations[it, ...], locations[it, ...] - L)  # get positions in periodic cell
-        locations[it, ...] = np.where(locations[it, ...] > zv, locations[it, ...], locations[it, ...] + L)
+def reciprocal_vectors(ucell):
+    """ Reciprocal lattice vectors of a unit cell (without the factor of 2 pi)
 
-    # fourier transform loop
-    sf = np.zeros([x.size - 1, y.size - 1, z.size - 1])
-    for frame in tqdm.tqdm(range(nT), unit=' Frames'):
-        H, edges = np.histogramdd(locations[frame, ...], bins=(x, y, z))
-        if sf:
-            fft = np.fft.fftn(H - H.mean())
-            sf += (fft * fft.conjugate()).real
-        else:
-            sf += np.abs(np.fft.fftn(H)) ** 2
+    :param ucell: unit cell vectors as rows (3, 3)
+
+    :type ucell: numpy.ndarray
+
+    :return: reciprocal lattice vectors as rows (3, 3)
+    """
+
+    a1, a2, a3 = ucell
+
+    b1 = (np.cross(a2, a3)) / (np.dot(a1, np.cross(a2, a3)))
+    b2 = (np.cross(a3, a1)) / (np.dot(a2, np.cross(a3, a1)))
+    b3 = (np.cross(a1, a2)) / (np.dot(a3, np.cross(a1, a2)))
+
+    return np.vstack((b1, b2, b3))
+
+
+def cylindrical_bins(X, Y, Z, rarr, zar, ucell=None):
+    """ Assign every point of a 3D grid to the (r, z) bin whose center it is closest to. The result only depends on
+    the grid and the bins, so it is calculated once and reused for any array defined on the same grid.
+
+    :param X: grid coordinates along the first dimension
+    :param Y: grid coordinates along the second dimension
+    :param Z: grid coordinates along the third dimension
+    :param rarr: evenly spaced r bin centers starting at 0
+    :param zar: evenly spaced z bin centers
+    :param ucell: unit cell vectors. If given, grid coordinates are multiplied by the reciprocal lattice vectors of
+    the cell to get cartesian coordinates (i.e. the inverse of the transformation applied in angle_average)
+
+    :type X: numpy.ndarray
+    :type Y: numpy.ndarray
+    :type Z: numpy.ndarray
+    :type rarr: numpy.ndarray
+    :type zar: numpy.ndarray
+    :type ucell: numpy.ndarray
+
+    :return: flattened index, r_bin * zar.size + z_bin, of each grid point (-1 for points outside of all bins)
+    """
+
+    key = tuple(np.asarray(a, dtype=float).tobytes() for a in (X, Y, Z, rarr, zar)) + \
+        (None if ucell is None else np.asarray(ucell, dtype=float).tobytes(),)
+
+    if key in _cylindrical_bins:
+        return _cylindrical_bins[key]
+
+    if ucell is not None:
+        b = reciprocal_vectors(ucell)
+    else:
+        b = np.eye(3)
+
+    X = np.asarray(X)[:, np.newaxis, np.newaxis]
+    Y = np.asarray(Y)[np.newaxis, :, np.newaxis]
+    Z = np.asarray(Z)[np.newaxis, np.newaxis, :]
+
+    r = np.sqrt((X * b[0, 0] + Y * b[1, 0] + Z * b[2, 0]) ** 2 + (X * b[0, 1] + Y * b[1, 1] + Z * b[2, 1]) ** 2)
+    z = X * b[0, 2] + Y * b[1, 2] + Z * b[2, 2]
+
+    ir = np.rint(r / (rarr[1] - rarr[0])).astype(np.int64)
+    iz = np.rint((z - zar[0]) / (zar[1] - zar[0])).astype(np.int64)
+
+    inside = (ir < rarr.size) & (iz >= 0) & (iz < zar.size)
+    bins = np.where(inside, ir * zar.size + iz, -1).astype(np.int32).ravel()
+
+    if len(_cylindrical_bins) >= _max_cylindrical_bins:
+        del _cylindrical_bins[next(iter(_cylindrical_bins))]  # forget the oldest grid
+    _cylindrical_bins[key] = bins
+
+    return bins
+
+
+def angle_average(X, Y, Z, SF, ucell=None, NBR=80, rmax=-1, zbins=-1, zmax=-1, interpolate=False):
+    """ Average a 3D array about the z axis to get a function of r and z
+
+    By default, each grid point is assigned to its nearest (r, z) bin and bins are averaged with np.bincount. Bin
+    assignments are cached (see cylindrical_bins) so averaging many arrays on the same grid only costs one pass over
+    the data each. With interpolate=True, the array is instead interpolated onto evenly spaced points around circles
+    of each radius, which is slower but does not leave small-r bins empty.
+
+    :param X: grid coordinates along the first dimension
+    :param Y: grid coordinates along the second dimension
+    :param Z: grid coordinates along the third dimension
+    :param SF: array to average, shape (X.size, Y.size, Z.size)
+    :param ucell: unit cell vectors. If given, (r, z) points are transformed into the coordinate system of the unit
+    cell's reciprocal lattice
+    :param NBR: number of r bins
+    :param rmax: largest r. If -1, 95 % of half of the smaller of the x and y ranges of the grid
+    :param zbins: number of z bins. If -1, Z.size
+    :param zmax: largest magnitude of z. If -1, Z[-1]
+    :param interpolate: average by interpolation instead of binning
+
+    :type X: numpy.ndarray
+    :type Y: numpy.ndarray
+    :type Z: numpy.ndarray
+    :type SF: numpy.ndarray
+    :type ucell: numpy.ndarray
+    :type NBR: int
+    :type rmax: float
+    :type zbins: int
+    :type zmax: float
+    :type interpolate: bool
+
+    :return: averaged array (NBR, zbins), with NaN in empty bins, r bin centers and z bin centers
+    """
+
+    ZBINS = Z.shape[0] if zbins == -1 else zbins
+    ZMAX = Z[-1] if zmax == -1 else zmax
+
+    if rmax == -1:
+        Rmax = 0.95 * min(X[-1] - X[0], Y[-1] - Y[0]) / 2.0
+    else:
+        Rmax = rmax
+
+    rarr = np.linspace(0.0, Rmax, NBR)
+    zar = np.linspace(-ZMAX, ZMAX, ZBINS)
+
+    if not interpolate:
+
+        bins = cylindrical_bins(X, Y, Z, rarr, zar, ucell=ucell)
+        inside = bins >= 0
+
+        total = np.bincount(bins[inside], weights=np.ravel(SF)[inside], minlength=rarr.size * zar.size)
+        count = np.bincount(bins[inside], minlength=rarr.size * zar.size)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            oa = np.where(count > 0, total / count, np.nan)
+
+        return oa.reshape(rarr.size, zar.size), rarr, zar
+
+    ES = RegularGridInterpolator((X, Y, Z), SF, bounds_error=False)
+
+    THETA_BINS_PER_INV_ANG = 20.
+    MIN_THETA_BINS = 10  # minimum allowed bins
+
+    if ucell is not None:
+        b_inv = np.linalg.inv(reciprocal_vectors(ucell))
+
+    oa = np.zeros((rarr.shape[0], zar.shape[0]))
+
+    circ = 2. * np.pi * rarr  # circumference
+
+    for ir in range(rarr.shape[0]):
+
+        NTHETABINS = max(int(THETA_BINS_PER_INV_ANG * circ[ir]), MIN_THETA_BINS)  # calculate number of bins at this r
+        thetas = np.linspace(0.0, np.pi * 2.0, NTHETABINS, endpoint=False)  # generate theta array
+
+        t, r, z = np.meshgrid(thetas, rarr[ir], zar)  # generate grid of cylindrical points
+
+        xar = r * np.cos(t)  # set up x,y coords
+        yar = r * np.sin(t)
+
+        pts = np.vstack((xar.ravel(), yar.ravel(), z.ravel())).T  # reshape for interpolation
+
+        if ucell is not None:
+            pts = np.matmul(pts, b_inv)
 
-    sf /= nT  # average of all frames
+        oa[ir, :] = np.average(ES(pts).reshape(r.shape), axis=1)  # store average values in final array
 
-    return sf
\ No newline at end of file
+    return oa, rarr, zar
@@ -60,21 +60,24 @@ if __name__ == "__main__":
     cp = 'cp %s.itp %s.itp.bak' % (args.itp, args.itp)
     subprocess.Popen(cp.split())
 
+    with open(res.itp_file, 'r') as f:
+        itp = f.readlines()
+
     #with open('%s/../top/topologies/%s.itp' % (script_location, args.itp), 'w') as f:
     with open('%s.itp' % args.itp, 'w') as f:
         line = 0
-        while res.itp[line].count('[ atoms ]') == 0:
-            f.write(res.itp[line])
+        while itp[line].count('[ atoms ]') == 0:
+            f.write(itp[line])
             line += 1
-        f.write(res.itp[line])
-        f.write(res.itp[line + 1])
+        f.write(itp[line])
+        f.write(itp[line + 1])
         line += 2
-        while res.itp[line] != '\n':
-            data = res.itp[line].split()
+        while itp[line] != '\n':
+            data = itp[line].split()
             f.write('{:>6d}{:>5s}{:>6d}{:>6s}{:>6s}{:>5d}{:>13.6f}{:>13.6f}\n'.format(int(data[0]), data[1], int(data[2]),
                     data[3], data[4], int(data[5]), charges[data[4]] / 10**args.precision, float(data[7])))
             line += 1
 
-        while line < len(res.itp):
-            f.write(res.itp[line])
+        while line < len(itp):
+            f.write(itp[line])
             line += 1
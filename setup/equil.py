@@ -5,6 +5,7 @@ import os
 import subprocess
 from llcsim.setup.gentop import SystemTopology
 from llcsim.setup.genmdp import SimulationMdp
+from llcsim.llclib import jobs
 
 location = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))  # Directory this script is in
 
@@ -109,34 +110,14 @@ def restrain(gro, build_monomer, force, axis, restraint_atoms):
 
 def simulate(mdp, top, config, out, restrained=False, mpi=False, np=4):
 
-    if mpi:
-        gmx = "mpirun -np %s gmx_mpi" % np
-    else:
-        gmx = "gmx"
-
-    grompp = "%s grompp -f %s -p %s -c %s -o %s" % (gmx, mdp, top, config, out)
-
-    if restrained:
-        grompp += ' -r %s' % config
-
-    p = subprocess.Popen(grompp.split())
-    p.wait()
-
-    mdrun = "%s mdrun -v -deffnm %s" % (gmx, out)
-    p = subprocess.Popen(mdrun.split())
-    p.wait()
+    runner = jobs.Runner(mpi=mpi, nproc=np)
+    runner.grompp(mdp, top, config, out, restraints=config if restrained else None)
+    runner.mdrun(out, verbose=True)
 
 
 def check_energy(logname='em.log'):
 
-    nrg = 1
-
-    with open('%s' % logname) as f:
-        for line in f:
-            if line.count("Potential Energy") == 1:
-                nrg = float(line.split()[3])
-
-    return nrg
+    return jobs.potential_energy(logname, default=1)  # a positive energy means the run failed
 
 
 if __name__ == "__main__":
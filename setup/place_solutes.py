@@ -3,10 +3,10 @@
 import argparse
 import mdtraj as md
 import numpy as np
-from llcsim.llclib import file_rw, transform, physical, topology
+from llcsim.llclib import file_rw, transform, physical, topology, jobs, neighbors
 from llcsim.setup.gentop import SystemTopology
-import subprocess
 import os
+import shutil
 import tqdm
 import matplotlib.path as path
 from scipy import spatial
@@ -23,6 +23,12 @@ def initialize():
     parser.add_argument('-n', '--n_solute', nargs='+', help='Number of solute molecules to add (overrides '
                                                             'concentration')
     parser.add_argument('-s', '--solutes', nargs='+', help='.gro file for solute molecules')
+    parser.add_argument('-j', '--jobs', default=1, type=int, help='Number of candidate placements of each solute to '
+                        'energy minimize at the same time. The lowest energy candidate is kept')
+    parser.add_argument('--bulk', action="store_true", help='Place all solutes at once, removing water molecules they '
+                        'overlap with, and energy minimize a single time')
+    parser.add_argument('-b', '--batch', default=10, type=int, help='If minimization fails in bulk mode, place solutes '
+                        'in batches of this size')
 
     args = parser.parse_args()
 
@@ -235,6 +241,7 @@ class Solvent(object):
         # parallelization
         self.mpi = False  # use mpi / gpu acceleration
         self.np = 1  # number of parallel process
+        self.njobs = 1  # number of candidate placements energy minimized at the same time
 
         self.box_gromacs = [self.box_vectors[0, 0], self.box_vectors[1, 1], self.box_vectors[2, 2],
                             self.box_vectors[0, 1], self.box_vectors[2, 0], self.box_vectors[1, 0],
@@ -278,24 +285,48 @@ class Solvent(object):
         :return:
         """
 
-        # randomly rotate the molecule and then tranlate it to the placement point
-        solute_positions = transform.random_orientation(solute.t.xyz[0, ...], solute.t.xyz[0, 0, :] -
-                                                        solute.t.xyz[0, 1, :], placement_point)
-        self.positions = np.concatenate((self.positions, solute_positions))  # add to array of positions
+        # randomly rotate the molecule and then tranlate it to the placement point. With more than one job, extra
+        # candidates are generated with different orientations (and different points if placing randomly)
+        candidates = []
+        for i in range(max(1, self.njobs)):
+            point = self.random_point_box() if (random and i > 0) else placement_point
+            candidates.append(transform.random_orientation(solute.t.xyz[0, ...], solute.t.xyz[0, 0, :] -
+                                                           solute.t.xyz[0, 1, :], point))
+
+        self.positions = np.concatenate((self.positions, candidates[0]))  # add to array of positions
         self.residues += solute.res  # add solute residues to list of all residues
         self.names += [solute.names.get(i) for i in range(1, solute.natoms + 1)]  # add solute atom names to all names
         self.top.add_residue(solute, write=True)  # add 1 solute to topology
 
-        # write new .gro file
-        file_rw.write_gro_pos(self.positions, self.intermediate_fname, box=self.box_gromacs, ids=self.names,
-                              res=self.residues)
-
         if freeze:
             self.freeze_ndx(solute_placement_point=placement_point, res=solute.resname)
 
-        nrg = self.energy_minimize(self.em_steps, freeze=freeze)
+        # each candidate is minimized in its own directory so that their output files don't collide
+        directories = [None] if len(candidates) == 1 else ['candidate_%d' % i for i in range(len(candidates))]
+
+        # write new .gro file(s)
+        n = self.positions.shape[0] - solute.natoms
+        for d, c in zip(directories, candidates):
+            if d is not None:
+                os.makedirs(d, exist_ok=True)
+            file_rw.write_gro_pos(np.concatenate((self.positions[:n, :], c)), os.path.join(d or '',
+                                  self.intermediate_fname), box=self.box_gromacs, ids=self.names, res=self.residues)
+
+        file_rw.write_em_mdp(self.em_steps, freeze=freeze, freeze_group='Freeze', freeze_dim='xyz', xlink=self.xlink)
 
-        if nrg >= 0:
+        runner = self.runner()
+        energies = runner.map(lambda d: self.minimize(freeze=freeze, cwd=d, runner=runner), directories)
+        best = int(np.argmin(energies))
+
+        if energies[best] < 0 and directories[best] is not None:  # bring the output of the best candidate back here
+            for ext in ['gro', 'tpr', 'log']:
+                shutil.copyfile(os.path.join(directories[best], 'em.%s' % ext), 'em.%s' % ext)
+
+        for d in directories:  # everything needed from the candidates has been copied out
+            if d is not None:
+                shutil.rmtree(d, ignore_errors=True)
+
+        if energies[best] >= 0:
             self.revert(solute)
             if random:
                 self.place_solute_random(solute)
@@ -303,8 +334,7 @@ class Solvent(object):
                 #self.remove_water(placement_point, 3)
                 self.place_solute(solute, placement_point, freeze=True)
         else:
-            p3 = subprocess.Popen(["cp", "em.gro", "%s" % self.intermediate_fname])
-            p3.wait()
+            shutil.copyfile('em.gro', self.intermediate_fname)
             self.positions = md.load('%s' % self.intermediate_fname).xyz[0, :, :]  # update positions
 
     def place_solute_random(self, solute):
@@ -314,7 +344,8 @@ class Solvent(object):
         placement_point = self.random_point_box()  # where to place solute
         self.place_solute(solute, placement_point, random=True)
 
-    def place_solute_pores(self, solute, z=None, layers=20, pores=4, ref=['C', 'C1', 'C2', 'C3', 'C4', 'C5']):
+    def place_solute_pores(self, solute, z=None, layers=20, pores=4, ref=['C', 'C1', 'C2', 'C3', 'C4', 'C5'],
+                           bulk=False):
         """
         Place solute in middle of pores at given z location
         :param solute: solute object
@@ -322,6 +353,8 @@ class Solvent(object):
         :param layers: number of layers in system (when initial configuration was set up) (int)
         :param pores: number of pores in which to place solutes (int)
         :param ref: reference atoms used to define pore center
+        :param bulk: place the solute in every pore at once then energy minimize one time. As when placing them one at a
+        time, the solutes are frozen during minimization so they stay on the pore axes (bool)
         :return:
         """
 
@@ -335,60 +368,57 @@ class Solvent(object):
         if type(z) is float or type(z) is np.float64:
             z = np.array([z for i in range(pores)])
 
-        for i in tqdm.tqdm(range(pores)):
-            placement_point = placement(z[i], self.pore_spline[i, ...], self.box_vectors[:2, :2])
-            self.place_solute(solute, placement_point, freeze=True)
+        points = np.array([placement(z[i], self.pore_spline[i, ...], self.box_vectors[:2, :2]) for i in range(pores)])
+
+        if bulk:
+            self.place_solutes_bulk(solute, pores, points=points, freeze=True)
+        else:
+            for i in tqdm.tqdm(range(pores)):
+                self.place_solute(solute, points[i, :], freeze=True)
+
+    def runner(self):
+        """
+        :return: jobs.Runner set up with this system's parallelization settings
+        """
+
+        return jobs.Runner(max_jobs=self.njobs, mpi=self.mpi, nproc=self.np)
 
     def energy_minimize(self, steps, freeze=False, freeze_group='Freeze', freeze_dim='xyz'):
         """
         Energy minimize a configuration
         :param steps: number of steepest descent energy minimization steps to take
-        :return: coordinates of energy minimized structure, updated coordinates of reference atoms
+        :return: potential energy of the energy minimized structure
         """
 
         # write em.mdp with a given number of steps
         file_rw.write_em_mdp(steps, freeze=freeze, freeze_group='Freeze', freeze_dim='xyz', xlink=self.xlink)
 
-        if freeze:
-            if self.mpi:
-                p1 = subprocess.Popen(
-                    ["mpirun", "-np", "1", "gmx_mpi", "grompp", "-p", "topol.top", "-f", "em.mdp", "-o", "em", "-c",
-                     "%s" % self.intermediate_fname, "-n", "freeze_index.ndx"], stdout=open(os.devnull, 'w'),
-                    stderr=subprocess.STDOUT)  # generate atomic level input file
-            else:
-                p1 = subprocess.Popen(
-                    ["gmx", "grompp", "-p", "topol.top", "-f", "em.mdp", "-o", "em", "-c",
-                     "%s" % self.intermediate_fname,
-                     "-n", "freeze_index.ndx"],
-                    stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)  # generate atomic level input file
-        else:
-            if self.mpi:
-                p1 = subprocess.Popen(
-                    ["mpirun", "-np", "1", "gmx_mpi", "grompp", "-p", "topol.top", "-f", "em.mdp", "-o", "em", "-c",
-                     "%s" % self.intermediate_fname], stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)  # generate atomic level input file
-                p1.wait()
-            else:
-                p1 = subprocess.Popen(
-                    ["gmx", "grompp", "-p", "topol.top", "-f", "em.mdp", "-o", "em", "-c", "%s" % self.intermediate_fname],
-                    stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)  # generate atomic level input file
-        p1.wait()
-
-        if self.mpi:
-            p2 = subprocess.Popen(["mpirun", "-np", "%s" % self.np, "gmx_mpi", "mdrun", "-deffnm", "em"],
-                                  stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)  # run energy minimization
-        else:
-            p2 = subprocess.Popen(["gmx", "mdrun", "-deffnm", "em"], stdout=open(os.devnull, 'w'),
-                                  stderr=subprocess.STDOUT)  # run energy minimization
-        p2.wait()
+        return self.minimize(freeze=freeze)
 
-        nrg = subprocess.check_output(
-            ["awk", "/Potential Energy/ {print $4}", "em.log"])  # get Potential energy from em.log
+    def minimize(self, freeze=False, cwd=None, runner=None):
+        """
+        Energy minimize self.intermediate_fname using em.mdp, topol.top and, if freeze is True, freeze_index.ndx from
+        the current working directory
+        :param freeze: freeze the atoms in freeze_index.ndx (bool)
+        :param cwd: directory containing the configuration and where output is written. Defaults to the current
+        working directory (str)
+        :param runner: jobs.Runner used to launch GROMACS. Defaults to self.runner()
+        :return: potential energy of the energy minimized structure, or 0 if minimization failed
+        """
+
+        here = os.getcwd()
+        if runner is None:
+            runner = self.runner()
 
-        try:
-            return float(nrg.decode("utf-8"))
-        except ValueError:
-            return 0  # If the system did not energy minimize, the above statement will not work because nrg will be an
-            # empty string. Make nrg=0 so placement gets attempted again
+        index = os.path.join(here, 'freeze_index.ndx') if freeze else None
+        nrg = runner.simulate(os.path.join(here, 'em.mdp'), os.path.join(here, 'topol.top'), self.intermediate_fname,
+                              'em', index=index, cwd=cwd)
+
+        if nrg is None:
+            return 0  # If the system did not energy minimize, there is no energy. Make nrg=0 so placement gets
+            # attempted again
+        else:
+            return nrg
 
     def freeze_ndx(self, solute_placement_point=None, rem=None, res=None):
         """
@@ -423,13 +453,173 @@ class Solvent(object):
         :return: (numpy array, (3)) coordinates of a randomly chosen point that lies in box
         """
 
-        A = self.box_vectors[0, :]  # x box vector
-        B = self.box_vectors[1, :]  # y box vector
-        C = self.box_vectors[2, :]  # z box vector
-        u, v, w = np.random.rand(3)  # generate 3 random numbers between 0 and 1
-        pt = np.array([0, 0, 0]) + u * A + v * B + w * C  # places point inside 3D box defined by box vector A, B and C
+        return self.random_points_box(1)[0, :]
+
+    def random_points_box(self, n):
+        """
+        :param n: number of points (int)
+        :return: (numpy array, (n, 3)) coordinates of n randomly chosen points that lie in box
+        """
+
+        uvw = np.random.rand(n, 3)  # generate 3 random numbers between 0 and 1 for each point
+
+        return np.dot(uvw, self.box_vectors)  # places points inside 3D box defined by the box vectors
+
+    def bulk_placements(self, solute, n, points=None, clash=0.2, max_tries=100):
+        """
+        Randomly orient n copies of a solute and place them at the given points, or at random points in the box. Copies
+        that come within 'clash' of a non-water atom or of another copy are redrawn (in a new random orientation, and
+        at a new random point if points were not given). Overlap with water is ignored since clashing waters are
+        removed by insert_solutes()
+        :param solute: Solute object
+        :param n: number of copies (int)
+        :param points: (numpy array, (n, 3)) points at which to place copies. Random points in the box if None
+        :param clash: smallest allowed distance between atoms (float, nm)
+        :param max_tries: give up on copies that still overlap after this many redraws (int)
+        :return: coordinates of placed copies (numpy array [ncopies, solute.natoms, 3]) and the point each was placed
+        at (numpy array [ncopies, 3])
+        """
+
+        random = points is None
+        candidates = self.random_points_box(n) if random else np.array(points)
+
+        not_water = np.array([r != 'SOL' for r in self.residues])
+        fixed = self.positions[not_water, :]  # atoms that copies must avoid
+
+        copies = []
+        placed = []
+        for tries in range(max_tries):
+
+            xyz = np.array([transform.random_orientation(solute.t.xyz[0, ...], solute.t.xyz[0, 0, :] -
+                                                         solute.t.xyz[0, 1, :], p) for p in candidates])
+            flat = xyz.reshape(-1, 3)
+            owner = np.repeat(np.arange(len(candidates)), solute.natoms)  # copy each atom belongs to
+
+            accept = np.ones(len(candidates), dtype=bool)
+            i, j, d = neighbors.pairs(flat, self.box_vectors, clash, y=fixed)
+            accept[owner[i]] = False
+            if copies:
+                i, j, d = neighbors.pairs(flat, self.box_vectors, clash, y=np.concatenate(copies).reshape(-1, 3))
+                accept[owner[i]] = False
+
+            # copies that overlap each other. Keep the first of each overlapping set
+            i, j, d = neighbors.pairs(flat, self.box_vectors, clash)
+            a, b = owner[i], owner[j]
+            for c in np.unique(b[a < b]):
+                if accept[c] and np.any(accept[a[(b == c) & (a < c)]]):
+                    accept[c] = False
 
-        return pt
+            copies += list(xyz[accept])
+            placed += list(candidates[accept])
+
+            if accept.all():
+                break
+
+            ndx = np.nonzero(~accept)[0]
+            candidates = self.random_points_box(ndx.size) if random else candidates[ndx]
+
+        if len(copies) < n:
+            print('WARNING: Only %d of %d copies of %s could be placed without overlaps' % (len(copies), n,
+                                                                                            solute.resname))
+
+        return np.array(copies).reshape(-1, solute.natoms, 3), np.array(placed).reshape(-1, 3)
+
+    def insert_solutes(self, solute, copies, clash=0.2):
+        """
+        Add copies of a solute to the system, removing any water molecules with an atom within 'clash' of a solute atom
+        :param solute: Solute object
+        :param copies: coordinates of each copy (numpy array [ncopies, solute.natoms, 3])
+        :param clash: water molecules closer than this to a solute are removed (float, nm)
+        """
+
+        flat = copies.reshape(-1, 3)
+
+        water_atoms = np.nonzero(np.array([r == 'SOL' for r in self.residues]))[0]
+        if water_atoms.size > 0:
+            i, j, d = neighbors.pairs(flat, self.box_vectors, clash, y=self.positions[water_atoms, :])
+            # water molecule (index into self.water) that each clashing atom belongs to
+            rm = np.unique(np.searchsorted(self.water, water_atoms[np.unique(j)], side='right') - 1)
+            self.remove_waters(rm, write=False)
+
+        self.positions = np.concatenate((self.positions, flat))
+        self.residues += solute.res * copies.shape[0]
+        self.names += [solute.names.get(i) for i in range(1, solute.natoms + 1)] * copies.shape[0]
+        self.top.add_residue(solute, n=copies.shape[0], write=True)
+
+    def relax(self, res=None):
+        """
+        Write the current configuration and energy minimize it. If minimization succeeds, positions are updated
+        :param res: freeze all atoms of this residue during energy minimization (str)
+        :return: potential energy of the energy minimized structure, or 0 if minimization failed
+        """
+
+        self.write_config(name=self.intermediate_fname)
+        if res is not None:
+            self.freeze_ndx(res=res)
+        nrg = self.energy_minimize(self.em_steps, freeze=(res is not None))
+
+        if nrg < 0:
+            shutil.copyfile('em.gro', self.intermediate_fname)
+            self.positions = md.load('%s' % self.intermediate_fname).xyz[0, :, :]  # update positions
+
+        return nrg
+
+    def save_state(self):
+        """
+        :return: everything needed to undo changes made by insert_solutes()
+        """
+
+        return (self.positions.copy(), list(self.residues), list(self.names), list(self.water),
+                list(self.top.residues), dict(self.top.residue_count), list(self.top.ions))
+
+    def restore_state(self, state):
+        """
+        Undo changes made since save_state() was called
+        :param state: output of save_state()
+        """
+
+        positions, residues, names, water, top_residues, count, ions = state
+        self.positions = positions.copy()
+        self.residues, self.names, self.water = list(residues), list(names), list(water)
+        self.top.residues, self.top.residue_count, self.top.ions = list(top_residues), dict(count), list(ions)
+        self.top.write_top()
+
+    def place_solutes_bulk(self, solute, n, points=None, batch=10, clash=0.2, freeze=False):
+        """
+        Place many copies of a solute at once. All placement points are drawn (or given) together, overlaps are
+        rejected with a periodic neighbor search, water molecules in the way are removed and the system is energy
+        minimized a single time. If that minimization fails, the copies are added in batches, minimizing after each
+        one, and copies in a batch that still fails are placed one at a time with place_solute()
+        :param solute: Solute object
+        :param n: number of copies to place (int)
+        :param points: (numpy array, (n, 3)) placement points. Random points in the box if None
+        :param batch: number of copies per batch if the bulk minimization fails (int)
+        :param clash: smallest allowed distance between atoms when placing copies (float, nm)
+        :param freeze: freeze the solutes during energy minimization so they stay at their placement points (bool)
+        """
+
+        random = points is None
+        res = solute.resname if freeze else None
+        copies, placed = self.bulk_placements(solute, n, points=points, clash=clash)
+
+        state = self.save_state()
+        self.insert_solutes(solute, copies, clash=clash)
+        if self.relax(res=res) < 0:
+            return
+
+        print('Energy minimization of all %d solutes failed. Placing them in batches of %d' % (len(copies), batch))
+        self.restore_state(state)
+
+        for b in tqdm.tqdm(range(0, len(copies), batch)):
+            state = self.save_state()
+            self.insert_solutes(solute, copies[b:(b + batch)], clash=clash)
+            if self.relax(res=res) >= 0:
+                self.restore_state(state)
+                for p in placed[b:(b + batch)]:
+                    if random:
+                        self.place_solute_random(solute)
+                    else:
+                        self.place_solute(solute, p, freeze=True)
 
     def revert(self, solute):
         """
@@ -456,21 +646,31 @@ class Solvent(object):
         """
 
         tree = spatial.cKDTree(self.positions[self.water, :])
-        rm = []
-
         nn = tree.query(point, k=n)[1]
-        for j in nn:
-            rm.append(self.water[j])
-            rm.append(self.water[j] + 1)
-            rm.append(self.water[j] + 2)
+
+        self.remove_waters(np.atleast_1d(nn))
+
+    def remove_waters(self, rm, write=True):
+        """
+        Remove water molecules from the system
+        :param rm: indices (with respect to self.water) of water molecules to remove (numpy array)
+        :param write: write the updated topology (bool)
+        """
+
+        oxygens = np.array(self.water)[rm]
+
+        keep = np.ones(len(self.residues), dtype=bool)
+        for i in range(3):  # oxygen then two hydrogens
+            keep[oxygens + i] = False
 
         # update relevant arrays
-        self.positions = np.delete(self.positions, rm, axis=0)
-        self.residues = [self.residues[x] for x in range(len(self.residues)) if x not in rm]
-        self.names = [self.names[x] for x in range(len(self.names)) if x not in rm]
-        self.water = [i for i, x in enumerate(self.residues) if x == 'SOL' and self.names[i] == 'OW']
+        self.positions = self.positions[keep, :]
+        self.residues = [r for r, k in zip(self.residues, keep) if k]
+        self.names = [name for name, k in zip(self.names, keep) if k]
+        water = np.array([r == 'SOL' and name == 'OW' for r, name in zip(self.residues, self.names)])
+        self.water = list(np.nonzero(water)[0])
 
-        self.top.remove_residue(self.water_top, n, write=True)
+        self.top.remove_residue(self.water_top, len(rm), write=write)
 
 # Revamped in llclib.topology
 # class Solute(object):
@@ -553,6 +753,7 @@ if __name__ == "__main__":
     os.environ["GMX_MAXBACKUP"] = "-1"  # stop GROMACS from making backups
 
     solvent = Solvent(args.gro)
+    solvent.njobs = args.jobs
     if args.concentration:
         concentration = [float(i) for i in args.concentration]
     elif args.n_solute:
@@ -614,8 +815,11 @@ if __name__ == "__main__":
     #     solvent.place_solute(solutes[n])
 
     for i in range(len(nsolute)):
-        for sol in tqdm.tqdm(range(nsolute[i])):
-            solvent.place_solute_random(solutes[i])
+        if args.bulk:
+            solvent.place_solutes_bulk(solutes[i], nsolute[i], batch=args.batch)
+        else:
+            for sol in tqdm.tqdm(range(nsolute[i])):
+                solvent.place_solute_random(solutes[i])
 
     from pathlib import Path
 
@@ -21,6 +21,10 @@ def initialize():
     parser.add_argument('-mdps', '--generate_mdps', action="store_true", help='Create input .mdp files')
     parser.add_argument('-noxlink', action="store_false", help='If the system is not cross-linked, add this flag')
     parser.add_argument('-mpi', '--mpi', default=False, help="Specify number of MPI processes")
+    parser.add_argument('-j', '--jobs', default=1, type=int, help='Number of candidate placements of each solute to '
+                        'energy minimize at the same time')
+    parser.add_argument('--bulk', action="store_true", help='Place the solutes at each z location in all pores at once '
+                        'and energy minimize a single time')
 
     return parser
 
@@ -38,10 +42,12 @@ if __name__ == "__main__":
         solvent.mpi = True
         solvent.np = int(args.mpi)
 
+    solvent.njobs = args.jobs
+
     zbox = solvent.box_vectors[2, 2]
     z = np.linspace(0, zbox, args.nsolutes*2 + 1)[1::2]  # equally space residues
     for i in range(args.nsolutes):
-            solvent.place_solute_pores(solute, z=z[i])
+            solvent.place_solute_pores(solute, z=z[i], bulk=args.bulk)
 
     solvent.write_config(name='%s' % args.out)
 
@@ -2,9 +2,9 @@
 
 import numpy as np
 from llcsim.setup import place_solutes, genmdp
+from llcsim.llclib import jobs
 import argparse
 import os
-import subprocess
 
 
 def initialize():
@@ -32,6 +32,8 @@ def initialize():
                                                        'constant (kJ / mol / nm^2)')
     parser.add_argument('-r', '--ref', default=['C', 'C1', 'C2', 'C3', 'C4', 'C5'], nargs='+', help='Atoms to use for'
                         'center of mass reference groups. Also dictates placement of solutes')
+    parser.add_argument('-j', '--jobs', default=1, type=int, help='Number of umbrella windows to run grompp on at the '
+                        'same time')
 
     args = parser.parse_args()
 
@@ -245,10 +247,8 @@ if __name__ == "__main__":
     #     write = False
 
     # write default index groups using GROMACS (creates index.ndx by default)
-    ps = subprocess.Popen(['echo', 'q'], stdout=subprocess.PIPE)
-    ps2 = subprocess.Popen(['gmx', 'make_ndx', '-f', '%s_1.gro' % args.output], stdin=ps.stdout,
-                           stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
-    ps2.wait()
+    runner = jobs.Runner(max_jobs=args.jobs)
+    runner.run(jobs.Job(runner.gmx('make_ndx', '-f', '%s_1.gro' % args.output), stdin='q\n'))
 
     ref_groups, res_groups = create_individual_pull_groups(system, solute, args.n_configs, args.ref_layer, args.layers,
                                                            args.pores, ref=args.ref, write=write)
@@ -259,12 +259,12 @@ if __name__ == "__main__":
     mdp = genmdp.SimulationMdp(args.gro, T=args.temp, length=args.sim_length, tau_p=1, nstxout=nst, nstvout=nst,
                                nstfout=nst)
 
-    # write separate .mdp files for each system since pull groups are different, then grompp them
+    # write separate .mdp files for each system since pull groups are different, then grompp them. The windows are
+    # independent so several can be grompp'd at once
     for i in range(args.n_configs):
         mdp.write_npt_mdp(out='pull_%d' % (i + 1))  # write pull.mdp for an NPT simulation without pull parameters
         mdp.add_pull_groups(ref_groups[i], res_groups[i], force_constant, 0, 'pull_%d.mdp' % (i + 1))  # add pull params
-        p = subprocess.Popen(['gmx', 'grompp', '-f', 'pull_%d.mdp' % (i + 1), '-p', 'topol.top', '-n', 'index.ndx',
-                              '-c', '%s_%d.gro' % (args.output, i + 1), '-o', '%s_%d' % (args.output, i + 1)],
-                             stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
-        p.wait()
+
+    runner.map(lambda i: runner.grompp('pull_%d.mdp' % (i + 1), 'topol.top', '%s_%d.gro' % (args.output, i + 1),
+                                       '%s_%d' % (args.output, i + 1), index='index.ndx'), range(args.n_configs))
     print('Success!')
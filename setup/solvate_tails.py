@@ -4,9 +4,7 @@ import argparse
 import mdtraj as md
 import numpy as np
 import random
-from llcsim.llclib import transform, file_rw, topology
-import subprocess
-import copy
+from llcsim.llclib import transform, file_rw, topology, jobs, neighbors
 import os, glob
 import sys
 import time
@@ -32,6 +30,8 @@ def initialize():
                                                                'water molecules (nm)')
     parser.add_argument('-n', '--nwater', default=600, type=int, help='Number of waters to add to the system')
     parser.add_argument('--restrained', action="store_true", help='Add flag if system contains position restraints')
+    parser.add_argument('-b', '--batch', default=50, type=int, help='Largest number of water molecules inserted between '
+                        'energy minimizations')
 
     args = parser.parse_args()
 
@@ -126,9 +126,7 @@ class System(object):
         self.mpi = mpi
         self.np = nproc
 
-        self.gmx = "gmx"
-        if self.mpi:
-            self.gmx = "mpirun -np %s gmx_mpi" % self.np
+        self.runner = jobs.Runner(mpi=self.mpi, nproc=self.np)
 
         # handle mdtraj renaming SOL to HOH
         self.res = []
@@ -173,6 +171,14 @@ class System(object):
         self.water_ids = ['OW', 'HW1', 'HW2']  # water atom names
         self.water_res = ['SOL', 'SOL', 'SOL']  # water residue name
 
+        # parameters of the in-process overlap screen applied to candidate water molecules before GROMACS sees them
+        self.dmin = 0.1  # candidates with any atom closer than this to another atom are rejected (nm)
+        self.sigma = 0.315  # Lennard-Jones parameters used to estimate the energy of placing a water oxygen next to a
+        self.epsilon = 0.636  # heavy atom (TIP3P oxygen values. nm, kJ/mol)
+        self.cutoff = 0.6  # cutoff of Lennard-Jones estimate (nm)
+        self.max_overlap = 25  # candidates whose estimated Lennard-Jones energy is higher than this are rejected (kJ/mol)
+        self.max_energy = -50000  # batches whose energy after minimization is higher than this are rejected (kJ/mol)
+
         write_em_mdp(5)  # 5 step energy minimization
 
     def add_water_placeholder(self):
@@ -204,37 +210,84 @@ class System(object):
             for line in self.top:
                 f.write(line)
 
-    def place_water(self, nwater, steps):
+    def candidate_waters(self, n):
+        """
+        Randomly place and orient water molecules near n different, randomly chosen, reference atoms
+        :param n: number of candidate water molecules (int)
+        :return: indices of reference atoms used for placement (numpy array [n]), coordinates of candidate water
+        molecules (numpy array [n, 3, 3])
+        """
+
+        placement_atoms = np.random.choice(self.placement_options, size=n, replace=False)
+
+        waters = np.zeros([n, self.water.shape[0], 3])
+        for i, a in enumerate(placement_atoms):
+            placement = random_pt_spherical_shell(self.ref_atom_locations[a, :], self.rmin, self.rmax)  # point near atom
+            waters[i, ...] = transform.random_orientation(self.water, self.water_alignment_vector, placement)
+
+        return placement_atoms, waters
+
+    def prescreen(self, waters):
+        """
+        Check candidate water molecules for overlaps without calling GROMACS. A candidate is rejected if any of its atoms
+        is within self.dmin of another atom or if the Lennard-Jones energy of its oxygen with the heavy atoms of the
+        system (estimated with a single set of parameters, self.sigma and self.epsilon) is above self.max_overlap.
+        Candidates that pass are then accepted in order as long as they don't overlap with a candidate that was already
+        accepted.
+        :param waters: coordinates of candidate water molecules (numpy array [n, 3, 3])
+        :return: boolean mask of accepted candidates
         """
-        Place water molecules near a random reference atom and perform a short energy minimization
-        :param placement_options: All of the possible indexes of reference atoms near which a water molecule could be placed (list)
-        :param ref_atom_locations: xyz coordinates of reference atoms (numpy array [number of ref atoms, 3]
-        :param coordinates: Coordinates of full system (numpy array [natoms, 3])
-        :param rmin: minimimum distance to place water molecules from reference atom (float)
-        :param rmax: maximum distance to place water molecules from reference atom (float)
-        :param ids: all atom names in order they appear in coordinates (list)
-        :param res: all residue atoms in order they appear in coordinates (list)
-        :param nwater: number of water molecules in the system (int)
+
+        n, natoms = waters.shape[:2]
+        box = self.full_box[0, ...]
+        flat = waters.reshape(-1, 3)
+        owner = np.repeat(np.arange(n), natoms)  # candidate each atom belongs to
+
+        # contacts with atoms already in the system
+        i, j, d = neighbors.pairs(flat, box, self.dmin, y=self.coordinates)
+        accept = np.ones(n, dtype=bool)
+        accept[owner[i]] = False
+
+        heavy = np.array([not name.startswith('H') for name in self.ids])
+        oxygens = waters[:, 0, :]
+        i, j, d = neighbors.pairs(oxygens, box, self.cutoff, y=self.coordinates[heavy, :])
+        sr6 = (self.sigma / d) ** 6
+        overlap = np.bincount(i, weights=4 * self.epsilon * (sr6 ** 2 - sr6), minlength=n)
+        accept &= overlap < self.max_overlap
+
+        # contacts between candidates
+        i, j, d = neighbors.pairs(flat, box, self.dmin)
+        conflicts = [[] for _ in range(n)]
+        for a, b in zip(owner[i], owner[j]):
+            if a != b:
+                conflicts[a].append(b)
+
+        for c in range(n):
+            if accept[c] and any(accept[other] for other in conflicts[c] if other < c):
+                accept[c] = False
+
+        return accept
+
+    def place_waters(self, waters, nwater, steps):
+        """
+        Add water molecules to the system and perform a short energy minimization
+        :param waters: coordinates of water molecules to add (numpy array [n, 3, 3])
+        :param nwater: number of water molecules in the system before adding these (int)
         :param steps: number of energy minimization steps to take (int)
-        :return: Potential energy of slightly minimized system, coordinates of minimized system, atom used for placement,
-        new locations of reference atoms
+        :return: Potential energy of slightly minimized system, coordinates of minimized system, new locations of
+        reference atoms
         """
 
-        placement_atom = np.random.choice(self.placement_options)  # choose which atom to place water molecule near
-        placement = random_pt_spherical_shell(self.ref_atom_locations[placement_atom, :], self.rmin,
-                                                          self.rmax)  # point near placement atom
-        placed_water_coordinates = transform.random_orientation(self.water, self.water_alignment_vector, placement)
-        new_coordinates = np.concatenate((self.coordinates, placed_water_coordinates),
-                                         axis=0)  # add to full list of coordinates
-        names = self.ids + self.water_ids  # add water to ids
-        residues = self.res + self.water_res  # add water residue to res
+        n = waters.shape[0]
+        new_coordinates = np.concatenate((self.coordinates, waters.reshape(-1, 3)), axis=0)  # add to full list
+        names = self.ids + self.water_ids * n  # add water to ids
+        residues = self.res + self.water_res * n  # add water residue to res
         file_rw.write_gro_pos(new_coordinates, 'water.gro', ids=names, res=residues,
                               box=self.box_gromacs)  # write out config with new water
-        minimized_coordinates, new_ref_atom_locations = self.energy_minimize(steps, nwater + 1)  # energy minimzed system
-        nrg = subprocess.check_output(
-            ["awk", "/Potential Energy/ {print $4}", "em.log"])  # get Potential energy from em.log
+        minimized_coordinates, new_ref_atom_locations = self.energy_minimize(steps, nwater + n)  # energy minimzed system
+        nrg = jobs.potential_energy('em.log', default=0)  # a failed minimization counts as a rejected batch
 
-        return float(nrg.decode("utf-8")), minimized_coordinates, placement_atom, new_ref_atom_locations
+        return nrg, minimized_coordinates, new_ref_atom_locations
 
     def energy_minimize(self, steps, nwater):
         """
@@ -246,23 +299,18 @@ class System(object):
 
         write_em_mdp(steps)  # write em.mdp with a given number of steps
 
-        cp = "cp placeholder_top.top top_intermediate.top"
-        p1 = subprocess.Popen(cp.split())  # make a copy of placeholder_top.top
-        p1.wait()
+        # make a copy of placeholder_top.top with the current number of water molecules
+        with open('placeholder_top.top') as f:
+            top = f.read()
+        with open('top_intermediate.top', 'w') as f:
+            f.write(top.replace('PLACEHOLDER', str(nwater)))
 
-        sed = "sed -i -e s/PLACEHOLDER/%s/g top_intermediate.top" % nwater
-        p2 = subprocess.Popen(sed.split())
-        p2.wait()
+        if os.path.isfile('em.log'):
+            os.remove('em.log')  # so a failed minimization is not mistaken for the previous one
 
-        grompp = "%s grompp -f em.mdp -p top_intermediate.top -c water.gro -o em" % self.gmx
-        if self.restraints:
-            grompp += " -r water.gro"
-        p3 = subprocess.Popen(grompp.split(), stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
-        p3.wait()
-
-        mdrun = "%s mdrun -deffnm em" % self.gmx
-        p4 = subprocess.Popen(mdrun.split(), stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
-        p4.wait()
+        self.runner.grompp('em.mdp', 'top_intermediate.top', 'water.gro', 'em',
+                           restraints='water.gro' if self.restraints else None)
+        self.runner.mdrun('em')
 
         t = md.load('em.gro')
         minimized_coordinates = t.xyz[0, :, :]  # coordinates of energy minimized system
@@ -270,58 +318,99 @@ class System(object):
 
         return minimized_coordinates, new_ref_atom_locations
 
-    def insert_all_water(self, nwater, output='solvated.gro', final_topname='topol.top'):
-
-        trials = 0  # number of water placement tries
-        # start = time.time()
-
-        for i in tqdm.tqdm(range(nwater), unit='waters'):
-            # randomly place water molecule and do short energy minimization
-            energy, new_coordinates, placement_atom, new_ref_atom_locations = self.place_water(i, 5)
-            trials += 1
-            count = 0
-            while energy > -50000:  # make sure the potential energy doesn't get too close to exploding
-
-                energy, new_coordinates, placement_atom, new_ref_atom_locations = self.place_water(i, 5)
-                trials += 1
-                count += 1
-                if count > 10:
-                    # if the energy is too high for water placement, run a longer energy minimization
-                    sys.stdout.write("\r Running longer energy minimization...                                         "
-                                     "                \r")
-                    sys.stdout.flush()
-                    file_rw.write_gro_pos(self.coordinates, 'water.gro', box=self.box_gromacs, ids=self.ids, res=self.res)
-                    self.coordinates, self.ref_atom_locations = self.energy_minimize(500, i)  # energy minimize and update coordinates
-                    count = 0
-                    write_em_mdp(1)
-
-            # success_rate = 100*((i + 1) / trials)
-            # s = "Waters placed: %s/%s, Placement Success Rate : %3.2f, Potential Energy = %s\r" % (i, nwater,
-            #                                                                                        success_rate, energy)
-            # sys.stdout.write("\r"+s)
-            # sys.stdout.flush()
-            self.ids += self.water_ids
-            self.res += self.water_res
-            self.coordinates = copy.deepcopy(new_coordinates)
-            self.placement_options.remove(placement_atom)
-            for filename in glob.glob("./#*"):
-                os.remove(filename)
-
-        cp = "cp top_intermediate.top %s" % final_topname
-        p = subprocess.Popen(cp.split())
-        p.wait()
+    def insert_all_water(self, nwater, output='solvated.gro', final_topname='topol.top', batch=50, max_fallbacks=10):
+        """
+        Add water molecules to the tails. Candidate water molecules are screened for overlaps in-process (see
+        prescreen()) so that GROMACS only has to minimize batches of waters that are likely to be accepted. If a batch
+        is rejected, the batch size is halved. It grows again after successful batches.
+        :param nwater: number of water molecules to add (int)
+        :param output: name of final energy minimized configuration (str)
+        :param final_topname: name of final topology (str)
+        :param batch: largest number of water molecules inserted between energy minimizations (int)
+        :param max_fallbacks: give up after this many longer energy minimizations in a row fail to make room for any
+        more water (int)
+        """
+
+        nplaced = 0  # number of water molecules placed so far
+        size = batch  # current batch size
+        count = 0  # number of consecutive rejected batches
+        fallbacks = 0  # number of longer energy minimizations since water was last placed
+
+        with tqdm.tqdm(total=nwater, unit='waters') as bar:
+
+            while nplaced < nwater:
+
+                n = min(size, nwater - nplaced, len(self.placement_options))
+                if n == 0:
+                    print('\nRan out of reference atoms near which to place water. Placed %d of %d water molecules'
+                          % (nplaced, nwater))
+                    break
+
+                placement_atoms, waters = self.candidate_waters(n)
+                accepted = self.prescreen(waters)
+
+                if accepted.any():
+
+                    placement_atoms, waters = placement_atoms[accepted], waters[accepted]
+
+                    # place waters and do short energy minimization
+                    energy, new_coordinates, new_ref_atom_locations = self.place_waters(waters, nplaced, 5)
+
+                    # make sure the potential energy doesn't get too close to exploding
+                    rejected = energy > self.max_energy
+
+                else:  # every candidate overlaps existing atoms. Treat it like a batch rejected after minimization
+
+                    rejected = True
+
+                if rejected:
+                    size = max(1, size // 2)
+                    count += 1
+                    if count > 10:
+                        if fallbacks >= max_fallbacks:
+                            print('\nWARNING: The system is too crowded to add more water. Placed %d of %d water '
+                                  'molecules' % (nplaced, nwater))
+                            break
+                        # if the energy is too high for water placement, run a longer energy minimization
+                        sys.stdout.write("\r Running longer energy minimization...                                     "
+                                         "                    \r")
+                        sys.stdout.flush()
+                        file_rw.write_gro_pos(self.coordinates, 'water.gro', box=self.box_gromacs, ids=self.ids,
+                                              res=self.res)
+                        self.coordinates, self.ref_atom_locations = self.energy_minimize(500, nplaced)  # energy minimize and update coordinates
+                        count = 0
+                        fallbacks += 1
+                        write_em_mdp(5)
+                    continue
+
+                self.ids += self.water_ids * waters.shape[0]
+                self.res += self.water_res * waters.shape[0]
+                self.coordinates = new_coordinates
+                self.ref_atom_locations = new_ref_atom_locations
+                for a in placement_atoms:
+                    self.placement_options.remove(a)
+
+                nplaced += waters.shape[0]
+                bar.update(waters.shape[0])
+                size = min(batch, 2 * size)
+                count = 0
+                fallbacks = 0
+
+                for filename in glob.glob("./#*"):
+                    os.remove(filename)
+
+        # write the accepted configuration and matching topology (the last minimization may have been rejected)
+        file_rw.write_gro_pos(self.coordinates, 'water.gro', box=self.box_gromacs, ids=self.ids, res=self.res)
+        with open('placeholder_top.top') as f:
+            top = f.read()
+        with open(final_topname, 'w') as f:
+            f.write(top.replace('PLACEHOLDER', str(nplaced)))
 
         # energy minimize final configuration until convergence
         write_em_mdp(-1)
-        grompp = "%s grompp -f em.mdp -p %s -c water.gro -o %s" % (self.gmx, final_topname, output.split('.')[0])
-        if self.restraints:
-            grompp += " -r water.gro"
-        p = subprocess.Popen(grompp.split())
-        p.wait()
-
-        mdrun = "%s mdrun -v -deffnm %s" % (self.gmx, output.split('.')[0])
-        p = subprocess.Popen(mdrun.split())
-        p.wait()
+        self.runner.grompp('em.mdp', final_topname, 'water.gro', output.split('.')[0],
+                           restraints='water.gro' if self.restraints else None)
+        self.runner.mdrun(output.split('.')[0], verbose=True)
 
 
 if __name__ == "__main__":
@@ -332,7 +421,7 @@ if __name__ == "__main__":
         os.remove(args.out)
 
     system = System(args.gro, args.top, args.monomer, rbounds=[args.rmin, args.rmax], restraints=args.restrained)
-    system.insert_all_water(args.nwater)
+    system.insert_all_water(args.nwater, batch=args.batch)
 
     # water = md.load('%s/../top/solutes/water.gro')  # load water structure
     # water_xyz = water.xyz[0, :, :]  # get water coordinates
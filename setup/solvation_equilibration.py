@@ -3,7 +3,7 @@
 import argparse
 import subprocess
 import sqlite3 as sql
-from llcsim.llclib import topology, file_rw
+from llcsim.llclib import topology, file_rw, jobs
 from llcsim.analysis import solute_partitioning
 from llcsim.setup import lc_class, equil, solvate_tails
 import numpy as np
@@ -29,7 +29,7 @@ def initialize():
 
     # parallelization
     parser.add_argument('-mpi', '--mpi', action="store_true", help='Run MD simulations in parallel')
-    parser.add_argument('-np', '--nproc', default=4, help='Number of MPI processes')
+    parser.add_argument('-np', '--nproc', default=4, type=int, help='Number of MPI processes')
 
     # same flags as to build.py
     parser.add_argument('-b', '--build_monomer', default='NAcarb11V.gro', type=str, help='Name of single monomer'
@@ -203,13 +203,9 @@ class System(object):
     def calculate_pore_water(self):
 
         # solvate the system
-        if self.args.mpi:
-            gmx = "mpirun -np %s gmx_mpi" % self.args.nproc
-        else:
-            gmx = "gmx"
-
-        cmd = "%s solvate -cp %s.gro -cs spc216.gro -o solvated.gro -p topol.top" % (gmx, self.args.forces[0])
-        subprocess.call(cmd.split())
+        runner = jobs.Runner(mpi=self.args.mpi, nproc=self.args.nproc)
+        runner.run(jobs.Job(runner.gmx('solvate', '-cp', '%s.gro' % self.args.forces[0], '-cs', 'spc216.gro', '-o',
+                                       'solvated.gro', '-p', 'topol.top')))
 
         pore_defining_atoms = lc_class.LC(self.args.build_monomer).pore_defining_atoms
 
@@ -5,12 +5,11 @@ import argparse
 import time
 import os
 import numpy as np
-import subprocess
 from llcsim.setup.add_dummies import add_dummies
 from llcsim.setup.gentop import SystemTopology
 from llcsim.setup.genmdp import SimulationMdp
-from llcsim.llclib import file_rw
-from scipy.sparse import lil_matrix
+from llcsim.llclib import file_rw, neighbors, jobs, topology
+from scipy.sparse import csr_matrix
 
 
 def initialize():
@@ -69,15 +68,9 @@ class Atoms(object):
 
     def __init__(self, res, nres):
 
-        natoms = res.natoms
-        self.type = np.zeros([nres*natoms], dtype=object)
-        self.charge = np.zeros([nres*natoms])
-        self.mass = np.zeros([nres*natoms])
-
-        for i in range(len(res.atom_info)):
-            self.type[i::natoms] = str(res.atom_info[i][1])
-            self.charge[i::natoms] = float(res.atom_info[i][6])
-            self.mass[i::natoms] = float(res.atom_info[i][7])
+        self.type = np.tile(res.topology.types.astype(object), nres)
+        self.charge = np.tile(res.topology.charges, nres)
+        self.mass = np.tile(res.topology.masses, nres)
 
 
 class Residue(object):
@@ -102,15 +95,16 @@ class Residue(object):
 
         if not self.is_ion:
 
+            itp_file = '%s/../top/topologies/%s.itp' % (location, name)
+            self.topology = topology.read_itp(itp_file)  # atoms and bonds, parsed once and cached
+
             self.itp = []
-            with open('%s/../top/topologies/%s.itp' % (location, name), 'r') as f:
+            with open(itp_file, 'r') as f:
                 for line in f:
                     self.itp.append(line)
 
-            self.bonds = self.get_bonds()
-
-            self.atom_info = self.get_atoms()
-            self.natoms = len(self.atom_info)
+            self.bonds = (self.topology.bonds + 1).tolist()  # serial numbers of bonded atoms
+            self.natoms = self.topology.natoms
 
             self.virtual_sites = self.get_vsites()
             self.improper_dihedrals = self.get_improper_dihedrals()
@@ -124,55 +118,9 @@ class Residue(object):
 
         """
 
-        with open('%s/../top/topologies/ions.txt' % location) as f:
-            ions = []
-            for line in f:
-                if line[0] != '#':
-                    ions.append(str.strip(line))
-
-        if self.name in ions:
+        if self.name in topology.ions():
             self.is_ion = True
 
-    def get_atoms(self):
-        """ Store all information inside the "[ atoms ]" section of name.itp
-
-        """
-
-        atoms_index = 0
-        while self.itp[atoms_index].count('[ atoms ]') == 0:
-            atoms_index += 1
-        atoms_index += 1
-
-        while self.itp[atoms_index].split()[0] == ';':
-            atoms_index += 1
-
-        atoms = []
-        while self.itp[atoms_index] != '\n':
-            atoms.append(self.itp[atoms_index].split())
-            atoms_index += 1
-
-        return atoms
-
-    def get_bonds(self):
-        """ Store all information in the "[ bonds ]" section of name.itp
-
-        """
-
-        bonds_index = 0
-        while self.itp[bonds_index].count('[ bonds ]') == 0:
-            bonds_index += 1
-        bonds_index += 1
-
-        while self.itp[bonds_index].split()[0] == ';':
-            bonds_index += 1
-
-        bonds = []
-        while self.itp[bonds_index] != '\n':
-            bonds.append([int(self.itp[bonds_index].split()[i]) for i in range(2)])
-            bonds_index += 1
-
-        return bonds
-
     def get_improper_dihedrals(self):
         """ Store all information in the "[ dihedrals ] ; impropers" section of name.itp
 
@@ -276,35 +224,37 @@ class Topology():
         self.xlink_residue_atoms = Atoms(self.xlink_residue, self.nresidues[self.xlink_residue_name])
 
         # get all bonds
-        self.all_bonds = []
         natoms = self.residues[self.res_ndx].natoms
-        bonds = self.residues[self.res_ndx].bonds
-        for i in range(self.nresidues[self.xlink_residue_name]):
-            for j in range(len(bonds)):
-                self.all_bonds.append([int(bonds[j][0]) + i * natoms, int(bonds[j][1]) + i * natoms])
+        bonds = np.array(self.residues[self.res_ndx].bonds, dtype=int).reshape(-1, 2)
+        offsets = np.arange(self.nresidues[self.xlink_residue_name]) * natoms
+        self.all_bonds = (bonds[np.newaxis, ...] + offsets[:, np.newaxis, np.newaxis]).reshape(-1, 2).tolist()
 
         # number all vsites
-        nvsites = len(self.residues[self.res_ndx].virtual_sites)
         nres = self.nresidues[self.xlink_residue_name]
-        self.vsites = np.zeros([nvsites*nres, 9], dtype=object)
-        for i in range(nres):
-            for k in range(nvsites):
-                self.vsites[i * nvsites + k, :] = [float(j) for j in self.residues[self.res_ndx].virtual_sites[k]]
-                self.vsites[i * nvsites + k, :5] += i * natoms
+        vsites = np.array(self.residues[self.res_ndx].virtual_sites, dtype=float)
+        self.vsites = np.tile(vsites, (nres, 1))
+        self.vsites[:, :5] += np.repeat(np.arange(nres) * natoms, vsites.shape[0])[:, np.newaxis]
+        self.removed_vsites = set()  # rows of self.vsites whose dummy atoms have become real atoms
+        self.vsite_rows = {int(x): i for i, x in enumerate(self.vsites[:, 0])}  # serial index of dummy atom: row
+        self.vsite_carbon_rows = {int(x): i for i, x in enumerate(self.vsites[:, 1])}  # serial index of carbon: row
 
         # number all improper dihedrals
-        nimpropers = len(self.xlink_residue.improper_dihedrals)
-        self.impropers = np.zeros([nimpropers*nres, 5], dtype=int)
-        for i in range(nres):
-            for j in range(nimpropers):
-                self.impropers[i * nimpropers + j, :] = [int(k) for k in self.xlink_residue.improper_dihedrals[j]]
-                self.impropers[i * nimpropers + j, :4] += i * natoms
+        impropers = np.array(self.xlink_residue.improper_dihedrals, dtype=int)
+        self.impropers = np.tile(impropers, (nres, 1))
+        self.impropers[:, :4] += np.repeat(np.arange(nres) * natoms, impropers.shape[0])[:, np.newaxis]
+        self.removed_impropers = set()  # rows of self.impropers that no longer apply
+        self.improper_rows = self.create_adjacency_matrix(np.column_stack((self.impropers[:, :4].ravel(),
+                                                          np.repeat(np.arange(self.impropers.shape[0]), 4))),
+                                                          symmetric=False)  # atom serial index: improper rows
 
         # get pairs, angles, dihedrals
-        self.pairs = None
-        self.angles = None
-        self.dihedrals = None
+        self.pairs = np.zeros([0, 2], dtype=int)
+        self.angles = np.zeros([0, 3], dtype=int)
+        self.dihedrals = np.zeros([0, 4], dtype=int)
         self.adjacency_matrix = None
+        self.angle_bonds = np.zeros([0], dtype=int)  # index of bond in self.all_bonds each angle was built from
+        self.dihedral_bonds = np.zeros([0], dtype=int)  # index of bond in self.all_bonds each dihedral was built from
+        self.nbonds_defined = 0  # number of bonds in self.all_bonds whose angles, dihedrals and pairs are known
 
         self.define_topology()
 
@@ -313,17 +263,86 @@ class Topology():
         self.terminate = []
 
     def define_topology(self):
+        """ Update the adjacency matrix and the lists of angles, dihedrals and pairs. Only bonds added to
+        self.all_bonds since the last call are processed, so the work done scales with the number of new bonds rather
+        than the size of the system.
+
+        An angle i-j-k exists for every bond [j, k] and neighbor i of j with i < k. A dihedral h-i-j-k exists for every
+        angle i-j-k and neighbor h of i with h < k. Each dihedral defines the 1-4 pair [h, k]. New bonds can create
+        angles (and dihedrals) in two ways: from the new bonds themselves, and from existing bonds (and angles) whose
+        first atom gained a neighbor.
+        """
+
+        bonds = np.array(self.all_bonds, dtype=int).reshape(-1, 2)
+        n = self.nbonds_defined
+
+        self.adjacency_matrix = self.create_adjacency_matrix(bonds)
+        new_neighbors = self.create_adjacency_matrix(bonds[n:])  # neighbors gained through new bonds only
+
+        # angles formed by new bonds and angles formed by old bonds with new neighbors
+        angles = [self.find_angles(bonds[n:], self.adjacency_matrix), self.find_angles(bonds[:n], new_neighbors)]
+        new_angles = np.concatenate([a[0] for a in angles])
+        new_angle_bonds = np.concatenate((angles[0][1] + n, angles[1][1]))  # bond each angle was built from
+
+        dihedrals = [self.find_dihedrals(new_angles, self.adjacency_matrix), self.find_dihedrals(self.angles,
+                                                                                                 new_neighbors)]
+        new_dihedrals = np.concatenate([d[0] for d in dihedrals])
+        new_dihedral_bonds = np.concatenate((new_angle_bonds[dihedrals[0][1]], self.angle_bonds[dihedrals[1][1]]))
 
-        self.create_adjacency_matrix()
-        self.find_angles()
-        self.find_dihedrals()
-        self.find_pairs()
+        # order everything as if it had been generated by looping over all bonds, then over neighbors
+        self.angles = np.concatenate((self.angles, new_angles))
+        self.angle_bonds = np.concatenate((self.angle_bonds, new_angle_bonds))
+        order = np.lexsort((self.angles[:, 0], self.angle_bonds))
+        self.angles, self.angle_bonds = self.angles[order], self.angle_bonds[order]
+
+        self.dihedrals = np.concatenate((self.dihedrals, new_dihedrals))
+        self.dihedral_bonds = np.concatenate((self.dihedral_bonds, new_dihedral_bonds))
+        order = np.lexsort((self.dihedrals[:, 0], self.dihedrals[:, 1], self.dihedral_bonds))
+        self.dihedrals, self.dihedral_bonds = self.dihedrals[order], self.dihedral_bonds[order]
+
+        self.pairs = self.find_pairs(self.dihedrals)
+
+        self.nbonds_defined = bonds.shape[0]
 
     def write_assembly_topology(self, out='assembly.itp', virtual_sites=True, vsite_atom_name='hc_d'):
 
-        if not virtual_sites:
-            count = 0
-            new_numbers = {}  # everything will need to be renumbered
+        residue = self.residues[self.res_ndx].topology
+        natoms = residue.natoms
+        nres = self.nresidues[self.xlink_residue_name]
+
+        # one row per atom: nr, type, resi, res, atom, cgnr, charge, mass, comment
+        atoms = np.zeros([nres * natoms, 9], dtype=object)
+        atoms[:, 0] = np.arange(1, nres * natoms + 1)
+        atoms[:, 1] = self.xlink_residue_atoms.type
+        atoms[:, 2] = np.tile(residue.resnr, nres)
+        atoms[:, 3] = np.tile(residue.residues, nres)
+        atoms[:, 4] = np.tile(residue.names, nres)
+        atoms[:, 5] = np.tile(residue.cgnr, nres)
+        atoms[:, 6] = self.xlink_residue_atoms.charge
+        atoms[:, 7] = self.xlink_residue_atoms.mass
+        atoms[:, 8] = ''
+
+        impropers = np.delete(self.impropers, list(self.removed_impropers), axis=0)
+
+        if virtual_sites:
+
+            atoms[np.isin(atoms[:, 0], np.array(self.terminate, dtype=int)), 8] = '; T'
+            atoms[np.array(self.radicals, dtype=int), 8] = '; *'
+
+        else:  # remove dummy atoms and renumber everything
+
+            atoms = atoms[self.xlink_residue_atoms.type != vsite_atom_name]
+
+            new_numbers = np.zeros(nres * natoms + 1, dtype=int)
+            new_numbers[atoms[:, 0].astype(int)] = np.arange(1, atoms.shape[0] + 1)
+            atoms[:, 0] = new_numbers[atoms[:, 0].astype(int)]
+
+            self.all_bonds = new_numbers[np.array(self.all_bonds, dtype=int)].tolist()
+            self.pairs = new_numbers[self.pairs]
+            self.angles = new_numbers[self.angles]
+            self.dihedrals = new_numbers[self.dihedrals]
+            self.impropers[:, :4] = new_numbers[self.impropers[:, :4]]
+            impropers[:, :4] = new_numbers[impropers[:, :4]]
 
         with open(out, 'w') as f:
 
@@ -334,117 +353,98 @@ class Topology():
             f.write('\n')
             f.write('[ atoms ]\n')
             f.write(';   nr  type  resi  res  atom  cgnr     charge      mass\n')
-            atom_info = self.residues[self.res_ndx].atom_info
-            natoms = self.residues[self.res_ndx].natoms
-            nres = self.nresidues[self.xlink_residue_name]
-            for i in range(nres):
-                for j in range(len(atom_info)):
-                    if virtual_sites:
-                        f.write('{:>5d}{:>5s}{:>6s}{:>6s}{:>6s}{:>7s}{:>13f}{:>13f}'.format(int(atom_info[j][0]) + i*natoms,
-                                self.xlink_residue_atoms.type[i*natoms + j], atom_info[j][2], atom_info[j][3],
-                                atom_info[j][4], atom_info[j][5], self.xlink_residue_atoms.charge[i*natoms + j],
-                                self.xlink_residue_atoms.mass[i * natoms + j]))
-                        if (i * natoms + j) in self.radicals:
-                            f.write('; *\n')
-                        elif (i * natoms + j + 1) in self.terminate:
-                            f.write('; T\n')
-                        else:
-                            f.write('\n')
-                    else:
-                        if self.xlink_residue_atoms.type[i*natoms + j] != vsite_atom_name:
-                            count += 1
-                            f.write('{:>5d}{:>5s}{:>6s}{:>6s}{:>6s}{:>7s}{:>13f}{:>13f}\n'.format(count,
-                                    self.xlink_residue_atoms.type[i*natoms + j], atom_info[j][2], atom_info[j][3],
-                                    atom_info[j][4], atom_info[j][5], self.xlink_residue_atoms.charge[i*natoms + j],
-                                    self.xlink_residue_atoms.mass[i * natoms + j]))
-                            new_numbers[i*natoms + j + 1] = count
-
-            if not virtual_sites:  # renumber atoms
-
-                for i in range(len(self.all_bonds)):
-                    self.all_bonds[i] = [new_numbers[x] for x in self.all_bonds[i]]
-                for i in range(len(self.pairs)):
-                    self.pairs[i] = [new_numbers[x] for x in self.pairs[i]]
-                for i in range(len(self.angles)):
-                    self.angles[i] = [new_numbers[x] for x in self.angles[i]]
-                for i in range(len(self.dihedrals)):
-                    self.dihedrals[i] = [new_numbers[x] for x in self.dihedrals[i]]
-                for i in range(len(self.impropers)):
-                    self.impropers[i, :-1] = [new_numbers[x] for x in self.impropers[i, :-1]]
+            np.savetxt(f, atoms, fmt='%5d%5s%6s%6s%6s%7s%13f%13f%s')
 
             f.write('\n[ bonds ]\n')
             f.write(';   ai     aj funct\n')
-            for i in range(len(self.all_bonds)):
-                    f.write('{:>6d}{:>7d}  1\n'.format(self.all_bonds[i][0], self.all_bonds[i][1]))
+            np.savetxt(f, np.array(self.all_bonds, dtype=int).reshape(-1, 2), fmt='%6d%7d  1')
 
             f.write('\n[ pairs ]\n')
             f.write(';   ai     aj    funct\n')
-            for i in range(len(self.pairs)):
-                f.write('{:>6d}{:>7d}{:>7d}\n'.format(self.pairs[i][0], self.pairs[i][1], 1))
+            np.savetxt(f, self.pairs, fmt='%6d%7d      1')
 
             f.write('\n[ angles ]\n')
             f.write(';   ai      aj      ak    funct\n')
-            for i in range(len(self.angles)):
-                f.write('{:>6d}{:>7d}{:>7d}{:>7d}\n'.format(self.angles[i][0], self.angles[i][1], self.angles[i][2], 1))
+            np.savetxt(f, self.angles, fmt='%6d%7d%7d      1')
 
             f.write('\n[ dihedrals ]\n')
             f.write(';   ai     aj    funct\n')
-            for i in range(len(self.dihedrals)):
-                f.write('{:>6d}{:>7d}{:>7d}{:>7d}{:>7d}\n'.format(self.dihedrals[i][0], self.dihedrals[i][1],
-                                                                  self.dihedrals[i][2], self.dihedrals[i][3], 3))
+            np.savetxt(f, self.dihedrals, fmt='%6d%7d%7d%7d      3')
 
             f.write('\n[ dihedrals ] ; impropers\n')
             f.write(';     i      j      k      l    func\n')
-            #impropers = self.residues[self.res_ndx].improper_dihedrals
-
-            for i in range(self.impropers.shape[0]):
-                f.write('{:<6d}{:<7d}{:<7d}{:<7d}{:<7d}\n'.format(self.impropers[i, 0], self.impropers[i, 1],
-                        self.impropers[i, 2], self.impropers[i, 3], self.impropers[i, 4]))
+            np.savetxt(f, impropers, fmt='%-6d%-7d%-7d%-7d%-7d')
 
             if virtual_sites:
                 f.write('\n[ virtual_sites4 ]\n')
                 f.write(';Site  from                         funct   a          b          d\n')
-                for i in range(self.vsites.shape[0]):
-                    f.write('{:<8d}{:<6d}{:<6d}{:<6d}{:<8d}{:<8s}{:<11f}{:<11f}{:<11f}\n'.format(int(self.vsites[i, 0]),
-                            int(self.vsites[i, 1]), int(self.vsites[i, 2]), int(self.vsites[i, 3]), int(self.vsites[i, 4]),
-                            str(self.vsites[i, 5]), self.vsites[i, 6], self.vsites[i, 7], self.vsites[i, 8]))
+                vsites = np.delete(self.vsites, list(self.removed_vsites), axis=0).astype(object)
+                vsites[:, 5] = [str(x) for x in vsites[:, 5]]
+                np.savetxt(f, vsites, fmt='%-8d%-6d%-6d%-6d%-8d%-8s%-11f%-11f%-11f')
 
-    def create_adjacency_matrix(self):
+    def create_adjacency_matrix(self, bonds, symmetric=True):
+        """ Build a sparse adjacency matrix from a list of bonds. Rows and columns are serial atom indices (row 0 is
+        unused)
+
+        :param bonds: pairs of serial indices of bonded atoms (nbonds, 2)
+        :param symmetric: add entries for [j, i] as well as [i, j]
+
+        :type bonds: numpy.ndarray
+        :type symmetric: bool
+
+        :return: scipy.sparse.csr_matrix whose row i lists the atoms bonded to atom i in sorted order
+        """
 
         natoms = self.nresidues[self.xlink_residue_name] * self.residues[self.res_ndx].natoms
-        #self.adjacency_matrix = np.zeros([natoms, natoms], dtype=bool)  # 27 GB --> 3 GB when changed dtype to bool
-        self.adjacency_matrix = lil_matrix((natoms, natoms), dtype=int)  # 27 GB --> 56 bytes wow
-        for i, bond in enumerate(self.all_bonds):
-            self.adjacency_matrix[bond[0] - 1, bond[1] - 1] = 1
-            self.adjacency_matrix[bond[1] - 1, bond[0] - 1] = 1
+        bonds = np.asarray(bonds, dtype=int).reshape(-1, 2)
+
+        if symmetric:
+            bonds = np.concatenate((bonds, bonds[:, ::-1]))
 
-    def find_angles(self):
+        adjacency = csr_matrix((np.ones(bonds.shape[0], dtype=int), (bonds[:, 0], bonds[:, 1])),
+                               shape=(natoms + 1, max(natoms + 1, bonds[:, 1].max(initial=0) + 1)))
+        adjacency.sum_duplicates()
 
-        self.angles = []
-        for bond in self.all_bonds:
-            # nonzero = np.nonzero(self.adjacency_matrix[bond[0] - 1])[0] + 1
-            # nonzero = self.adjacency_matrix[bond[0] - 1].nonzero()[1] + 1
-            nonzero = np.array(self.adjacency_matrix[bond[0] - 1].rows[0]) + 1
-            for i in nonzero:
-                if i < bond[1] and i not in bond:
-                    self.angles.append([i, bond[0], bond[1]])
+        return adjacency
+
+    @staticmethod
+    def extend(chains, adjacency):
+        """ Extend chains of bonded atoms (bonds, angles, ...) by one atom bonded to their first atom. An atom is only
+        added if its serial index is lower than that of the last atom of the chain and it is not already in the chain
+
+        :param chains: serial indices of atoms in each chain (nchains, length)
+        :param adjacency: adjacency matrix. See create_adjacency_matrix
+
+        :type chains: numpy.ndarray
+        :type adjacency: scipy.sparse.csr_matrix
+
+        :return: extended chains (nextended, length + 1) and the index of the chain each was extended from
+        """
 
-    def find_dihedrals(self):
+        chains = np.asarray(chains, dtype=int)
+        first = chains[:, 0]
 
-        self.dihedrals = []
-        for angle in self.angles:
-            # nonzero = np.nonzero(self.adjacency_matrix[angle[0] - 1])[0] + 1
-            #nonzero = self.adjacency_matrix[angle[0] - 1].nonzero()[1] + 1
-            nonzero = np.array(self.adjacency_matrix[angle[0] - 1].rows[0]) + 1
-            for i in nonzero:
-                if i < angle[2] and i not in angle:
-                    self.dihedrals.append([i, angle[0], angle[1], angle[2]])
+        degree = np.diff(adjacency.indptr)[first]
+        row = np.repeat(np.arange(chains.shape[0]), degree)
+        neighbor = adjacency.indices[np.arange(row.size) + np.repeat(adjacency.indptr[first] - np.cumsum(degree) +
+                                                                     degree, degree)]
 
-    def find_pairs(self):
+        keep = (neighbor < chains[row, -1]) & ~np.any(chains[row] == neighbor[:, np.newaxis], axis=1)
 
-        self.pairs = []
-        for i in self.dihedrals:
-            self.pairs.append([i[0], i[3]])
+        return np.column_stack((neighbor[keep], chains[row[keep]])), row[keep]
+
+    def find_angles(self, bonds, adjacency):
+
+        return self.extend(np.asarray(bonds, dtype=int).reshape(-1, 2), adjacency)
+
+    def find_dihedrals(self, angles, adjacency):
+
+        return self.extend(np.asarray(angles, dtype=int).reshape(-1, 3), adjacency)
+
+    @staticmethod
+    def find_pairs(dihedrals):
+
+        return dihedrals[:, [0, 3]]
 
 
 class System(Topology):
@@ -488,67 +488,29 @@ class System(Topology):
         Energy minimize a configuration using existing .mdp files
         """
 
-        p1 = subprocess.Popen(
-            ["gmx", "grompp", "-p", "%s" % top, "-f", "%s" % mdp, "-o", "%s" % out, "-c", "%s" % configuration],
-            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)  # generate atomic level input file
-        p1.wait()
-
-        if parallel:
-            p2 = subprocess.Popen(["mpirun", "-np", "%s" % np, "gmx_mpi", "mdrun", "-deffnm", "%s" % out],
-                                  stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
-        else:
-            p2 = subprocess.Popen(["gmx", "mdrun", "-deffnm", "%s" % out], stdout=open(os.devnull, 'w'),
-                                  stderr=subprocess.STDOUT)  # run energy minimization
-        p2.wait()
-
-    def minimum_image_distances(self, list1, list2):
-        """
-        Find the minimum image distance between all pairs of atoms between two lists. They can be of different length.
-        This is written for a cubic box, so transformations need to be applied if non-cubic box is used
-        :param list1: numpy array or list
-        :param list2: numpy array or list
-        :return:
-        """
-
-        dim = self.t.unitcell_lengths[0]
-
-        list1_len = len(list1)
-        list2_len = len(list2)
-
-        diff = np.zeros([list1_len * list2_len, 3])
-        for i in range(list1_len):
-            diff[i * list2_len: (i + 1) * list2_len] = self.t.xyz[0, list1[i], :] - self.t.xyz[0, list2, :]
-
-        diff = np.where(diff > 0.5 * dim, diff - dim, diff)
-        diff = np.where(diff < -0.5 * dim, diff + dim, diff)
-
-        return diff
+        runner = jobs.Runner(mpi=parallel, nproc=np)
+        runner.grompp(mdp, top, configuration, out)  # generate atomic level input file
+        runner.mdrun(out, nproc=np)  # run energy minimization
 
     def generate_ordered_distances(self, list1, list2):
         """
-        Generate a list ordered sequentially based on pairwise distances between atom indices listed in list1 and list2
+        Generate a list ordered sequentially based on pairwise distances between atom indices listed in list1 and list2.
+        Pairs are found with a periodic KD-tree search in the (monoclinic) unit cell, so memory use scales with the
+        number of pairs within self.cutoff rather than len(list1) * len(list2)
         :param list1: list or numpy array
         :param list2: list or numpy array
-        :param cut: maximum allowable pairwise distance to still be considered eligible for bonding (nm)
         :return: 2 same-length numpy arrays ordered so each index is paired with the same index with the other array.
-        Pairwise distances are in increasing order.
+        Pairwise distances are in increasing order. Only pairs closer than self.cutoff are included.
         """
 
-        diff = self.minimum_image_distances(list1, list2)
-        d = np.linalg.norm(diff, axis=1)
-
-        d_ndx = np.argsort(d)
+        i, j, d = neighbors.pairs(self.t.xyz[0, list1, :], self.t.unitcell_vectors[0], self.cutoff,
+                                  y=self.t.xyz[0, list2, :], order='distance')
 
         # These lists may need post-modification to account for adjacent atoms
-        eligible_list1 = (d_ndx // len(list2))
-        eligible_list2 = (d_ndx % len(list2))
-
-        eligible_list1 = np.array(list1)[eligible_list1]
-        eligible_list2 = np.array(list2)[eligible_list2]
+        eligible_list1 = np.array(list1)[i]
+        eligible_list2 = np.array(list2)[j]
 
-        cut_ndx = np.argmin(np.abs(d[d_ndx] - self.cutoff))  # index where cut is exceeded
-
-        return eligible_list1[:cut_ndx], eligible_list2[:cut_ndx]
+        return eligible_list1, eligible_list2
 
     def select_eligible_carbons(self):
         """
@@ -561,13 +523,6 @@ class System(Topology):
         """
 
         # calculate minimum image distance between c1 and c2 atoms
-
-        # shift so box is cubic temporarily. The minimum image distances are just an approximation using this approach
-        theta = np.pi / 3
-
-        self.t.xyz[..., 1] /= np.sin(theta)
-        self.t.xyz[..., 0] = self.t.xyz[..., 0] - self.t.xyz[..., 1]*np.cos(theta)
-
         if self.radicals:
 
             eligible_c1_rad, eligible_rad = self.generate_ordered_distances(self.c1_atoms, self.radicals)
@@ -585,7 +540,7 @@ class System(Topology):
 
         # prevent adjacent carbon atoms from bonding
         exclude = 0
-        while eligible_c1[exclude] == (eligible_c2[exclude] + 1):  # This 1 is hard-coded. Could be made more general
+        while exclude < len(eligible_c1) and eligible_c1[exclude] == (eligible_c2[exclude] + 1):  # This 1 is hard-coded. Could be made more general
             exclude += 1
 
         eligible_c1 = eligible_c1[exclude:]
@@ -632,7 +587,7 @@ class System(Topology):
 
             # Get (serial) indices of hydrogen atoms to make real
             for i in c1:
-                ndx = np.where(self.vsites[:, 1] == i)[0]  # index 1 contains serial carbon index used to construct vsite
+                ndx = self.vsite_carbon_rows[i]  # index 1 contains serial carbon index used to construct vsite
                 self.initiators.append(int(self.vsites[ndx, 0]))  # index 0 contains serial index of dummy H atom
 
             # add bonds -- this can be made more general
@@ -660,23 +615,13 @@ class System(Topology):
         # keep improper dihedrals involving oxygen
         oxygen = self.xlink_residue.get_carbonyl_oxygens()
 
-        rm_imp = []
         # all improper dihedrals that c1 is involved with do not involve the carbonyl oxygen
-        for i in self.bond_c1:
-            imps = np.where(self.impropers == i)[0]
-            for j in imps:
-                rm_imp.append(j)
+        self.removed_impropers.update(self.improper_rows[np.array(self.bond_c1, dtype=int)].indices.tolist())
 
-        for i in self.bond_c2:
-            imps = np.where(self.impropers == i)[0]
-            for j in imps:
-                test = [x for x in (self.impropers[j, :] % self.xlink_residue.natoms) if x in oxygen]
-                if not test:  # if list is empty, then there is no carbonyl carbon, so we should remove the dihedral
-                    rm_imp.append(j)
-
-        rm_imp = np.unique(rm_imp)  # should be unnecessary
-
-        self.impropers = np.delete(self.impropers, rm_imp, axis=0)
+        c2_impropers = np.unique(self.improper_rows[np.array(self.bond_c2, dtype=int)].indices)
+        carbonyl = np.isin(self.impropers[c2_impropers, :] % self.xlink_residue.natoms, oxygen).any(axis=1)
+        # if there is no carbonyl carbon, we should remove the dihedral
+        self.removed_impropers.update(int(j) for j in c2_impropers[~carbonyl])
 
     def identify_terminated(self, rad_term_frac=0.5):
 
@@ -690,7 +635,7 @@ class System(Topology):
 
             # bond dummy hydrogen to terminated radicals
             for i in self.terminated_radicals:
-                ndx = np.where(self.vsites[:, 1] == (i + 1))[0]  # index 1 contains serial carbon index used to construct vsite
+                ndx = self.vsite_carbon_rows[i + 1]  # index 1 contains serial carbon index used to construct vsite
                 H = int(self.vsites[ndx, 0])  # index 0 contains serial index of dummy H atom
                 self.all_bonds.append([i + 1, H])
                 self.xlink_residue_atoms.type[H - 1] = 'hc'  # change from dummy hydrogen to real hydrogen
@@ -711,12 +656,7 @@ class System(Topology):
     def remove_virtual_sites(self):
 
         # remove virtual sites for atoms that became real
-        rm_vsite = []
-        for i in range(self.vsites.shape[0]):
-            if int(self.vsites[i, 0]) in self.initiators:
-                rm_vsite.append(i)
-
-        self.vsites = np.delete(self.vsites, rm_vsite, axis=0)  # delete vsite entries
+        self.removed_vsites.update(self.vsite_rows[i] for i in self.initiators if i in self.vsite_rows)
 
     def bond(self):
 
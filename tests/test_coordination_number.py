@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+import numpy as np
+from llcsim.analysis import coordination_number
+
+
+def overlapping_system(nframes=3, n=8, L=2.0, seed=0):
+    """ System whose centers and coordinated atoms are the same set of points, as with -r HOH -rc HOH
+    """
+
+    rng = np.random.default_rng(seed)
+    system = object.__new__(coordination_number.System)
+    system.com = rng.uniform(0, L, size=(nframes, n, 3))
+    system.com_coordinated = system.com.copy()
+    system.box = np.tile(np.eye(3) * L, (nframes, 1, 1))
+    system.n_frames = nframes
+
+    return system
+
+
+def brute_force(x, y, L, cut):
+
+    d = x[:, :, np.newaxis, :] - y[:, np.newaxis, :, :]
+    d -= L * np.round(d / L)
+    d = np.linalg.norm(d, axis=-1)
+
+    return (d > 0) & (d <= cut), d
+
+
+def test_overlapping_selections_exclude_self():
+
+    system = overlapping_system()
+    cut = 0.8
+    system.distance_search(cut=cut)
+
+    contacts, d = brute_force(system.com, system.com_coordinated, 2.0, cut)
+
+    np.testing.assert_array_equal(system.contacts.coordination_number(), contacts.sum(axis=2))
+
+    for t in range(system.n_frames):
+        frame = system.contacts[t]
+        assert frame.nnz == frame.count_nonzero()  # no explicitly stored zero distances
+        np.testing.assert_allclose(frame.toarray(), np.where(contacts[t], d[t], 0), rtol=1e-6)
+
+    for i in range(system.com.shape[1]):
+        assert i not in system.contacts.neighbors(-1, i)
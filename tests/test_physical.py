@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+
+import numpy as np
+import pytest
+from llcsim.llclib import physical
+
+
+def test_center_of_mass_ignores_partial_residue():
+
+    rng = np.random.default_rng(0)
+    pos = rng.uniform(0, 3, size=(2, 7, 3))  # two complete residues of 3 atoms followed by one leftover atom
+    mass = np.array([12.011, 1.008, 15.999])
+
+    com = physical.center_of_mass(pos, mass)
+
+    expected = np.stack([(pos[:, 3 * r:3 * (r + 1), :] * mass[:, np.newaxis]).sum(axis=1) / mass.sum()
+                         for r in range(2)], axis=1)
+
+    assert com.shape == (2, 2, 3)
+    np.testing.assert_allclose(com, expected)
+
+
+def test_center_of_mass_offsets_need_every_mass():
+
+    pos = np.zeros([1, 5, 3])
+
+    with pytest.raises(ValueError):
+        physical.center_of_mass(pos, np.ones(3), offsets=[0, 3])